@@ -1,9 +1,39 @@
+import base64
+import binascii
 import json
-from typing import Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
 from urllib.parse import urlencode
 
 import urllib3
 
+# the maximum number of concurrent token exchanges (and pooled connections per host)
+MAX_WORKERS = 8
+
+# transient ICA errors are retried with exponential backoff (0.5s, 1s, 2s) - the token POST is safe to repeat
+RETRY = urllib3.Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(500, 502, 503, 504),
+    allowed_methods=frozenset(["POST"]),
+    raise_on_status=False,
+)
+
+# JWTs are not immediately useful due to ICA clock skew and nbf claims
+# https://github.com/umccr-illumina/stratus/issues/151
+# so new JWTs are only released once they are valid (plus a margin for the skew) - but never later than it used to
+CLOCK_SKEW_MARGIN = 5  # seconds
+MAX_READINESS_WAIT = 30  # seconds
+VERIFY_INTERVAL = 1  # seconds between verification attempts
+
+# shared by all exchanges (and warm invocations), so the TLS session to ICA is set up once
+http = urllib3.PoolManager(
+    maxsize=MAX_WORKERS,
+    retries=RETRY,
+    timeout=urllib3.Timeout(connect=5.0, read=15.0),
+)
+
 
 # Two wrapper scripts for v1 and v2 platforms respectfully
 def api_key_to_jwt_for_project_v1(ica_base_url: str, api_key: str, cid: str) -> str:
@@ -14,6 +44,102 @@ def api_key_to_jwt_for_project_v1(ica_base_url: str, api_key: str, cid: str) ->
                                       output_attribute="access_token")
 
 
+def api_keys_to_jwts_for_projects_v1(ica_base_url: str, api_key: str, cids: List[str],
+                                     max_workers: int = MAX_WORKERS) -> Dict[str, str]:
+    """
+    Exchanges the API key for one JWT per project, with the exchanges running concurrently.
+
+    Returns:
+        a dictionary of project id to JWT access token
+    """
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(cids)))) as executor:
+        jwts = executor.map(lambda cid: api_key_to_jwt_for_project_v1(ica_base_url, api_key, cid), cids)
+        result = dict(zip(cids, jwts))
+
+    print(f"Exchanged {len(cids)} project JWTs in {time.perf_counter() - start:.2f}s")
+
+    return result
+
+
+def jwt_claims(jwt: str) -> Dict[str, Any]:
+    """
+    Decodes the claims of a JWT - *without* verifying its signature (we only want to know its validity period).
+    """
+    payload = jwt.split(".")[1]
+    claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    if not isinstance(claims, dict):
+        raise ValueError("JWT payload is not a JSON object")
+    return claims
+
+
+def jwt_not_before(jwt: str) -> Optional[float]:
+    """
+    Returns:
+        the nbf claim of a JWT (or its iat claim if it has no nbf), or None if it has neither
+    """
+    claims = jwt_claims(jwt)
+    not_before = claims.get("nbf", claims.get("iat"))
+    if not isinstance(not_before, (int, float)):
+        return None
+    return float(not_before)
+
+
+def wait_until_jwts_ready(jwts: List[str], ica_base_url: str, verify_path: Optional[str] = None,
+                          clock_skew_margin: float = CLOCK_SKEW_MARGIN,
+                          max_wait: float = MAX_READINESS_WAIT) -> float:
+    """
+    Waits until newly created JWTs can be expected to be accepted by ICA, i.e. until the latest nbf (or iat)
+    claim of the JWTs plus a margin for clock skew has passed. If the claims can't be decoded (or a JWT has neither
+    claim) we fall back to waiting the maximum time.
+
+    Args:
+        jwts: the new JWTs
+        ica_base_url: the base URL for ICA
+        verify_path: optionally, the path of an ICA endpoint (e.g. '/v1/volumes?pageSize=1') that is called with
+                     each JWT until it is no longer rejected
+        clock_skew_margin: seconds to wait in addition to the nbf/iat claims
+        max_wait: the maximum number of seconds to wait
+
+    Returns:
+        the number of seconds waited
+    """
+    start = time.time()
+    deadline = start + max_wait
+
+    ready_at = deadline
+    try:
+        not_befores = [jwt_not_before(jwt) for jwt in jwts]
+    except (IndexError, ValueError, binascii.Error) as e:
+        print(f"Could not decode the claims of the new JWTs, waiting {max_wait}s: {e}")
+    else:
+        known_not_befores = [not_before for not_before in not_befores if not_before is not None]
+        if known_not_befores and len(known_not_befores) == len(not_befores):
+            ready_at = min(max(known_not_befores) + clock_skew_margin, deadline)
+        else:
+            print(f"New JWTs without nbf/iat claims, waiting {max_wait}s")
+
+    if ready_at > time.time():
+        time.sleep(ready_at - time.time())
+
+    if verify_path:
+        for jwt in jwts:
+            while True:
+                r = http.request("GET", f"{ica_base_url}{verify_path}", headers={"Authorization": f"Bearer {jwt}"})
+                if r.status not in (401, 403):
+                    break
+                if time.time() + VERIFY_INTERVAL > deadline:
+                    print(f"New JWT still rejected ({r.status}) by '{verify_path}' after {time.time() - start:.1f}s")
+                    break
+                time.sleep(VERIFY_INTERVAL)
+
+    waited = time.time() - start
+    print(f"Waited {waited:.1f}s for {len(jwts)} new JWTs to become valid")
+
+    return waited
+
+
 def api_key_to_jwt_for_project_v2(ica_base_url: str, api_key: str) -> str:
     return api_key_to_jwt_for_project(url=f"{ica_base_url}/ica/rest/api/tokens",
                                       accept_value="application/vnd.illumina.v3+json",
@@ -41,11 +167,11 @@ def api_key_to_jwt_for_project(url: str, accept_value: str, encoded_params: Opti
         uses urllib3 rather than a more featured library as this allows us to
         avoid a more complex lambda build step (urllib3 is built into lambda base image).
     """
-    http = urllib3.PoolManager()
-
     if encoded_params is not None:
         url = f"{url}?{encoded_params}"
 
+    start = time.perf_counter()
+
     r = http.request(
         "POST",
         url,
@@ -56,6 +182,9 @@ def api_key_to_jwt_for_project(url: str, accept_value: str, encoded_params: Opti
         body=None,
     )
 
+    print(f"ICA token exchange POST to '{url}' returned {r.status} in {(time.perf_counter() - start) * 1000:.0f}ms "
+          f"({len(r.retries.history) if r.retries else 0} retries)")
+
     if r.status == 201:
         body = r.data.decode("utf-8")
         body_as_json = json.loads(body)
@@ -1,10 +1,10 @@
 import json
 import os
-from time import sleep
 from typing import Any
 
 import boto3
 
+from ica_common import wait_until_jwts_ready
 from secret_manager_common import (
     get_master_api_key,
     do_finish_secret,
@@ -25,6 +25,8 @@ def main(ev: Any, _: Any) -> Any:
     Params
     PROJECT_ID  or  PROJECT_IDS   the projects to ask for in the JWT - this alters the format of the
                                   resulting Secret (either straight JWT *or* dictionary)
+    VERIFY_PATH   optional path of an ICA endpoint (e.g. /v1/volumes?pageSize=1) the new JWTs are
+                  checked against before the createSecret step finishes
     """
     arn = ev["SecretId"]
     tok = ev["ClientRequestToken"]
@@ -51,6 +53,7 @@ def main(ev: Any, _: Any) -> Any:
     else:  # V1
         # We import the api_key_to_jwt_for_project method for v1
         from ica_common import api_key_to_jwt_for_project_v1 as api_key_to_jwt_for_project
+        from ica_common import api_keys_to_jwts_for_projects_v1 as api_key_to_jwts_for_projects
 
         # we operate in two basic modes - in one we have a single project id and generate a single JWT for it
         # when given multiple ids however, ICA doesn't allow a combined JWT - so instead we generate a dictionary
@@ -89,24 +92,24 @@ def main(ev: Any, _: Any) -> Any:
     if step == "createSecret":
 
         def exchange_multi() -> str:
-            result = {}
-            for p in project_ids:
-                result[p] = api_key_to_jwt_for_project(ica_base_url, master_val, p)
-            return json.dumps(result)
+            return json.dumps(api_key_to_jwts_for_projects(ica_base_url, master_val, project_ids))
 
         def exchange_single() -> str:
             return api_key_to_jwt_for_project(ica_base_url, master_val, project_id)
 
-        do_create_secret(
+        is_single = is_ica_v2_platform or project_id is not None
+
+        new_secret = do_create_secret(
             sm_client, arn, tok,
-            exchange_single if is_ica_v2_platform or project_id is not None
-            else exchange_multi
+            exchange_single if is_single else exchange_multi
         )
 
         # JWTs are not immediately useful due to ICA clock skew and nbf claims
-        # https://github.com/umccr-illumina/stratus/issues/151
-        # So we delay here which delays the availability of this new JWT to the outside world
-        sleep(30)
+        # So we delay here (until the new JWTs are valid) which delays the availability of the new JWTs
+        # to the outside world
+        if new_secret:
+            new_jwts = [new_secret] if is_single else list(json.loads(new_secret).values())
+            wait_until_jwts_ready(new_jwts, ica_base_url, os.environ.get("VERIFY_PATH"))
 
     elif step == "setSecret":
         pass
@@ -1,5 +1,5 @@
 import traceback
-from typing import Any, Callable
+from typing import Any, Callable, Optional
 
 
 def get_master_api_key(client: Any, master_arn) -> str:
@@ -71,7 +71,7 @@ def check_rotation_state(client: Any, arn: str, tok: str) -> bool:
 
 def do_create_secret(
     client: Any, arn: str, tok: str, creator: Callable[[], str]
-) -> None:
+) -> Optional[str]:
     """
     Do the official create stage of a Secret rotation involving the logic for
     creating a secret and the safely saving it into the secret as pending.
@@ -84,6 +84,9 @@ def do_create_secret(
         arn: the secret arn
         tok: the client token for this particular rotation
         creator: a creator function that should return the new string secret
+
+    Returns:
+        the new secret, or None if there already was a pending secret
     """
     try:
         # if get_secret_value works then we have a value and we should *not* create
@@ -91,7 +94,7 @@ def do_create_secret(
 
         # all we need to do is *not* doing anything - and the rotation machinery
         # will move on to the next stage
-        return
+        return None
     except Exception as e:
         # there was no secret value - so on to the creation code
         pass
@@ -105,6 +108,8 @@ def do_create_secret(
         VersionStages=["AWSPENDING"],
     )
 
+    return new_secret
+
 
 def do_finish_secret(client: Any, arn: str, tok: str) -> None:
     """
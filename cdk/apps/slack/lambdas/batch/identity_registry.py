@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import boto3
+
+################################################################################
+# Identity registry of the Slack notifiers
+#
+# Maps AWS account IDs, IAP user IDs and IAP workgroup IDs to readable names. The built in mappings below are
+# extended/overridden by the JSON document in the SSM parameter REGISTRY_PARAMETER, e.g.
+#   {"accounts": {"<account ID>": "<name>"}, "users": {"<user ID>": "<name>"}, "workgroups": {"<wid>": "<name>"}}
+# so new users can be added without a deployment. The parameter is loaded once per container and reloaded once
+# REGISTRY_TTL seconds have passed.
+# NOTE: the same module is deployed with each Slack notifier Lambda:
+#       cdk/apps/slack/lambdas/iap, cdk/apps/slack/lambdas/batch and cdk/apps/umccrise/lambdas/slack,
+#       keep the copies in sync.
+
+REGISTRY_PARAMETER = os.environ.get("IDENTITY_REGISTRY_PARAMETER", "/slack/identity_registry")
+REGISTRY_TTL = int(os.environ.get("IDENTITY_REGISTRY_TTL", "300"))  # seconds
+
+DEFAULT_IDENTITIES = {
+    'accounts': {
+        '472057503814': 'prod',
+        '843407916570': 'dev (new)',
+        '620123204273': 'dev (old)',
+        '602836945884': 'agha',
+        '455634345446': 'stg'
+    },
+    'users': {
+        'c9688651-7872-3753-8146-ffa41c177aa1': 'Vlad Saveliev - unimelb',
+        '590dfb6c-6e4f-3db8-9e23-2d1039821653': 'Vlad Saveliev',
+        '567d89e4-de8b-3688-a733-d2a979eb510e': 'Peter - unimelb',
+        'bd68e368-7587-3e22-a30e-9a2e1714b7c1': 'Peter Diakumis',
+        '1678890e-b107-3974-a47d-0bb532a64ad6': 'Roman Valls - unimelb',
+        '9c925fa3-9b93-3f14-92a3-d35488ab1cc4': 'Roman Valls',
+        '8abf754b-e94f-3841-b44b-75d10d33588b': 'Sehrish unimelb',
+        'd24913a8-676f-39f3-9250-7cf22fbc48c8': 'Sehrish Kanwal',
+        '7eec7332-f780-3edc-bb70-c4f711398f1c': 'Florian - unimelb',
+        '6039c53c-d362-3dd6-9294-46f08d8994ff': 'Florian Reisinger',
+        '57a99faa-ae79-33f8-9736-454a36b06a43': 'Service User',
+        'ef928f99-662d-3e9f-8476-303131e9a58a': 'Karey Cheong',
+        'a46c2704-4568-3a39-b934-45bc9b352ac8': 'Voula Dimitriadis',
+        '6696900a-96ea-372a-bc00-ca6bbe19bf7b': 'Kym Pham',
+        '3ed6bc8a-ba5a-3ec3-9e25-361703c7ba20': 'Egan Lohman',
+        'b2f0ff65-c77b-37bc-af87-68a89c2f8d27': 'Alexis Lucattini',
+        '46258763-7c48-3a1c-8c5f-04003bf74e5a': 'Alexis - unimelb',
+        'aa9f1c02-3963-3c3b-ad0d-9b6f6e26a405': 'Pratik Soares - Illumina',
+        'e44e09eb-60c7-3a0f-9313-46f7454ede92': 'Andrei Seleznev - Illumina',
+        'e3c89a8a-23a7-36cf-a1dc-281d96ed1aab': 'Yinan Wang - Illumina',
+        '41fc4571-741c-386e-be44-cf9ae7313f53': 'Victor Lin'
+    },
+    'workgroups': {
+        'wid:e4730533-d752-3601-b4b7-8d4d2f6373de': 'development',
+        'wid:9c481003-f453-3ff2-bffa-ae153b1ee565': 'collab-illumina-dev',
+        'wid:acddbfda-4980-38ed-99fa-94fe79523959': 'clinical-genomics-workgroup',
+        'wid:4d2aae8c-41d3-302e-a814-cdc210e4c38b': 'production'
+    }
+}
+
+
+class IdentityRegistry:
+
+    def __init__(self, parameter_name=REGISTRY_PARAMETER, ttl=REGISTRY_TTL, defaults=DEFAULT_IDENTITIES,
+                 ssm_client=None):
+        self.parameter_name = parameter_name
+        self.ttl = ttl
+        self.defaults = defaults
+        self._ssm_client = ssm_client
+        self._identities = None
+        self._expires = 0
+
+    def _load(self):
+        identities = {kind: dict(mapping) for kind, mapping in self.defaults.items()}
+        if self.parameter_name:
+            try:
+                if self._ssm_client is None:
+                    self._ssm_client = boto3.client('ssm')
+                value = self._ssm_client.get_parameter(Name=self.parameter_name)['Parameter']['Value']
+                for kind, mapping in json.loads(value).items():
+                    identities.setdefault(kind, dict()).update(mapping)
+            except Exception as e:
+                # the built in mappings (or the last loaded ones) are still good enough to name things
+                print(f"Could not load identity registry {self.parameter_name}, keeping the current mappings: {e}")
+                if self._identities is not None:
+                    return self._identities
+        return identities
+
+    def identities(self):
+        """
+        :return: the mappings by kind ('accounts', 'users', 'workgroups'), reloaded if older than the TTL
+        """
+        now = time.monotonic()
+        if self._identities is None or now >= self._expires:
+            self._identities = self._load()
+            self._expires = now + self.ttl
+        return self._identities
+
+    def lookup(self, kind, id, default=None):
+        return self.identities().get(kind, {}).get(id, default)
+
+    def account_name(self, account_id):
+        return self.lookup('accounts', account_id, account_id)
+
+    def creator(self, user_id):
+        return f"{user_id} ({self.lookup('users', user_id, 'unknown')})"
+
+    def workgroup_name(self, wid):
+        return self.lookup('workgroups', wid, 'unknown')
+
+
+# one registry per container, shared by all invocations
+registry = IdentityRegistry()
@@ -1,7 +1,7 @@
 import os
 import json
-import boto3
-import http.client
+from identity_registry import registry
+from slack_client import SlackClient
 
 slack_host = os.environ.get("SLACK_HOST")
 slack_channel = os.environ.get("SLACK_CHANNEL")
@@ -12,43 +12,10 @@ BLUE = '#439FE0'
 GRAY = '#dddddd'
 BLACK = '#000000'
 
-ssm_client = boto3.client('ssm')
-
-headers = {
-    'Content-Type': 'application/json',
-}
-
-
-def getAwsAccountName(id):
-    if id == '472057503814':
-        return 'prod'
-    elif id == '843407916570':
-        return 'dev (new)'
-    elif id == '620123204273':
-        return 'dev (old)'
-    elif id == '602836945884':
-        return 'agha'
-    elif id == '455634345446':
-        return 'stg'
-    else:
-        return id
-
-
-def getSSMParam(name):
-    """
-    Fetch the parameter with the given name from SSM Parameter Store.
-    """
-    return ssm_client.get_parameter(
-                Name=name,
-                WithDecryption=True
-           )['Parameter']['Value']
+slack_client = SlackClient(slack_host, webhook_parameter="/slack/webhook/id")
 
 
 def call_slack_webhook(sender, topic, attachments):
-    slack_webhook_endpoint = '/services/' + getSSMParam("/slack/webhook/id")
-
-    connection = http.client.HTTPSConnection(slack_host)
-
     post_data = {
         "channel": slack_channel,
         "username": sender,
@@ -58,11 +25,7 @@ def call_slack_webhook(sender, topic, attachments):
     }
     print(f"Slack POST data: {json.dumps(post_data)}")
 
-    connection.request("POST", slack_webhook_endpoint, json.dumps(post_data), headers)
-    response = connection.getresponse()
-    connection.close()
-
-    return response.status
+    return slack_client.post(post_data)
 
 
 def lambda_handler(event, context):
@@ -144,7 +107,7 @@ def lambda_handler(event, context):
                     },
                     {
                         "title": "AWS Account",
-                        "value": getAwsAccountName(aws_account),
+                        "value": registry.account_name(aws_account),
                         "short": True
                     }
                 ],
@@ -0,0 +1,194 @@
+import os
+import time
+import posixpath
+import boto3
+
+################################################################################
+# Aggregation of GDS file upload notifications
+#
+# A BCL Convert run uploads thousands of files to GDS, each producing a gds.files notification. Instead of reporting
+# every file, the uploads are counted per volume and folder prefix (the first FOLDER_DEPTH folders of the path) in a
+# window store. Once a window is older than AGGREGATION_WINDOW seconds it is claimed (removed from the store) and
+# reported as one summary: the number of files, the total size and a sample of the paths.
+# The DynamoDB store is shared by all Lambda containers; the in memory store is a stand-in for local testing.
+
+AGGREGATION_TABLE = os.environ.get("GDS_AGGREGATION_TABLE")
+AGGREGATION_WINDOW = int(os.environ.get("GDS_AGGREGATION_WINDOW", "300"))  # seconds
+FOLDER_DEPTH = int(os.environ.get("GDS_AGGREGATION_FOLDER_DEPTH", "3"))
+SAMPLE_SIZE = 5  # paths kept per window
+RETENTION = 24 * 60 * 60  # seconds before unclaimed windows expire (DynamoDB TTL)
+
+
+def folder_prefix(path, depth=FOLDER_DEPTH):
+    """
+    :return: the first <depth> folders of a file path, e.g. /primary_data/<run>/<id>/ for a depth of 3
+    """
+    folders = [folder for folder in posixpath.dirname(path).split('/') if folder][:depth]
+    return '/' + ''.join(f"{folder}/" for folder in folders)
+
+
+class InMemoryWindowStore:
+
+    def __init__(self):
+        self.windows = dict()
+
+    def add(self, key, volume, folder, file_count, total_bytes, paths, now, sample_size):
+        window = self.windows.setdefault(key, {
+            'volume_name': volume,
+            'folder': folder,
+            'window_start': now,
+            'file_count': 0,
+            'total_bytes': 0,
+            'sample_paths': []
+        })
+        window['file_count'] += file_count
+        window['total_bytes'] += total_bytes
+        window['sample_paths'].extend(paths[:max(sample_size - len(window['sample_paths']), 0)])
+
+    def due(self, cutoff):
+        return [key for key, window in self.windows.items() if window['window_start'] <= cutoff]
+
+    def claim(self, key):
+        return self.windows.pop(key, None)
+
+
+class DynamoDbWindowStore:
+
+    def __init__(self, table_name, dynamodb_client=None):
+        self.table_name = table_name
+        self.client = dynamodb_client if dynamodb_client else boto3.client('dynamodb')
+
+    def add(self, key, volume, folder, file_count, total_bytes, paths, now, sample_size):
+        # counters are incremented atomically in a single update, concurrent containers can add to the same window
+        # and a failed add can be retried without counting the uploads twice; the first add stores the sample paths
+        window = self.client.update_item(
+            TableName=self.table_name,
+            Key={'window_key': {'S': key}},
+            UpdateExpression="SET volume_name = :volume, folder = :folder, " +
+                             "window_start = if_not_exists(window_start, :now), " +
+                             "expires = if_not_exists(expires, :expires), " +
+                             "sample_paths = if_not_exists(sample_paths, :paths) " +
+                             "ADD file_count :files, total_bytes :bytes",
+            ExpressionAttributeValues={
+                ':volume': {'S': volume},
+                ':folder': {'S': folder},
+                ':now': {'N': str(now)},
+                ':expires': {'N': str(now + RETENTION)},
+                ':paths': {'L': [{'S': path} for path in paths[:sample_size]]},
+                ':files': {'N': str(file_count)},
+                ':bytes': {'N': str(total_bytes)}
+            },
+            ReturnValues='ALL_OLD').get('Attributes', {})
+        samples = len(window.get('sample_paths', {}).get('L', []))
+        if 'sample_paths' not in window or samples >= sample_size:
+            return
+        # best effort: top up the sample, only if no other container did in the meantime (keeps it at sample_size)
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={'window_key': {'S': key}},
+                UpdateExpression="SET sample_paths = list_append(sample_paths, :paths)",
+                ConditionExpression="size(sample_paths) = :samples",
+                ExpressionAttributeValues={
+                    ':paths': {'L': [{'S': path} for path in paths[:sample_size - samples]]},
+                    ':samples': {'N': str(samples)}
+                })
+        except Exception as e:
+            print(f"Not adding sample paths to {key}: {e}")
+
+    def due(self, cutoff):
+        keys = []
+        paginator = self.client.get_paginator('scan')
+        for page in paginator.paginate(TableName=self.table_name,
+                                       FilterExpression="window_start <= :cutoff",
+                                       ExpressionAttributeValues={':cutoff': {'N': str(cutoff)}},
+                                       ProjectionExpression="window_key"):
+            keys.extend(item['window_key']['S'] for item in page.get('Items', []))
+        return keys
+
+    def claim(self, key):
+        # deleting the window claims it, so only one container reports it (including uploads added in the meantime)
+        item = self.client.delete_item(TableName=self.table_name,
+                                       Key={'window_key': {'S': key}},
+                                       ReturnValues='ALL_OLD').get('Attributes')
+        if not item:
+            return None
+        return {
+            'volume_name': item['volume_name']['S'],
+            'folder': item['folder']['S'],
+            'window_start': int(item['window_start']['N']),
+            'file_count': int(item['file_count']['N']),
+            'total_bytes': int(item['total_bytes']['N']),
+            'sample_paths': [path['S'] for path in item.get('sample_paths', {}).get('L', [])]
+        }
+
+
+class GdsUploadAggregator:
+
+    def __init__(self, store, window=AGGREGATION_WINDOW, depth=FOLDER_DEPTH, sample_size=SAMPLE_SIZE,
+                 clock=time.time):
+        self.store = store
+        self.window = window
+        self.depth = depth
+        self.sample_size = sample_size
+        self.clock = clock
+        self._pending = dict()
+
+    def add(self, volume, path, size, record_id=None):
+        """
+        Buffer an upload, the buffered uploads are added to the store by commit().
+        """
+        folder = folder_prefix(path, self.depth)
+        pending = self._pending.setdefault(f"{volume}:{folder}", {
+            'volume': volume, 'folder': folder, 'file_count': 0, 'total_bytes': 0, 'paths': [], 'record_ids': []})
+        pending['file_count'] += 1
+        pending['total_bytes'] += size
+        if len(pending['paths']) < self.sample_size:
+            pending['paths'].append(path)
+        pending['record_ids'].append(record_id)
+
+    def commit(self):
+        """
+        Add the buffered uploads to the store, one update per window.
+        :return: the record IDs of the uploads that could not be stored
+        """
+        failed_record_ids = []
+        pending_windows, self._pending = self._pending, dict()
+        now = int(self.clock())
+        for key, pending in pending_windows.items():
+            try:
+                self.store.add(key, pending['volume'], pending['folder'], pending['file_count'],
+                               pending['total_bytes'], pending['paths'], now, self.sample_size)
+            except Exception as e:
+                print(f"Could not store {pending['file_count']} GDS uploads of {key}: {e}")
+                failed_record_ids.extend(pending['record_ids'])
+        return failed_record_ids
+
+    def claim_due(self):
+        """
+        :return: the windows that are older than the aggregation window, removed from the store
+        """
+        windows = []
+        for key in self.store.due(int(self.clock()) - self.window):
+            window = self.store.claim(key)
+            if window:
+                windows.append(window)
+        return windows
+
+    def restore(self, windows):
+        """
+        Put claimed windows back into the store, e.g. if they could not be reported.
+        """
+        for window in windows:
+            self.store.add(f"{window['volume_name']}:{window['folder']}", window['volume_name'], window['folder'],
+                           window['file_count'], window['total_bytes'], window['sample_paths'],
+                           window['window_start'], self.sample_size)
+
+
+def get_aggregator():
+    """
+    :return: the aggregator backed by the GDS_AGGREGATION_TABLE, or None if aggregation is not configured
+    """
+    if not AGGREGATION_TABLE:
+        return None
+    return GdsUploadAggregator(DynamoDbWindowStore(AGGREGATION_TABLE))
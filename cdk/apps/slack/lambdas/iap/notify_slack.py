@@ -1,8 +1,8 @@
 import os
-import sys
 import json
-import boto3
-import http.client
+from identity_registry import registry
+from slack_client import SlackClient
+from gds_aggregator import get_aggregator
 from dateutil.parser import parse
 
 slack_host = os.environ.get("SLACK_HOST")
@@ -13,102 +13,23 @@ RED = '#ff0000'
 BLUE = '#439FE0'
 GRAY = '#dddddd'
 BLACK = '#000000'
+# Slack does not accept more than 100 attachments per message
+MAX_ATTACHMENTS = 100
 
-ssm_client = boto3.client('ssm')
+slack_client = SlackClient(slack_host, webhook_parameter="/slack/webhook/id")
+# GDS uploads are reported as summaries if an aggregation table is configured
+gds_aggregator = get_aggregator()
 
-headers = {
-    'Content-Type': 'application/json',
-}
-
-
-def getAwsAccountName(id):
-    if id == '472057503814':
-        return 'prod'
-    elif id == '843407916570':
-        return 'dev (new)'
-    elif id == '620123204273':
-        return 'dev (old)'
-    elif id == '602836945884':
-        return 'agha'
-    else:
-        return id
-
-
-def getCreatorFromId(id):
-    if id == 'c9688651-7872-3753-8146-ffa41c177aa1':
-        return f"{id} (Vlad Saveliev - unimelb)"
-    elif id == '590dfb6c-6e4f-3db8-9e23-2d1039821653':
-        return f"{id} (Vlad Saveliev)"
-    elif id == '567d89e4-de8b-3688-a733-d2a979eb510e':
-        return f"{id} (Peter - unimelb)"
-    elif id == 'bd68e368-7587-3e22-a30e-9a2e1714b7c1':
-        return f"{id} (Peter Diakumis)"
-    elif id == '1678890e-b107-3974-a47d-0bb532a64ad6':
-        return f"{id} (Roman Valls - unimelb)"
-    elif id == '9c925fa3-9b93-3f14-92a3-d35488ab1cc4':
-        return f"{id} (Roman Valls)"
-    elif id == '8abf754b-e94f-3841-b44b-75d10d33588b':
-        return f"{id} (Sehrish unimelb)"
-    elif id == 'd24913a8-676f-39f3-9250-7cf22fbc48c8':
-        return f"{id} (Sehrish Kanwal)"
-    elif id == '7eec7332-f780-3edc-bb70-c4f711398f1c':
-        return f"{id} (Florian - unimelb)"
-    elif id == '6039c53c-d362-3dd6-9294-46f08d8994ff':
-        return f"{id} (Florian Reisinger)"
-    elif id == '57a99faa-ae79-33f8-9736-454a36b06a43':
-        return f"{id} (Service User)"
-    elif id == 'ef928f99-662d-3e9f-8476-303131e9a58a':
-        return f"{id} (Karey Cheong)"
-    elif id == 'a46c2704-4568-3a39-b934-45bc9b352ac8':
-        return f"{id} (Voula Dimitriadis)"
-    elif id == '6696900a-96ea-372a-bc00-ca6bbe19bf7b':
-        return f"{id} (Kym Pham)"
-    elif id == '3ed6bc8a-ba5a-3ec3-9e25-361703c7ba20':
-        return f"{id} (Egan Lohman)"
-    elif id == 'b2f0ff65-c77b-37bc-af87-68a89c2f8d27':
-        return f"{id} (Alexis Lucattini)"
-    elif id == '46258763-7c48-3a1c-8c5f-04003bf74e5a':
-        return f"{id} (Alexis - unimelb)"
-    elif id == 'aa9f1c02-3963-3c3b-ad0d-9b6f6e26a405':
-        return f"{id} Pratik Soares (Illumina)"
-    elif id == 'e44e09eb-60c7-3a0f-9313-46f7454ede92':
-        return f"{id} Andrei Seleznev (Illumina)"
-    elif id == 'e3c89a8a-23a7-36cf-a1dc-281d96ed1aab':
-        return f"{id} Yinan Wang (Illumina)"
-    elif id == '41fc4571-741c-386e-be44-cf9ae7313f53':
-        return f"{id} Victor Lin"
-    else:
-        return f"{id} (unknown)"
-
-
-def getWgNameFromId(wid):
-    if wid == 'wid:e4730533-d752-3601-b4b7-8d4d2f6373de':
-        return 'development'
-    elif wid == 'wid:9c481003-f453-3ff2-bffa-ae153b1ee565':
-        return 'collab-illumina-dev'
-    elif wid == 'wid:acddbfda-4980-38ed-99fa-94fe79523959':
-        return 'clinical-genomics-workgroup'
-    elif wid == 'wid:4d2aae8c-41d3-302e-a814-cdc210e4c38b':
-        return 'production'
-    else:
-        return 'unknown'
 
-
-def getSSMParam(name):
-    """
-    Fetch the parameter with the given name from SSM Parameter Store.
-    """
-    return ssm_client.get_parameter(
-                Name=name,
-                WithDecryption=True
-           )['Parameter']['Value']
+def format_bytes(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
 
 
 def call_slack_webhook(sender, topic, attachments):
-    slack_webhook_endpoint = '/services/' + getSSMParam("/slack/webhook/id")
-
-    connection = http.client.HTTPSConnection(slack_host)
-
     post_data = {
         "channel": slack_channel,
         "username": sender,
@@ -118,12 +39,7 @@ def call_slack_webhook(sender, topic, attachments):
     }
     print(f"Slack POST data: {json.dumps(post_data)}")
 
-    connection.request("POST", slack_webhook_endpoint, json.dumps(post_data), headers)
-    response = connection.getresponse()
-    print(f"Slack webhook response: {response}")
-    connection.close()
-
-    return response.status
+    return slack_client.post(post_data)
 
 
 def slack_message_not_supported(sns_record):
@@ -181,12 +97,12 @@ def slack_message_not_supported(sns_record):
                 },
                 {
                     "title": "Task Created By",
-                    "value": getCreatorFromId(iap_created_by),
+                    "value": registry.creator(iap_created_by),
                     "short": True
                 },
                 {
                     "title": "AWS Account",
-                    "value": getAwsAccountName(aws_account),
+                    "value": registry.account_name(aws_account),
                     "short": True
                 }
             ],
@@ -280,12 +196,12 @@ def slack_message_from_wes_runs_historyevents(sns_record):
                 },
                 {
                     "title": "Task Created By",
-                    "value": getCreatorFromId(wes_run_created_by),
+                    "value": registry.creator(wes_run_created_by),
                     "short": True
                 },
                 {
                     "title": "AWS Account",
-                    "value": getAwsAccountName(aws_account),
+                    "value": registry.account_name(aws_account),
                     "short": True
                 }
             ],
@@ -403,12 +319,12 @@ def slack_message_from_tes_runs(sns_record):
                 },
                 {
                     "title": "Task Created By",
-                    "value": getCreatorFromId(task_created_by),
+                    "value": registry.creator(task_created_by),
                     "short": True
                 },
                 {
                     "title": "AWS Account",
-                    "value": getAwsAccountName(aws_account),
+                    "value": registry.account_name(aws_account),
                     "short": True
                 }
             ],
@@ -484,12 +400,12 @@ def slack_message_from_gds_uploaded(sns_record):
                 },
                 {
                     "title": "File Created By",
-                    "value": getCreatorFromId(file_created_by),
+                    "value": registry.creator(file_created_by),
                     "short": True
                 },
                 {
                     "title": "AWS Account",
-                    "value": getAwsAccountName(aws_account),
+                    "value": registry.account_name(aws_account),
                     "short": True
                 }
             ],
@@ -500,6 +416,47 @@ def slack_message_from_gds_uploaded(sns_record):
     return slack_sender, slack_topic, slack_attachment
 
 
+def gds_upload_from_record(sns_record):
+    """
+    :return: (volume name, path, size in bytes) if the record is a GDS file upload, None otherwise
+    """
+    sns_msg_atts = sns_record.get('MessageAttributes')
+    if sns_msg_atts['type']['Value'] != 'gds.files' or sns_msg_atts['action']['Value'] != 'uploaded':
+        return None
+    sns_msg = json.loads(sns_record.get('Message'))
+    return sns_msg['volumeName'], sns_msg['path'], int(sns_msg.get('sizeInBytes') or 0)
+
+
+def slack_attachments_from_gds_windows(windows):
+    slack_attachment = []
+    for window in windows:
+        sample = "\n".join(window['sample_paths'])
+        if window['file_count'] > len(window['sample_paths']):
+            sample += f"\n... and {window['file_count'] - len(window['sample_paths'])} more"
+        slack_attachment.append({
+            "fallback": f"{window['file_count']} files uploaded to gds://{window['volume_name']}{window['folder']}",
+            "color": GREEN,
+            "pretext": f"gds://{window['volume_name']}{window['folder']}",
+            "title": f"{window['file_count']} files uploaded",
+            "text": sample,
+            "fields": [
+                {
+                    "title": "Files",
+                    "value": window['file_count'],
+                    "short": True
+                },
+                {
+                    "title": "Total Size",
+                    "value": format_bytes(window['total_bytes']),
+                    "short": True
+                }
+            ],
+            "footer": "IAP GDS Event",
+            "ts": window['window_start']
+        })
+    return slack_attachment
+
+
 def slack_message_from_bssh_runs(sns_record):
     # TODO: parse ACL, extract workgroup ID and map to workgroup name
     aws_account = sns_record.get('TopicArn').split(':')[4]
@@ -524,7 +481,7 @@ def slack_message_from_bssh_runs(sns_record):
 
     acl = sns_msg['acl']
     if len(acl) == 1:
-        owner = getWgNameFromId(acl[0])
+        owner = registry.workgroup_name(acl[0])
     else:
         print("Multiple IDs in ACL, expected 1!")
         owner = 'undetermined'
@@ -553,7 +510,7 @@ def slack_message_from_bssh_runs(sns_record):
         slack_color = RED
     else:
         print(f"Unsupported status {status}. Not reporting to Slack!")
-        sys.exit(0)
+        return None
 
     slack_sender = "Illumina Application Platform"
     slack_topic = f"Notification from {stratus_action_type}"
@@ -612,7 +569,7 @@ def slack_message_from_bssh_runs(sns_record):
                 },
                 {
                     "title": "AWS Account",
-                    "value": getAwsAccountName(aws_account),
+                    "value": registry.account_name(aws_account),
                     "short": True
                 }
             ],
@@ -623,6 +580,68 @@ def slack_message_from_bssh_runs(sns_record):
     return slack_sender, slack_topic, slack_attachment
 
 
+# IAP message type -> function returning (sender, topic, attachments) for the SNS record,
+# or None if the record should not be reported
+MESSAGE_HANDLERS = {
+    'gds.files': slack_message_from_gds_uploaded,
+    'tes.runs': slack_message_from_tes_runs,
+    'bssh.runs': slack_message_from_bssh_runs,
+    'wes.runs': slack_message_from_wes_runs,
+    'wes.runs.historyevents': slack_message_from_wes_runs_historyevents
+}
+
+
+def get_sns_record(record):
+    """
+    Extract the SNS notification of a record, delivered either by SNS directly or via an SQS queue subscribed to the
+    SNS topic (without raw message delivery, the SQS message body then is the SNS notification).
+    :return: the SNS notification (TopicArn, Timestamp, Message, MessageAttributes)
+    """
+    if record.get('EventSource') == 'aws:sns' and record.get('Sns'):
+        return record.get('Sns')
+    if record.get('eventSource') == 'aws:sqs' and record.get('body'):
+        sns_record = json.loads(record.get('body'))
+        if sns_record.get('Type') == 'Notification':
+            return sns_record
+    raise ValueError("Unexpected Message Format!")
+
+
+def slack_message_from_record(sns_record):
+    message_type = sns_record['MessageAttributes']['type']['Value']
+    handler = MESSAGE_HANDLERS.get(message_type, slack_message_not_supported)
+    return handler(sns_record)
+
+
+def post_attachments(slack_sender, slack_topic, items):
+    """
+    Send the attachments of the items to Slack, in as few messages as possible (the attachments of an item are
+    always sent in the same message).
+    :param items: list of (item, attachments), e.g. the record ID and the attachments of the record
+    :return: the number of messages sent and the items of the messages that could not be sent
+    """
+    chunks = []  # (items, attachments) per message
+    for item, attachments in items:
+        if not chunks or len(chunks[-1][1]) + len(attachments) > MAX_ATTACHMENTS:
+            chunks.append(([], []))
+        chunks[-1][0].append(item)
+        chunks[-1][1].extend(attachments)
+
+    posts = 0
+    failed_items = []
+    for chunk_items, chunk_attachments in chunks:
+        print(f"Slack sender: ({slack_sender}), topic: ({slack_topic}) and {len(chunk_attachments)} attachments")
+        try:
+            response = call_slack_webhook(slack_sender, slack_topic, chunk_attachments)
+            print(f"Response status: {response}")
+            if response != 200:
+                raise ValueError(f"Unexpected response status {response}")
+            posts += 1
+        except Exception as e:
+            print(f"Error sending message to Slack: {e}")
+            failed_items.extend(chunk_items)
+    return posts, failed_items
+
+
 def lambda_handler(event, context):
     # Log the received event in CloudWatch
     print(f"Received event: {json.dumps(event)}")
@@ -632,42 +651,81 @@ def lambda_handler(event, context):
     print(f"RequestId: {context.aws_request_id}")
     print(f"FunctionName: {context.function_name}")
 
-    # we expect events of a defined format
-    records = event.get('Records')
-    if len(records) == 1:
-        record = records[0]
-        if record.get('EventSource') == 'aws:sns' and record.get('Sns'):
-            sns_record = record.get('Sns')
-
-            if sns_record.get('MessageAttributes'):
-                if sns_record['MessageAttributes']['type']['Value'] == 'gds.files':
-                    slack_sender, slack_topic, slack_attachment = slack_message_from_gds_uploaded(sns_record)
-                elif sns_record['MessageAttributes']['type']['Value'] == 'tes.runs':
-                    slack_sender, slack_topic, slack_attachment = slack_message_from_tes_runs(sns_record)
-                elif sns_record['MessageAttributes']['type']['Value'] == 'bssh.runs':
-                    slack_sender, slack_topic, slack_attachment = slack_message_from_bssh_runs(sns_record)
-                elif sns_record['MessageAttributes']['type']['Value'] == 'wes.runs':
-                    slack_sender, slack_topic, slack_attachment = slack_message_from_wes_runs(sns_record)
-                elif sns_record['MessageAttributes']['type']['Value'] == 'wes.runs.historyevents':
-                    slack_sender, slack_topic, slack_attachment = slack_message_from_wes_runs_historyevents(sns_record)
-                else:
-                    slack_sender, slack_topic, slack_attachment = slack_message_not_supported(sns_record)
-        else:
-            raise ValueError("Unexpected Message Format!")
+    # we expect events of a defined format: one SNS record, or a batch of SQS records wrapping SNS notifications,
+    # or the scheduled event to report the due GDS upload summaries
+    if event.get('source') == 'aws.events':
+        records = []
     else:
-        raise ValueError("Unexpected Message Format!")
-
-    # Forward the data to Slack
-    try:
-        print(f"Slack sender: ({slack_sender}), topic: ({slack_topic}) and attachments: {json.dumps(slack_attachment)}")
+        records = event.get('Records')
+        if not records:
+            raise ValueError("Unexpected Message Format!")
+    from_sqs = bool(records) and records[0].get('eventSource') == 'aws:sqs'
+
+    # (sender, topic) -> (record ID, attachments) of the records, in order of arrival
+    messages = dict()
+    gds_record_ids = []
+    failed_records = []
+    posts = 0
+    for i, record in enumerate(records):
+        record_id = record.get('messageId', str(i))
+        try:
+            sns_record = get_sns_record(record)
+            if not sns_record.get('MessageAttributes'):
+                raise ValueError("Unexpected Message Format!")
+            gds_upload = gds_upload_from_record(sns_record) if gds_aggregator else None
+            if gds_upload:
+                gds_aggregator.add(*gds_upload, record_id=record_id)
+                gds_record_ids.append(record_id)
+                continue
+            slack_message = slack_message_from_record(sns_record)
+        except Exception as e:
+            print(f"Could not process record {record_id}: {e}")
+            failed_records.append(record_id)
+            continue
         # if we couldn't assign any sensible value, there is no point in sending a slack message
-        if slack_sender or slack_topic or slack_attachment:
-            response = call_slack_webhook(slack_sender, slack_topic, slack_attachment)
-            print(f"Response status: {response}")
-        else:
-            ValueError("Could not extract sensible values from event! Not sending Slack message.")
-    except Exception as e:
-        print(e)
+        if not slack_message or not any(slack_message):
+            print(f"Could not extract sensible values from record {record_id}! Not sending Slack message.")
+            continue
+        slack_sender, slack_topic, slack_attachment = slack_message
+        messages.setdefault((slack_sender, slack_topic), []).append(
+            (record_id, slack_attachment if slack_attachment else []))
+
+    # Forward the data to Slack, one message per sender/topic (i.e. per IAP message type)
+    # only the records of messages that could not be sent are failed, the others must not be delivered again
+    for (slack_sender, slack_topic), items in messages.items():
+        sent, failed_record_ids = post_attachments(slack_sender, slack_topic, items)
+        posts += sent
+        failed_records.extend(failed_record_ids)
+
+    # Report the GDS uploads of the windows that have been open long enough
+    # a store error must not fail the other records of the batch, their messages have already been sent
+    if gds_aggregator:
+        try:
+            failed_records.extend(gds_aggregator.commit())
+        except Exception as e:
+            print(f"Could not store the GDS uploads: {e}")
+            failed_records.extend(gds_record_ids)
+        try:
+            windows = gds_aggregator.claim_due()
+        except Exception as e:
+            print(f"Could not claim the due GDS upload summaries, leaving them for the next attempt: {e}")
+            windows = []
+        if windows:
+            sent, failed_windows = post_attachments(
+                "Illumina Application Platform", "Notification from gds.files",
+                [(window, slack_attachments_from_gds_windows([window])) for window in windows])
+            posts += sent
+            if failed_windows:
+                print(f"Keeping {len(failed_windows)} GDS upload summaries for the next attempt")
+                try:
+                    gds_aggregator.restore(failed_windows)
+                except Exception as e:
+                    print(f"Could not restore {len(failed_windows)} GDS upload summaries, they are lost: {e}")
+
+    print(f"Processed {len(records)} records in {posts} Slack messages, {len(failed_records)} failed")
+    if from_sqs:
+        # only the failed messages are returned to the queue (requires ReportBatchItemFailures)
+        return {'batchItemFailures': [{'itemIdentifier': record_id} for record_id in failed_records]}
+    if failed_records:
         raise ValueError('Error sending message to Slack')
-
     return event
@@ -1,9 +1,12 @@
-from aws_cdk import Stack
+from aws_cdk import Stack, Duration
 from aws_cdk import (
     aws_lambda as _lambda,
+    aws_lambda_event_sources as _lambda_event_sources,
     aws_iam as _iam,
     aws_sns as _sns,
     aws_sns_subscriptions as _sns_subs,
+    aws_sqs as _sqs,
+    aws_dynamodb as _dynamodb,
     aws_events as _events,
     aws_events_targets as _events_targets
 )
@@ -14,6 +17,10 @@ class IapLambdaStack(Stack):
     """ TODO DEPRECATED STACK """
 
     illumina_iap_account = '079623148045'
+    lambda_timeout = 30  # seconds
+    batch_size = 100  # notifications per invocation
+    max_batching_window = 20  # seconds to wait for a batch to fill up
+    gds_aggregation_window = 300  # seconds GDS uploads are summarised over
 
     def __init__(self, scope: Construct, id: str, slack_channel: str, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
@@ -28,18 +35,39 @@ class IapLambdaStack(Stack):
             ]
         )
 
+        # GDS uploads are counted per folder in this table and reported as summaries
+        gds_aggregation_table = _dynamodb.Table(
+            self,
+            'IapGdsAggregationTable',
+            partition_key=_dynamodb.Attribute(name='window_key', type=_dynamodb.AttributeType.STRING),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute='expires'
+        )
+
         function = _lambda.Function(
             self,
             'IapSlackLambda',
             handler='notify_slack.lambda_handler',
             runtime=_lambda.Runtime.PYTHON_3_11,
             code=_lambda.Code.from_asset('lambdas/iap'),
+            timeout=Duration.seconds(self.lambda_timeout),
             environment={
                 "SLACK_HOST": "hooks.slack.com",
-                "SLACK_CHANNEL": slack_channel
+                "SLACK_CHANNEL": slack_channel,
+                "GDS_AGGREGATION_TABLE": gds_aggregation_table.table_name,
+                "GDS_AGGREGATION_WINDOW": str(self.gds_aggregation_window)
             },
             role=lambda_role
         )
+        gds_aggregation_table.grant_read_write_data(function)
+
+        # Report the GDS upload summaries that are due, even if no further notifications arrive
+        _events.Rule(
+            self,
+            'IapGdsAggregationSchedule',
+            schedule=_events.Schedule.rate(Duration.minutes(1)),
+            targets=[_events_targets.LambdaFunction(handler=function)]
+        )
 
         sns_topic = _sns.Topic(
             self,
@@ -48,7 +76,27 @@ class IapLambdaStack(Stack):
             topic_name='IapSnsTopic'
         )
         sns_topic.grant_publish(_iam.AccountPrincipal(self.illumina_iap_account))
-        sns_topic.add_subscription(_sns_subs.LambdaSubscription(function))
+
+        # Buffer the notifications in a queue, so bursts of events (e.g. GDS uploads) are reported in batches
+        # instead of one Lambda invocation and Slack message each
+        dead_letter_queue = _sqs.Queue(
+            self,
+            'IapSlackDeadLetterQueue',
+            retention_period=Duration.days(14)
+        )
+        queue = _sqs.Queue(
+            self,
+            'IapSlackQueue',
+            visibility_timeout=Duration.seconds(6 * self.lambda_timeout),
+            dead_letter_queue=_sqs.DeadLetterQueue(max_receive_count=3, queue=dead_letter_queue)
+        )
+        sns_topic.add_subscription(_sns_subs.SqsSubscription(queue))
+        function.add_event_source(_lambda_event_sources.SqsEventSource(
+            queue,
+            batch_size=self.batch_size,
+            max_batching_window=Duration.seconds(self.max_batching_window),
+            report_batch_item_failures=True
+        ))
 
 
 class BatchLambdaStack(Stack):
@@ -1,7 +1,8 @@
 import os
 import json
 import boto3
-import http.client
+from identity_registry import registry
+from slack_client import SlackClient
 from dateutil.parser import parse
 
 slack_host = os.environ.get('SLACK_HOST')
@@ -15,42 +16,11 @@ BLUE = '#439FE0'
 GRAY = '#dddddd'
 BLACK = '#000000'
 
-ssm_client = boto3.client('ssm')
 ecr_client = boto3.client('ecr')
-
-headers = {
-    'Content-Type': 'application/json',
-}
-
-
-def getAwsAccountName(id):
-    if id == '472057503814':
-        return 'prod'
-    elif id == '843407916570':
-        return 'dev (new)'
-    elif id == '620123204273':
-        return 'dev (old)'
-    elif id == '602836945884':
-        return 'agha'
-    else:
-        return id
-
-
-def getSSMParam(name):
-    """
-    Fetch the parameter with the given name from SSM Parameter Store.
-    """
-    return ssm_client.get_parameter(
-                Name=name,
-                WithDecryption=True
-           )['Parameter']['Value']
+slack_client = SlackClient(slack_host, webhook_parameter="/slack/webhook/id")
 
 
 def call_slack_webhook(sender, topic, attachments):
-    slack_webhook_endpoint = '/services/' + getSSMParam("/slack/webhook/id")
-
-    connection = http.client.HTTPSConnection(slack_host)
-
     post_data = {
         "channel": slack_channel,
         "username": sender,
@@ -60,11 +30,7 @@ def call_slack_webhook(sender, topic, attachments):
     }
     print(f"Slack POST data: {json.dumps(post_data)}")
 
-    connection.request("POST", slack_webhook_endpoint, json.dumps(post_data), headers)
-    response = connection.getresponse()
-    connection.close()
-
-    return response.status
+    return slack_client.post(post_data)
 
 
 def get_image_tag(commit_id):
@@ -152,7 +118,7 @@ def slack_message_from_codebuild(message):
                 },
                 {
                     "title": "AWS Account",
-                    "value": getAwsAccountName(message_account),
+                    "value": registry.account_name(message_account),
                     "short": True
                 }
             ],
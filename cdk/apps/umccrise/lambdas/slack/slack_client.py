@@ -0,0 +1,114 @@
+import json
+import time
+import http.client
+import boto3
+
+################################################################################
+# Slack webhook client of the Slack notifiers
+#
+# Kept at module level by the notifier Lambdas, so a warm container reuses the webhook endpoint (read from SSM and
+# cached for WEBHOOK_TTL seconds) and the keep-alive HTTPS connection to Slack: a message costs a single POST instead
+# of an SSM call, a TLS handshake and a POST. A kept-alive connection closed by Slack before it got the request (e.g.
+# idle timed out) is replaced and the POST retried once, other errors are not retried as Slack may already have
+# accepted the message; a rejected webhook (rotated secret) causes the endpoint to be read again and the POST retried
+# once.
+# NOTE: the same module is deployed with each Slack notifier Lambda:
+#       cdk/apps/slack/lambdas/iap, cdk/apps/slack/lambdas/batch, cdk/apps/umccrise/lambdas/slack,
+#       terraform/stacks/bastion/lambdas, terraform/stacks/bootstrap/lambdas and
+#       terraform/stacks/agha_infra/lambdas/notify_slack, keep the copies in sync.
+
+WEBHOOK_TTL = 900  # seconds
+TIMEOUT = 10  # seconds
+REJECTED_WEBHOOK_STATUSES = (403, 404, 410)
+
+headers = {
+    'Content-Type': 'application/json',
+}
+
+
+class SlackClient:
+
+    def __init__(self, host, webhook_endpoint=None, webhook_parameter=None, ttl=WEBHOOK_TTL, timeout=TIMEOUT,
+                 ssm_client=None):
+        """
+        :param host: the Slack host, e.g. hooks.slack.com
+        :param webhook_endpoint: the webhook path, e.g. /services/<ID>
+        :param webhook_parameter: alternatively the name of the SSM parameter with the webhook ID
+        """
+        if not (webhook_endpoint or webhook_parameter):
+            raise ValueError("Either a webhook endpoint or the SSM parameter of the webhook ID is required!")
+        self.host = host
+        self.webhook_parameter = webhook_parameter
+        self.ttl = ttl
+        self.timeout = timeout
+        self._ssm_client = ssm_client
+        self._endpoint = webhook_endpoint
+        self._endpoint_expires = None if webhook_endpoint else 0
+        self._connection = None
+
+    def webhook_endpoint(self, refresh=False):
+        if self._endpoint_expires is None:
+            return self._endpoint
+        now = time.monotonic()
+        if refresh or not self._endpoint or now >= self._endpoint_expires:
+            start = time.perf_counter()
+            if self._ssm_client is None:
+                self._ssm_client = boto3.client('ssm')
+            webhook_id = self._ssm_client.get_parameter(
+                Name=self.webhook_parameter,
+                WithDecryption=True
+            )['Parameter']['Value']
+            self._endpoint = '/services/' + webhook_id
+            self._endpoint_expires = now + self.ttl
+            print(f"Loaded Slack webhook from {self.webhook_parameter} in {(time.perf_counter() - start) * 1000:.1f}ms")
+        return self._endpoint
+
+    def _post(self, body):
+        endpoint = self.webhook_endpoint()
+        reused = self._connection is not None
+        if not reused:
+            self._connection = http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        sent = False
+        try:
+            self._connection.request("POST", endpoint, body, headers)
+            sent = True
+            response = self._connection.getresponse()
+            # the response has to be read completely before the connection can be reused
+            response.read()
+        except (http.client.HTTPException, OSError) as error:
+            self.close()
+            # the request never reached Slack if the connection was already closed when writing it, or Slack closed
+            # it without any response; anything else (e.g. a read timeout) could mean the message was posted
+            if sent:
+                never_sent = isinstance(error, http.client.RemoteDisconnected)
+            else:
+                never_sent = isinstance(error, (BrokenPipeError, ConnectionResetError))
+            if not reused or not never_sent:
+                raise
+            print("Slack connection was closed, reconnecting")
+            return self._post(body)
+        if response.getheader('Connection', '').lower() == 'close':
+            self.close()
+        return response, reused
+
+    def post(self, post_data):
+        """
+        POST a message to the webhook.
+        :param post_data: the message payload
+        :return: the HTTP status of the response
+        """
+        start = time.perf_counter()
+        body = json.dumps(post_data)
+        response, reused = self._post(body)
+        if response.status in REJECTED_WEBHOOK_STATUSES and self._endpoint_expires is not None:
+            print(f"Slack webhook rejected ({response.status}), reloading it from {self.webhook_parameter}")
+            self.webhook_endpoint(refresh=True)
+            response, reused = self._post(body)
+        print(f"Slack webhook response: {response.status} {response.reason} in " +
+              f"{(time.perf_counter() - start) * 1000:.1f}ms ({'reused' if reused else 'new'} connection)")
+        return response.status
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,373 @@
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+from array import array
+
+try:
+    import ijson  # optional: stream Stats.json instead of loading it as a whole
+except ImportError:
+    ijson = None
+
+################################################################################
+# bcl2fastq Stats.json parsing and merging (used by update-stats-sheet.py)
+#
+# Only the run header and the ConversionResults are read (with ijson one lane at a time, skipping the large
+# UnknownBarcodes/ReadInfosForLanes sections). Per lane counters are kept in arrays indexed by lane, per sample
+# reads/bases in one array per sample (-1 marks a sample that is not in a lane).
+
+GENOME_SIZE = 3200000000
+LANES = [1, 2, 3, 4]
+HEADER_KEYS = ('Flowcell', 'RunNumber', 'RunId')
+NOT_IN_LANE = -1
+
+
+def read_stats_json(stats_file):
+    """
+    :param stats_file: path to a bcl2fastq Stats.json
+    :return: tuple of (header dict with Flowcell/RunNumber/RunId, iterable of ConversionResults lane records)
+    """
+    if ijson is None:
+        with open(stats_file) as fp:
+            data = json.load(fp)
+        return {key: data[key] for key in HEADER_KEYS}, data['ConversionResults']
+
+    header = dict()
+    with open(stats_file, 'rb') as fp:
+        # the header values precede the per lane results, so stop as soon as they are found
+        for prefix, event, value in ijson.parse(fp):
+            if prefix in HEADER_KEYS and event in ('string', 'number'):
+                header[prefix] = value
+                if len(header) == len(HEADER_KEYS):
+                    break
+
+    def conversion_results():
+        with open(stats_file, 'rb') as fp:
+            for lane_stat in ijson.items(fp, 'ConversionResults.item'):
+                yield lane_stat
+
+    return header, conversion_results()
+
+
+def _lane_counter():
+    return array('q', [0] * len(LANES))
+
+
+class Bcl2fastqStats:
+
+    separator = "\t"
+
+    def __init__(self, stats_file):
+        self.stats_file_name = stats_file
+        header, conversion_stats = read_stats_json(stats_file)
+
+        self.flowcell = header[u'Flowcell']  # str
+        self.run_number = header[u'RunNumber']  # int
+        self.run_id = header[u'RunId']
+        self.samples_in_lanes = {}
+
+        # conversion results
+        self.total_reads_PF = 0
+        self.total_bases_PF = 0
+        self.reads_raw = _lane_counter()
+        self.reads_PF = _lane_counter()
+        self.bases_PF = _lane_counter()
+        self.reads_undetermined = _lane_counter()
+        self.bases_undetermined = _lane_counter()
+        self.reads_demuxed = _lane_counter()
+        self.bases_demuxed = _lane_counter()
+        self.sample_reads = {}  # (sample ID, sample name) -> reads per lane
+        self.sample_bases = {}  # (sample ID, sample name) -> bases per lane
+
+        for lane_stat in conversion_stats:
+            lane = lane_stat[u'LaneNumber'] - 1
+            self.reads_raw[lane] = lane_stat[u'TotalClustersRaw']
+            self.reads_PF[lane] = lane_stat[u'TotalClustersPF']
+            self.bases_PF[lane] = lane_stat[u'Yield']
+            self.reads_undetermined[lane] = lane_stat[u'Undetermined'][u'NumberReads']
+            self.bases_undetermined[lane] = lane_stat[u'Undetermined'][u'Yield']
+
+            self.total_reads_PF += self.reads_PF[lane]
+            self.total_bases_PF += self.bases_PF[lane]
+
+            for sample_stat in lane_stat[u'DemuxResults']:
+                sample = (sample_stat[u'SampleId'], sample_stat[u'SampleName'])
+                self._sample_counters(sample)
+                self.sample_reads[sample][lane] = sample_stat[u'NumberReads']
+                self.sample_bases[sample][lane] = sample_stat[u'Yield']
+                self.reads_demuxed[lane] += sample_stat[u'NumberReads']
+                self.bases_demuxed[lane] += sample_stat[u'Yield']
+
+                if self.samples_in_lanes.get(sample) is None:
+                    self.samples_in_lanes[sample] = [0] * len(LANES)
+                self.samples_in_lanes[sample][lane] = 1
+
+    def _sample_counters(self, sample):
+        if sample not in self.sample_reads:
+            self.sample_reads[sample] = array('q', [NOT_IN_LANE] * len(LANES))
+            self.sample_bases[sample] = array('q', [NOT_IN_LANE] * len(LANES))
+
+    def _sample_lane_stats(self, sample, lane):
+        # (reads, bases) of the sample in the lane, None if the sample is not in the lane
+        reads = self.sample_reads.get(sample)
+        if reads is None or reads[lane] == NOT_IN_LANE:
+            return None
+        return reads[lane], self.sample_bases[sample][lane]
+
+    def get_total_bases_undetermined(self):
+        return sum(self.bases_undetermined)
+
+    def merge(self, other):
+        if self.run_id != other.run_id:
+            return False
+
+        # check other metrics
+        for lane in range(len(LANES)):
+            if other.reads_PF[lane] == 0:
+                continue
+
+            if other.reads_PF[lane] != self.reads_PF[lane]:
+                raise Exception(f"Read PF are not the same - Lane {lane + 1}. \
+                                  Reads 'self' = {self.reads_PF[lane]}, \
+                                  'other' = {other.reads_PF[lane]}")
+            if self.bases_PF[lane] != other.bases_PF[lane]:
+                raise Exception(f"[{self.run_id}] Base accounting failed - \
+                                    {self.bases_PF[lane]} vs \
+                                    {other.bases_PF[lane]}")
+
+            undetermined_self = self.reads_undetermined[lane] - other.reads_demuxed[lane]
+            undetermined_other = other.reads_undetermined[lane] - self.reads_demuxed[lane]
+            if undetermined_self != undetermined_other:
+                raise Exception(f"Mismatch of undetermined reads after matching up demultiplexed reads - \
+                                 Lane {lane + 1}")
+
+            # update the undetermined reads
+            self.reads_undetermined[lane] = undetermined_self
+            self.bases_undetermined[lane] -= other.bases_demuxed[lane]
+
+            # update the demultiplexed reads
+            self.reads_demuxed[lane] += other.reads_demuxed[lane]
+            self.bases_demuxed[lane] += other.bases_demuxed[lane]
+
+            # add samples in 'other' into 'self'
+            for sample in other.sample_reads:
+                sample_stats = other._sample_lane_stats(sample, lane)
+                if sample_stats is None:
+                    continue
+                self._sample_counters(sample)
+                if self.sample_reads[sample][lane] == NOT_IN_LANE:
+                    self.sample_reads[sample][lane] = 0
+                    self.sample_bases[sample][lane] = 0
+                self.sample_reads[sample][lane] += sample_stats[0]
+                self.sample_bases[sample][lane] += sample_stats[1]
+
+        for sample, membership in other.samples_in_lanes.items():
+            self.samples_in_lanes[sample] = membership
+
+        return True
+
+    def __hash__(self):
+        return hash(self.run_id)
+
+    def _lanes(self):
+        # lane indexes in lane number order
+        return range(len(LANES))
+
+    def prepare_output(self):
+        all_sample_names = sorted(
+            self.samples_in_lanes.items(), key=lambda kv: kv[1], reverse=True)
+
+        total_genome_equivalent = 0
+        output = []
+        for sample, sample_lane_membership in all_sample_names:
+            sample_id, sample_name = sample
+            row = [self.run_id, sample_id, sample_name]
+            total_sample_reads = 0
+            total_sample_bases = 0
+            for lane in self._lanes():
+                sample_stats = self._sample_lane_stats(sample, lane)
+                if sample_stats is not None:
+                    row += ['{:,}'.format(sample_stats[0]), '{:.2%}'.format(
+                        sample_stats[0]/float(self.reads_PF[lane]))]
+                    total_sample_reads += sample_stats[0]
+                    total_sample_bases += sample_stats[1]
+                else:
+                    row += ['.', '.']
+
+            genome_equivalent = total_sample_bases/float(GENOME_SIZE)
+            total_genome_equivalent += genome_equivalent
+            row += ['{:,}'.format(total_sample_reads), '{:.2%}'.format(
+                total_sample_reads/float(self.total_reads_PF))]
+            row += ['{:.2f}'.format(genome_equivalent)]
+            row_str = self.separator.join([str(v) for v in row])
+            output.append(row_str)
+
+        total_undetermined = 0
+        total_PF = 0
+        row = [self.run_id, 'Undetermined', 'Undetermined']
+        total = [self.run_id, '.', 'TOTAL']
+        for lane in self._lanes():
+            if self.reads_PF[lane] == 0:
+                row += ['.', '.']
+                total += ['.', '.']
+            else:
+                row += ['{:,}'.format(self.reads_undetermined[lane]), '{:.2%}'.format(
+                    self.reads_undetermined[lane]/float(self.reads_PF[lane]))]
+                total_undetermined += self.reads_undetermined[lane]
+                total_PF += self.reads_PF[lane]
+                total += ['{:,}'.format(self.reads_PF[lane]), '{:.2%}'.format(
+                    self.reads_PF[lane]/float(self.total_reads_PF))]
+
+        genome_equivalent = self.get_total_bases_undetermined()/float(GENOME_SIZE)
+        total_genome_equivalent += genome_equivalent
+        row += ['{:,}'.format(total_undetermined),
+                '{:.2%}'.format(total_undetermined/float(total_PF))]
+        row += ['{:.2f}'.format(genome_equivalent)]
+        row_str = self.separator.join([str(v) for v in row])
+        total += ['{:,}'.format(total_PF),
+                  '{:.2%}'.format(total_PF/float(self.total_reads_PF))]
+        total += ['{:.2f}'.format(total_genome_equivalent)]
+        total_str = self.separator.join([str(v) for v in total])
+
+        output.append(row_str)
+        output.append(total_str)
+
+        return output
+
+    def __str__(self):
+        output = self.prepare_output()
+        return '\n'.join(output)
+
+    def prepare_rows(self):
+        all_sample_names = sorted(
+            self.samples_in_lanes.items(), key=lambda kv: kv[1], reverse=True)
+
+        total_genome_equivalent = 0
+        output = []
+        for sample, sample_lane_membership in all_sample_names:
+            sample_id, sample_name = sample
+            row = [self.run_id, sample_id, sample_name]
+            total_sample_reads = 0
+            total_sample_bases = 0
+            for lane in self._lanes():
+                sample_stats = self._sample_lane_stats(sample, lane)
+                if sample_stats is not None:
+                    row.append(sample_stats[0])
+                    row.append(sample_stats[0]/float(self.reads_PF[lane]))
+                    total_sample_reads += sample_stats[0]
+                    total_sample_bases += sample_stats[1]
+                else:
+                    row.append(0)
+                    row.append(0)
+
+            genome_equivalent = total_sample_bases/float(GENOME_SIZE)
+            total_genome_equivalent += genome_equivalent
+            row.append(total_sample_reads)
+            row.append(total_sample_reads/float(self.total_reads_PF))
+            row.append(genome_equivalent)
+            output.append(row)
+
+        total_undetermined = 0
+        total_PF = 0
+        undet_row = [self.run_id, 'Undetermined', 'Undetermined']
+        total_row = [self.run_id, '.', 'TOTAL']
+        for lane in self._lanes():
+            if self.reads_PF[lane] == 0:
+                undet_row.append(0)
+                undet_row.append(0)
+                total_row.append(0)
+                total_row.append(0)
+            else:
+                undet = self.reads_undetermined[lane]
+                undet_row.append(undet)
+                undet_row.append(undet/float(self.reads_PF[lane]))
+                total_undetermined += self.reads_undetermined[lane]
+                total_PF += self.reads_PF[lane]
+                total_row.append(self.reads_PF[lane])
+                total_row.append(self.reads_PF[lane]/float(self.total_reads_PF))
+
+        genome_equivalent = self.get_total_bases_undetermined()/float(GENOME_SIZE)
+        total_genome_equivalent += genome_equivalent
+        undet_row.append(total_undetermined)
+        undet_row.append(total_undetermined/float(total_PF))
+        undet_row.append(genome_equivalent)
+        output.append(undet_row)
+
+        total_row.append(total_PF)
+        total_row.append(total_PF/float(self.total_reads_PF))
+        total_row.append(total_genome_equivalent)
+        output.append(total_row)
+
+        return output
+
+
+def merge_stats(stats_files):
+    """
+    Parse and merge the Stats.json files of (split) bcl2fastq runs.
+    :param stats_files: paths to Stats.json files
+    :return: list of merged Bcl2fastqStats, one per run, in the order the runs were first seen
+    """
+    stats_by_run = dict()
+    for stats_file in stats_files:
+        stats = Bcl2fastqStats(stats_file)
+        if stats.run_id in stats_by_run:
+            stats_by_run[stats.run_id].merge(stats)
+        else:
+            stats_by_run[stats.run_id] = stats
+    return list(stats_by_run.values())
+
+
+################################################################################
+# Benchmark: python bcl2fastq_stats.py [samples] [split files]
+
+def write_synthetic_stats(out_dir, samples=1500, splits=3, run_id='200101_A00130_0001_AHXXXXXXXX', seed=42):
+    # Stats.json files of a 4 lane run, with the samples split over several bcl2fastq runs
+    rnd = random.Random(seed)
+    sample_lanes = [(f"PRJ{i:06d}_L{i:07d}", f"L{i:07d}", [lane for lane in LANES if rnd.random() < 0.5] or [1])
+                    for i in range(samples)]
+    sample_reads = {(sample_id, lane): rnd.randint(1000, 1000000)
+                    for sample_id, _, lanes in sample_lanes for lane in lanes}
+    lane_demuxed = {lane: sum(reads for (_, l), reads in sample_reads.items() if l == lane) for lane in LANES}
+    reads_PF = {lane: lane_demuxed[lane] + 5000000 for lane in LANES}
+
+    stats_files = []
+    for split in range(splits):
+        split_samples = sample_lanes[split::splits]
+        conversion_results = []
+        for lane in LANES:
+            demux = [{'SampleId': sample_id, 'SampleName': sample_name,
+                      'NumberReads': sample_reads[(sample_id, lane)], 'Yield': sample_reads[(sample_id, lane)] * 300,
+                      'IndexMetrics': [], 'ReadMetrics': []}
+                     for sample_id, sample_name, lanes in split_samples if lane in lanes]
+            split_demuxed = sum(sample['NumberReads'] for sample in demux)
+            undetermined = reads_PF[lane] - split_demuxed
+            conversion_results.append({'LaneNumber': lane, 'TotalClustersRaw': reads_PF[lane] * 2,
+                                       'TotalClustersPF': reads_PF[lane], 'Yield': reads_PF[lane] * 300,
+                                       'DemuxResults': demux,
+                                       'Undetermined': {'NumberReads': undetermined, 'Yield': undetermined * 300}})
+        unknown_barcodes = [{'Lane': lane, 'Barcodes': {f"{rnd.getrandbits(32):08X}": rnd.randint(1, 9999)
+                                                        for _ in range(1000)}} for lane in LANES]
+        stats_file = os.path.join(out_dir, f"Stats.{split}.json")
+        with open(stats_file, 'w') as fp:
+            json.dump({'Flowcell': run_id[-9:], 'RunNumber': 1, 'RunId': run_id,
+                       'ConversionResults': conversion_results, 'UnknownBarcodes': unknown_barcodes}, fp)
+        stats_files.append(stats_file)
+    return stats_files
+
+
+def benchmark(samples=1500, splits=3):
+    with tempfile.TemporaryDirectory() as out_dir:
+        stats_files = write_synthetic_stats(out_dir, samples=samples, splits=splits)
+        size = sum(os.path.getsize(stats_file) for stats_file in stats_files)
+        start = time.perf_counter()
+        all_stats = merge_stats(stats_files)
+        duration = time.perf_counter() - start
+        rows = sum(len(stats.prepare_rows()) for stats in all_stats)
+    print(f"{samples} samples in {splits} Stats.json files ({size / 1e6:.1f} MB, " +
+          f"{'ijson' if ijson else 'json'}): parsed and merged in {duration:.3f}s, {rows} rows")
+
+
+if __name__ == "__main__":
+    benchmark(*[int(arg) for arg in sys.argv[1:3]])
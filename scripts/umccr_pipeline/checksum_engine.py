@@ -0,0 +1,289 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import xxhash  # optional: xxh64 checksums
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3  # optional: BLAKE3 checksums
+except ImportError:
+    blake3 = None
+
+################################################################################
+# Parallel checksum creation for runfolders and bcl2fastq output (used by create-checksums.py)
+#
+# Files are hashed in a process pool with large buffered reads, every requested algorithm is computed in the same
+# pass over a file. Digests are kept in a manifest keyed by relative path, size and modification time, so re-runs only
+# hash new or changed files. The checksum files use the md5sum/xxh64sum/b3sum output format ("<digest>  ./<path>").
+
+BUFFER_SIZE = 8 * 1024 * 1024  # bytes per read
+MAX_DEFAULT_PROCESSES = 8  # beyond that the (network) storage rather than the CPUs is the limit
+MANIFEST_SAVE_INTERVAL = 60  # seconds between manifest updates while hashing
+SIDECAR_SUFFIX = '.md5'
+
+# algorithm -> name of the equivalent command line tool (used for the checksum file names)
+HASH_COMMANDS = {
+    'md5': 'md5sum',
+    'xxh64': 'xxh64sum',
+    'blake3': 'b3sum'
+}
+
+
+def available_algorithms():
+    algorithms = ['md5']
+    if xxhash:
+        algorithms.append('xxh64')
+    if blake3:
+        algorithms.append('blake3')
+    return algorithms
+
+
+def _new_hash(algorithm):
+    if algorithm == 'md5':
+        return hashlib.md5()
+    if algorithm == 'xxh64' and xxhash:
+        return xxhash.xxh64()
+    if algorithm == 'blake3' and blake3:
+        return blake3.blake3()
+    raise ValueError(f"Hash algorithm {algorithm} is not available (available: {available_algorithms()})")
+
+
+def hash_file(path, algorithms=('md5',), buffer_size=BUFFER_SIZE):
+    """
+    :param path: the file to hash
+    :param algorithms: the hash algorithms to compute (in one pass over the file)
+    :param buffer_size: the number of bytes read at once
+    :return: dict of algorithm to hex digest
+    """
+    hashes = [(algorithm, _new_hash(algorithm)) for algorithm in algorithms]
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as fp:
+        while True:
+            size = fp.readinto(buffer)
+            if not size:
+                break
+            for _, file_hash in hashes:
+                file_hash.update(view[:size])
+    return {algorithm: file_hash.hexdigest() for algorithm, file_hash in hashes}
+
+
+def _hash_file_task(args):
+    # process pool entry point
+    path, algorithms, buffer_size = args
+    return hash_file(path, algorithms, buffer_size)
+
+
+def checksum_file_name(use_case, algorithm):
+    return f"{use_case}.{HASH_COMMANDS[algorithm]}"
+
+
+def list_files(directory, exclude_dirs=(), exclude_files=(), skip_sidecars=False):
+    """
+    List the files to hash (like `find . -type f`, in sorted order).
+    :param directory: the root directory
+    :param exclude_dirs: relative paths of directories to skip (with everything in them)
+    :param exclude_files: relative paths of files to skip
+    :param skip_sidecars: whether to skip the .md5 sidecar files of other files
+    :return: list of (relative path, size, modification time in ns) tuples
+    """
+    exclude_dirs = {os.path.normpath(path) for path in exclude_dirs}
+    exclude_files = {os.path.normpath(path) for path in exclude_files}
+    files = []
+    pending = ['.']
+    while pending:
+        rel_dir = pending.pop()
+        with os.scandir(os.path.join(directory, rel_dir)) as entries:
+            entries = list(entries)
+        names = {entry.name for entry in entries}
+        for entry in entries:
+            rel_path = os.path.normpath(os.path.join(rel_dir, entry.name))
+            if entry.is_dir(follow_symlinks=False):
+                if rel_path not in exclude_dirs:
+                    pending.append(rel_path)
+            elif entry.is_file(follow_symlinks=False):
+                if rel_path in exclude_files:
+                    continue
+                if skip_sidecars and entry.name.endswith(SIDECAR_SUFFIX) and \
+                        entry.name[:-len(SIDECAR_SUFFIX)] in names:
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                files.append((rel_path, stat.st_size, stat.st_mtime_ns))
+    files.sort()
+    return files
+
+
+class ChecksumManifest:
+    """
+    Digests of previously hashed files, keyed by relative path. An entry is only reused if size and modification
+    time of the file are unchanged.
+    """
+
+    def __init__(self, manifest_file=None):
+        self.manifest_file = manifest_file
+        self.entries = dict()
+        if manifest_file and os.path.exists(manifest_file):
+            with open(manifest_file) as fp:
+                self.entries = json.load(fp)
+
+    def get(self, rel_path, size, mtime_ns, algorithms):
+        # the digests of an unchanged file, None if (some of) the digests have to be computed
+        entry = self.entries.get(rel_path)
+        if entry and entry['size'] == size and entry['mtime_ns'] == mtime_ns and \
+                all(algorithm in entry['digests'] for algorithm in algorithms):
+            return {algorithm: entry['digests'][algorithm] for algorithm in algorithms}
+        return None
+
+    def put(self, rel_path, size, mtime_ns, digests):
+        self.entries[rel_path] = {'size': size, 'mtime_ns': mtime_ns, 'digests': digests}
+
+    def save(self):
+        if not self.manifest_file:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_file)), exist_ok=True)
+        with open(self.manifest_file + '.tmp', 'w') as fp:
+            json.dump(self.entries, fp)
+        os.replace(self.manifest_file + '.tmp', self.manifest_file)
+
+
+def manifest_file_name(manifest_dir, runfolder, use_case):
+    # the manifest of the checksums of a runfolder's directory (see create-checksums.py)
+    return os.path.join(manifest_dir, f"{runfolder}.{use_case}.json")
+
+
+def default_processes():
+    return max(1, min(os.cpu_count() or 1, MAX_DEFAULT_PROCESSES))
+
+
+def create_checksums(directory, use_case, algorithms=('md5',), exclude_dirs=(), processes=None, sidecars=False,
+                     manifest_file=None, buffer_size=BUFFER_SIZE, logger=None):
+    """
+    Create the checksum file(s) of all files in a directory.
+    :param directory: the directory to create the checksums for
+    :param use_case: prefix of the checksum files (e.g. runfolder -> runfolder.md5sum)
+    :param algorithms: the hash algorithms, one checksum file per algorithm
+    :param exclude_dirs: relative paths of directories to skip
+    :param processes: the size of the process pool (default: number of cores, at most MAX_DEFAULT_PROCESSES)
+    :param sidecars: whether to also write a <file>.md5 per file (requires md5 in algorithms)
+    :param manifest_file: the manifest of previous runs to reuse and update (None: hash all files)
+    :param buffer_size: the number of bytes read at once
+    :return: dict with the number of files/bytes, the number of files/bytes hashed in this run and the duration
+    """
+    logger = logger if logger else logging.getLogger(__name__)
+    if sidecars and 'md5' not in algorithms:
+        raise ValueError("Sidecar files require md5 checksums!")
+    for algorithm in algorithms:
+        _new_hash(algorithm)  # fail before any work is done
+
+    start = time.perf_counter()
+    output_files = [checksum_file_name(use_case, algorithm) for algorithm in algorithms]
+    files = list_files(directory, exclude_dirs=exclude_dirs, skip_sidecars=sidecars,
+                       exclude_files=[checksum_file_name(use_case, algorithm) for algorithm in HASH_COMMANDS])
+    manifest = ChecksumManifest(manifest_file)
+
+    digests = dict()
+    to_hash = []
+    for rel_path, size, mtime_ns in files:
+        known = manifest.get(rel_path, size, mtime_ns, algorithms)
+        if known:
+            digests[rel_path] = known
+        else:
+            to_hash.append((rel_path, size, mtime_ns))
+    bytes_to_hash = sum(size for _, size, _ in to_hash)
+    logger.info(f"{len(files)} files in {directory}, {len(to_hash)} to hash ({bytes_to_hash / 1e9:.2f} GB)")
+
+    if to_hash:
+        processes = processes if processes else default_processes()
+        # largest files first, so a big file doesn't end up last on a single process
+        to_hash.sort(key=lambda file: file[1], reverse=True)
+        tasks = [(os.path.join(directory, rel_path), algorithms, buffer_size) for rel_path, _, _ in to_hash]
+        saved = time.monotonic()
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for (rel_path, size, mtime_ns), file_digests in zip(to_hash, executor.map(_hash_file_task, tasks)):
+                digests[rel_path] = file_digests
+                manifest.put(rel_path, size, mtime_ns, file_digests)
+                if sidecars:
+                    with open(os.path.join(directory, rel_path + SIDECAR_SUFFIX), 'w') as fp:
+                        fp.write(f"{file_digests['md5']}  {os.path.basename(rel_path)}\n")
+                if time.monotonic() - saved > MANIFEST_SAVE_INTERVAL:
+                    manifest.save()  # progress is kept if we get interrupted
+                    saved = time.monotonic()
+        manifest.save()
+
+    for algorithm, output_file in zip(algorithms, output_files):
+        with open(os.path.join(directory, output_file), 'w') as fp:
+            for rel_path, _, _ in files:
+                fp.write(f"{digests[rel_path][algorithm]}  ./{rel_path}\n")
+
+    duration = time.perf_counter() - start
+    logger.info(f"Hashed {len(to_hash)} files ({bytes_to_hash / 1e6:.1f} MB) in {duration:.2f}s " +
+                f"({bytes_to_hash / 1e6 / max(duration, 1e-9):.1f} MB/s), " +
+                f"reused {len(files) - len(to_hash)} checksums, wrote {output_files}")
+    return {'files': len(files),
+            'bytes': sum(size for _, size, _ in files),
+            'hashed_files': len(to_hash),
+            'hashed_bytes': bytes_to_hash,
+            'seconds': duration}
+
+
+################################################################################
+# Benchmark: python checksum_engine.py [size in MB] [processes]
+
+def write_synthetic_runfolder(out_dir, total_mb=512, seed=42):
+    # a miniature NovaSeq runfolder: many small cbcl-like files, some larger ones and thumbnails
+    rnd = random.Random(seed)
+    sizes = []
+    for lane in range(1, 5):
+        for cycle in range(1, 31):
+            sizes.append((os.path.join('Data', 'Intensities', 'BaseCalls', f'L00{lane}', f'C{cycle}.1',
+                                       f'L00{lane}_1.cbcl'), rnd.randint(1, 4)))
+    for i in range(4):
+        sizes.append((os.path.join('InterOp', f'Metrics{i}Out.bin'), rnd.randint(20, 40)))
+    for i in range(20):
+        sizes.append((os.path.join('Thumbnail_Images', 'L001', f's_1_{i}_green.jpg'), 1))
+    scale = total_mb / sum(size for _, size in sizes)
+    chunk = os.urandom(1024 * 1024)
+    for rel_path, size in sizes:
+        path = os.path.join(out_dir, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        remaining = max(1, int(size * scale * 1024 * 1024))
+        with open(path, 'wb') as fp:
+            while remaining > 0:
+                fp.write(chunk[:remaining])
+                remaining -= len(chunk)
+    with open(os.path.join(out_dir, 'RunInfo.xml'), 'w') as fp:
+        fp.write('<RunInfo/>\n')
+
+
+def benchmark(total_mb=512, processes=None):
+    processes = processes if processes else default_processes()
+    with tempfile.TemporaryDirectory() as out_dir:
+        runfolder = os.path.join(out_dir, 'runfolder')
+        write_synthetic_runfolder(runfolder, total_mb=total_mb)
+        manifest_file = os.path.join(out_dir, 'runfolder.manifest.json')
+        for algorithms in [('md5',)] + [(algorithm,) for algorithm in available_algorithms()[1:]]:
+            for pool_size in sorted({1, processes}):
+                stats = create_checksums(runfolder, 'runfolder', algorithms=algorithms, processes=pool_size,
+                                         exclude_dirs=['Thumbnail_Images'])
+                print(f"{algorithms[0]:>6}, {pool_size:>2} processes: {stats['files']} files, " +
+                      f"{stats['bytes'] / 1e6:.0f} MB in {stats['seconds']:.2f}s " +
+                      f"({stats['bytes'] / 1e6 / stats['seconds']:.0f} MB/s)")
+        create_checksums(runfolder, 'runfolder', processes=processes, exclude_dirs=['Thumbnail_Images'],
+                         manifest_file=manifest_file)
+        stats = create_checksums(runfolder, 'runfolder', processes=processes, exclude_dirs=['Thumbnail_Images'],
+                                 manifest_file=manifest_file)
+        print(f"   md5, re-run with manifest: {stats['hashed_files']} of {stats['files']} files hashed " +
+              f"in {stats['seconds']:.2f}s")
+
+
+if __name__ == "__main__":
+    benchmark(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+import logging
+from logging.handlers import RotatingFileHandler
+from checksum_engine import create_checksums, available_algorithms, default_processes, checksum_file_name, \
+    manifest_file_name, BUFFER_SIZE
+
+################################################################################
+# CONSTANTS
+
+DEPLOY_ENV = os.getenv('DEPLOY_ENV')
+if not DEPLOY_ENV:
+    raise ValueError("DEPLOY_ENV is not set! Set it to either 'dev' or 'prod'.")
+SCRIPT = os.path.basename(__file__)
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+if DEPLOY_ENV == 'prod':
+    LOG_FILE_NAME = os.path.join(SCRIPT_DIR, SCRIPT + ".log")
+    MANIFEST_DIR = os.path.join(SCRIPT_DIR, 'checksum_manifests')
+else:
+    LOG_FILE_NAME = os.path.join(SCRIPT_DIR, SCRIPT + ".dev.log")
+    MANIFEST_DIR = os.path.join(SCRIPT_DIR, 'checksum_manifests.dev')
+
+# use case -> directories (relative to the input directory) that are not checksummed
+USE_CASES = {
+    'runfolder': ['Thumbnail_Images'],
+    'bcl2fastq': []
+}
+
+
+def getLogger():
+    new_logger = logging.getLogger(__name__)
+    new_logger.setLevel(logging.DEBUG)
+
+    # create a logging format
+    formatter = logging.Formatter('%(asctime)s - %(module)s - %(name)s - %(levelname)s : %(lineno)d - %(message)s')
+
+    # create a file handler
+    file_handler = RotatingFileHandler(filename=LOG_FILE_NAME, maxBytes=10000000, backupCount=5)
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(formatter)
+
+    # add the handlers to the logger
+    new_logger.addHandler(file_handler)
+
+    if DEPLOY_ENV != 'prod':
+        # create a console handler
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(logging.DEBUG)
+        console_handler.setFormatter(formatter)
+        new_logger.addHandler(console_handler)
+
+    return new_logger
+
+
+if __name__ == "__main__":
+    logger = getLogger()
+    logger.info(f"Invocation with parameters: {sys.argv[1:]}")
+
+    parser = argparse.ArgumentParser(description="Create the checksum files of a runfolder or bcl2fastq output.")
+    parser.add_argument('use_case', choices=sorted(USE_CASES),
+                        help="What to create checksums for, determines the name of the checksum files.")
+    parser.add_argument('directory',
+                        help="The directory to create the checksums for.")
+    parser.add_argument('runfolder', nargs='?',
+                        help="The run/runfolder name (default: the name of the directory).")
+    parser.add_argument('--hash', dest='algorithms', action='append', choices=available_algorithms(),
+                        help="Hash algorithm, can be repeated for several checksum files (default: md5).")
+    parser.add_argument('--processes', type=int, default=default_processes(),
+                        help=f"The number of files hashed in parallel (default: {default_processes()}).")
+    parser.add_argument('--buffer-size', type=int, default=BUFFER_SIZE,
+                        help=f"The number of bytes read at once (default: {BUFFER_SIZE}).")
+    parser.add_argument('--sidecars', action='store_true',
+                        help="Also write a <file>.md5 next to each file.")
+    parser.add_argument('--no-manifest', action='store_true',
+                        help="Hash all files, instead of reusing the checksums of unchanged files from earlier runs.")
+    args = parser.parse_args()
+
+    if DEPLOY_ENV == 'dev':
+        # Wait a bit to simulate work (and avoid tasks running too close to each other)
+        time.sleep(5)
+
+    directory = args.directory
+    if not (directory and os.path.isdir(directory)):
+        logger.error(f"Not a valid directory: {directory}")
+        sys.exit(1)
+
+    algorithms = args.algorithms if args.algorithms else ['md5']
+    runfolder = args.runfolder if args.runfolder else os.path.basename(os.path.normpath(directory))
+    manifest_file = None if args.no_manifest else manifest_file_name(MANIFEST_DIR, runfolder, args.use_case)
+    output_files = [checksum_file_name(args.use_case, algorithm) for algorithm in algorithms]
+
+    if DEPLOY_ENV != 'prod':
+        logger.debug(f"[dev]: would create {output_files} in {directory} using {args.processes} processes " +
+                     f"(manifest: {manifest_file})")
+    else:
+        try:
+            create_checksums(directory, args.use_case,
+                             algorithms=algorithms,
+                             exclude_dirs=USE_CASES[args.use_case],
+                             processes=args.processes,
+                             sidecars=args.sidecars,
+                             manifest_file=manifest_file,
+                             buffer_size=args.buffer_size,
+                             logger=logger)
+        except Exception as error:
+            logger.error(f"Checksum creation failed: {error}")
+            raise
+
+    logger.info("All done.")
@@ -0,0 +1,238 @@
+import sys
+import time
+import random
+import collections
+
+################################################################################
+# Index clash detection for SampleSheets
+#
+# Replaces the all-against-all sample comparison of samplesheet-check.py with a
+# lane bucketed lookup: Hamming distance <= 1 neighbours of equal length indexes
+# are found via a masked-position hash (each index is hashed once per position
+# with that position masked, two equal length indexes share a key iff they
+# differ in at most one position) and the substring rule for indexes of unequal
+# length is answered from a substring index. The findings (and their order) are
+# the same as the original pairwise comparison.
+
+IndexClash = collections.namedtuple('IndexClash', ['sample', 'other', 'check', 'message'])
+
+# Pairwise checks in the order of the original implementation:
+# (name, field of sample, field of other sample, 'too similar' message, 'substring' message,
+#  skip check if field of sample is empty, substring rule requires non-empty field of sample/other sample)
+PAIR_CHECKS = (
+    ('i7/i7', 'i7', 'i7', "Too similar: i7 for samples", "Substring: i7 for samples", False, False, False),
+    ('i7/i5', 'i7', 'i5', "Too similar: i7/i5 for samples", "Substring: i5/i7 for samples", False, False, True),
+    ('i5/i7', 'i5', 'i7', "Too similar: i5/i7 for samples", "Substring: i5/i7 for samples", False, True, False),
+    ('i5/i5', 'i5', 'i5', "Too similar: i5/i5 for samples", "Substring: i5/i5 for samples", True, True, True),
+)
+
+_IndexRecord = collections.namedtuple('_IndexRecord', ['position', 'sample', 'i7', 'i5'])
+
+
+def str_compare(a, b):
+    # count the differences between two strings of equal length
+    cnt = 0
+    for i, j in zip(a, b):
+        if i != j:
+            cnt += 1
+    return cnt
+
+
+def _mask_keys(index):
+    # the exact key also covers empty indexes, which have no positions to mask
+    yield (len(index), -1, index)
+    for i in range(len(index)):
+        yield (len(index), i, index[:i] + index[i + 1:])
+
+
+class IndexLookup:
+    """Lookup structure over a set of distinct index sequences."""
+
+    def __init__(self, indexes):
+        self.indexes = set(indexes)
+        self.by_mask = collections.defaultdict(set)
+        self.by_substring = collections.defaultdict(set)
+        self.lengths = set()
+        for index in self.indexes:
+            self.lengths.add(len(index))
+            for key in _mask_keys(index):
+                self.by_mask[key].add(index)
+            # all proper (shorter) substrings, including the empty string
+            for length in range(len(index)):
+                for start in range(len(index) - length + 1):
+                    self.by_substring[index[start:start + length]].add(index)
+
+    def similar(self, index):
+        # indexes of equal length with a Hamming distance <= 1
+        hits = set()
+        for key in _mask_keys(index):
+            hits.update(self.by_mask.get(key, ()))
+        return hits
+
+    def substring(self, index):
+        # indexes of different length that contain, or are contained in, the index
+        hits = set(self.by_substring.get(index, ()))
+        for length in self.lengths:
+            if length < len(index):
+                for start in range(len(index) - length + 1):
+                    if index[start:start + length] in self.indexes:
+                        hits.add(index[start:start + length])
+        return hits
+
+
+def _index_record(position, sample):
+    return _IndexRecord(position=position,
+                        sample=sample,
+                        i7=(sample.index or '').replace('N', ''),
+                        i5=(sample.index2 or '').replace('N', ''))
+
+
+def _check_sample(record):
+    if len(record.i5) > 0:
+        if len(record.i7) == len(record.i5):
+            if str_compare(record.i7, record.i5) <= 1:
+                return IndexClash(record.sample, None, 'i7/i5',
+                                  f"Too similar: i7 and i5 for sample {record.sample}")
+        elif record.i5 in record.i7:
+            return IndexClash(record.sample, None, 'i7/i5',
+                              f"Substring: i5 of i7 for sample {record.sample}")
+    return None
+
+
+def _check_lane(records):
+    # returns (position, other position, check rank, clash) tuples for all clashes within one lane
+    by_field = {'i7': collections.defaultdict(list), 'i5': collections.defaultdict(list)}
+    for record in records:
+        by_field['i7'][record.i7].append(record)
+        by_field['i5'][record.i5].append(record)
+    lookups = {field: IndexLookup(by_field[field].keys()) for field in by_field}
+
+    findings = []
+    for rank, (name, field, other_field, similar_msg, substring_msg,
+               skip_empty, substring_needs_field, substring_needs_other) in enumerate(PAIR_CHECKS):
+        by_index = by_field[field]
+        by_other_index = by_field[other_field]
+        lookup = lookups[other_field]
+
+        for index, index_records in by_index.items():
+            if skip_empty and len(index) == 0:
+                continue
+            hits = [(other_index, similar_msg) for other_index in lookup.similar(index)]
+            if not (substring_needs_field and len(index) == 0):
+                hits.extend((other_index, substring_msg) for other_index in lookup.substring(index)
+                            if not (substring_needs_other and len(other_index) == 0))
+            for other_index, message in hits:
+                for record in index_records:
+                    for other in by_other_index[other_index]:
+                        if record.position < other.position and record.sample.Sample_ID != other.sample.Sample_ID:
+                            clash = IndexClash(record.sample, other.sample, name,
+                                               f"{message} {record.sample} and {other.sample}")
+                            findings.append((record.position, other.position, rank, clash))
+    return findings
+
+
+def find_index_clashes(samples):
+    """
+    Find index clashes between the samples of a SampleSheet.
+
+    Every sample is checked for similar i7/i5 indexes and against every other sample (with a different Sample_ID)
+    in the same lane. Indexes of equal length clash if they differ in at most one position, indexes of unequal
+    length clash if one is a substring of the other.
+    :param samples: iterable of samples (with Sample_ID, lane, index and index2 attributes)
+    :return: list of IndexClash records, in the order the original pairwise comparison reported them
+    """
+    records = [_index_record(position, sample) for position, sample in enumerate(samples)]
+
+    findings = []
+    for record in records:
+        clash = _check_sample(record)
+        if clash:
+            findings.append((record.position, -1, -1, clash))
+
+    lanes = collections.defaultdict(list)
+    for record in records:
+        lanes[record.sample.lane].append(record)
+    for lane_records in lanes.values():
+        findings.extend(_check_lane(lane_records))
+
+    findings.sort(key=lambda finding: finding[:3])
+    return [finding[3] for finding in findings]
+
+
+################################################################################
+# Benchmark: python index_clash.py [sample counts]
+
+class _BenchmarkSample:
+
+    def __init__(self, sample_id, lane, index, index2):
+        self.Sample_ID = sample_id
+        self.lane = lane
+        self.index = index
+        self.index2 = index2
+
+    def __str__(self):
+        return self.Sample_ID
+
+
+def _pairwise_clashes(samples):
+    # reference implementation: the all-against-all comparison the engine replaces
+    findings = []
+    records = [_index_record(position, sample) for position, sample in enumerate(samples)]
+    for record in records:
+        clash = _check_sample(record)
+        if clash:
+            findings.append(clash)
+        for other in records[record.position + 1:]:
+            if record.sample.Sample_ID == other.sample.Sample_ID or record.sample.lane != other.sample.lane:
+                continue
+            for name, field, other_field, similar_msg, substring_msg, \
+                    skip_empty, substring_needs_field, substring_needs_other in PAIR_CHECKS:
+                index = getattr(record, field)
+                other_index = getattr(other, other_field)
+                if skip_empty and len(index) == 0:
+                    continue
+                if len(index) == len(other_index):
+                    message = similar_msg if str_compare(index, other_index) <= 1 else None
+                elif (substring_needs_field and len(index) == 0) or (substring_needs_other and len(other_index) == 0):
+                    message = None
+                else:
+                    message = substring_msg if index in other_index or other_index in index else None
+                if message:
+                    findings.append(IndexClash(record.sample, other.sample, name,
+                                               f"{message} {record.sample} and {other.sample}"))
+    return findings
+
+
+def _random_samples(count, lanes=4, seed=42):
+    rnd = random.Random(seed)
+
+    def random_index(length):
+        return ''.join(rnd.choice('ACGT') for _ in range(length))
+
+    samples = []
+    for i in range(count):
+        length = rnd.choice((8, 8, 8, 10))
+        samples.append(_BenchmarkSample(sample_id=f"PRJ{i:06d}_L{i:07d}",
+                                        lane=str(i % lanes + 1),
+                                        index=random_index(length),
+                                        index2=random_index(length) if rnd.random() > 0.1 else ''))
+    return samples
+
+
+def benchmark(sample_counts=(96, 384, 1536)):
+    for count in sample_counts:
+        samples = _random_samples(count)
+        start = time.perf_counter()
+        clashes = find_index_clashes(samples)
+        engine_time = time.perf_counter() - start
+        start = time.perf_counter()
+        reference = _pairwise_clashes(samples)
+        pairwise_time = time.perf_counter() - start
+        if [c.message for c in clashes] != [c.message for c in reference]:
+            raise AssertionError(f"Index clash findings differ from pairwise comparison for {count} samples!")
+        print(f"{count:>6} samples: {len(clashes):>6} clashes, engine {engine_time:8.4f}s, "
+              f"pairwise {pairwise_time:8.4f}s")
+
+
+if __name__ == "__main__":
+    benchmark([int(arg) for arg in sys.argv[1:]] or (96, 384, 1536))
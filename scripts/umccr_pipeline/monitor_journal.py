@@ -0,0 +1,69 @@
+import time
+import sqlite3
+import threading
+import collections
+
+################################################################################
+# Persistent journal of the runfolder monitor
+#
+# Records the runfolders the monitor has seen, when their ready flag file was detected and which pipeline execution
+# was started for them, so a restarted monitor can work out what it missed while it was down.
+
+RunfolderState = collections.namedtuple('RunfolderState', ['runfolder', 'first_seen', 'flag_detected',
+                                                           'execution_started', 'execution_arn'])
+
+# execution ARN recorded for runfolders that were already complete when the journal was created
+PRE_JOURNAL_EXECUTION = 'pre-journal'
+
+
+class MonitorJournal:
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._lock = threading.Lock()  # the connection is shared between the monitor and its workers
+        self._connection = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS runfolders (
+                runfolder TEXT PRIMARY KEY,
+                first_seen REAL NOT NULL,
+                flag_detected REAL,
+                execution_started REAL,
+                execution_arn TEXT
+            )""")
+
+    def _execute(self, statement, parameters=()):
+        with self._lock:
+            return self._connection.execute(statement, parameters).fetchall()
+
+    def is_empty(self):
+        return not self._execute("SELECT 1 FROM runfolders LIMIT 1")
+
+    def runfolders(self):
+        # state of all journaled runfolders, by runfolder name
+        rows = self._execute("SELECT runfolder, first_seen, flag_detected, execution_started, execution_arn "
+                             "FROM runfolders")
+        return {row[0]: RunfolderState(*row) for row in rows}
+
+    def get(self, runfolder):
+        rows = self._execute("SELECT runfolder, first_seen, flag_detected, execution_started, execution_arn "
+                             "FROM runfolders WHERE runfolder = ?", (runfolder,))
+        return RunfolderState(*rows[0]) if rows else None
+
+    def record_seen(self, runfolder):
+        self._execute("INSERT OR IGNORE INTO runfolders (runfolder, first_seen) VALUES (?, ?)",
+                      (runfolder, time.time()))
+
+    def record_flag(self, runfolder):
+        self.record_seen(runfolder)
+        self._execute("UPDATE runfolders SET flag_detected = ? WHERE runfolder = ? AND flag_detected IS NULL",
+                      (time.time(), runfolder))
+
+    def record_execution(self, runfolder, execution_arn):
+        self.record_flag(runfolder)
+        self._execute("UPDATE runfolders SET execution_started = ?, execution_arn = ? WHERE runfolder = ?",
+                      (time.time(), execution_arn, runfolder))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,13 +1,18 @@
 import os.path
-import sys
-import atexit
+import queue
+import argparse
+import threading
 import boto3
+from botocore.exceptions import ClientError
 import json
 import time
 import logging
+import collections
 from logging.handlers import RotatingFileHandler
 from inotify_simple import INotify, flags
 from pathlib import Path
+from monitor_journal import MonitorJournal, PRE_JOURNAL_EXECUTION
+from runfolder_name import RunfolderName
 
 DEPLOY_ENV = os.getenv('DEPLOY_ENV')
 SCRIPT = os.path.basename(__file__)
@@ -15,25 +20,27 @@ SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 if DEPLOY_ENV == 'prod':
     LOG_FILE_NAME = os.path.join(SCRIPT_DIR, SCRIPT + ".log")
+    JOURNAL_FILE_SUFFIX = ".journal.db"
 else:
     LOG_FILE_NAME = os.path.join(SCRIPT_DIR, SCRIPT + ".dev.log")
+    JOURNAL_FILE_SUFFIX = ".dev.journal.db"
 
 
-WATCH_FLAGS = flags.CREATE | flags.MOVED_TO  # creattion (and possibly renaming) events
+WATCH_FLAGS = flags.CREATE | flags.MOVED_TO | flags.DELETE_SELF  # creattion (and possibly renaming) events
 SLACK_TOPIC = "UMCCR runfolder monitor"
 FLAG_FILE_NAME = "CopyComplete.txt"
-
-lambda_client = boto3.client('lambda')
-pipeline_client = client = boto3.client('stepfunctions')
-inotify_service = INotify()
-
-
-# shutdown hook
-@atexit.register
-def cleanup():
-    logger.warn("Shutting down...")
-    inotify_service.close()
-    logger.warn("Shutdown complete.")
+SAMPLESHEET_FILE_NAME = "SampleSheet.csv"
+SAMPLESHEET_TOPIC = "Incoming run monitor"
+SAMPLESHEET_TITLE = "New runfolder detected"
+AWS_WORKERS = 2  # threads sending Slack notifications and starting pipelines
+AWS_MAX_RETRIES = 5
+DEFAULT_MAX_AGE_DAYS = 90  # runfolders older than this are ignored on startup
+METRICS_INTERVAL = 300  # seconds between metrics log entries
+MAX_USER_WATCHES_FILE = "/proc/sys/fs/inotify/max_user_watches"
+WATCH_LIMIT_WARNING = 0.8  # fraction of max_user_watches in use that triggers a warning
+DEFAULT_NOTIFY_WINDOW = 10  # seconds Slack notifications are collected before they are sent as one message
+NOTIFY_RATE = 1 / 6  # Slack messages per second (sustained)
+NOTIFY_BURST = 5  # Slack messages that can be sent at once
 
 
 def getLogger():
@@ -54,116 +61,507 @@ def getLogger():
     return new_logger
 
 
-def notify_slack(topic, title, message, lambda_name):
-    logger.debug(f"Sending slack message: {message} with title: {title}")
-    payload = {
-        "topic": topic,
-        "title": title,
-        "message": message
-    }
-
-    response = lambda_client.invoke(
-        FunctionName=lambda_name,
-        InvocationType='RequestResponse',
-        Payload=json.dumps(payload)
-    )
-
-    return response
-
-
-def start_pipeline(state_machine_arn, runfolder):
-    logger.info(f"Starting pipeline for {runfolder}")
-    payload = {
-        "runfolder": runfolder
-    }
-
-    # the name has to be unique for at least 90 days
-    execution_name = f"{runfolder}_execution_{round(time.time())}"
-
-    response = client.start_execution(
-        stateMachineArn=state_machine_arn,
-        name=execution_name,
-        input=json.dumps(payload)
-    )
-
-    return response
-
-
-def run_monitor(monitored_path, slack_lambda_name, state_machine_arn):
-    wd_dir_map = {}
-
-    # Add root folder as watched folder
-    root_wd = inotify_service.add_watch(monitored_path, WATCH_FLAGS)
-    wd_dir_map[root_wd] = monitored_path
-
-    # Add all existing runfolders to the ones being watched
-    logger.info("Adding child folders of monitored root path...")
-    root_path = Path(monitored_path)
-    for child_path in root_path.iterdir():
-        if child_path.is_dir():
-            # Add a hack to exclude certain folders from being monitored
-            # TODO: find better way to do this
-            if '200401_A00130_0135_AH2JJCDSXY' in child_path.name:
-                logger.info(f"Ignoring path: {child_path}")
+logger = logging.getLogger(__name__)
+
+
+def runfolder_age_days(runfolder_path):
+    # age by the run date of the runfolder name, falling back to the modification time
+    try:
+        created = RunfolderName.parse(os.path.basename(runfolder_path)).date.timestamp()
+    except ValueError:
+        created = os.stat(runfolder_path).st_mtime
+    return (time.time() - created) / (24 * 60 * 60)
+
+
+def max_user_watches():
+    try:
+        with open(MAX_USER_WATCHES_FILE) as fp:
+            return int(fp.read())
+    except (OSError, ValueError):
+        return None
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        # blocks until a token is available
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+
+
+class CoalescingNotifier:
+    """
+    Collects Slack notifications for a time window and sends them as one message per topic.
+
+    Identical (title, message) notifications of a topic within a window are only sent once and the sent messages are
+    rate limited with a token bucket, so a burst of events (e.g. after a remount of the instrument share) results in
+    a few Slack messages instead of one Lambda invocation per event. A repeated event after the window (e.g. a
+    SampleSheet uploaded again) is reported again.
+    """
+
+    def __init__(self, send, window=DEFAULT_NOTIFY_WINDOW, rate=NOTIFY_RATE, burst=NOTIFY_BURST):
+        self.send = send  # called with the payload of each Slack message
+        self.window = window
+        self.bucket = TokenBucket(rate, burst)
+        self.pending = collections.OrderedDict()  # topic -> list of (title, message)
+        self.notifications = 0
+        self.duplicates = 0
+        self.messages = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="slack-notifier", daemon=True)
+
+    def notify(self, title, message, topic):
+        with self._lock:
+            self.notifications += 1
+            if (title, message) in self.pending.get(topic, ()):
+                logger.debug(f"Suppressed duplicate notification '{message}' for {title}")
+                self.duplicates += 1
+                return
+            self.pending.setdefault(topic, []).append((title, message))
+
+    def flush(self):
+        with self._lock:
+            pending, self.pending = self.pending, collections.OrderedDict()
+
+        for topic, notifications in pending.items():
+            if len(notifications) == 1:
+                title, message = notifications[0]
             else:
+                title = f"{len(notifications)} notifications"
+                message = "\n".join(f"{runfolder}: {text}" for runfolder, text in notifications)
+            self.bucket.acquire()
+            self.send({
+                "topic": topic,
+                "title": title,
+                "message": message
+            })
+            self.messages += 1
+            logger.info(f"Sent {len(notifications)} notifications for topic '{topic}' as one Slack message, " +
+                        f"{self.avoided_invocations} Lambda invocations avoided so far.")
+
+    @property
+    def avoided_invocations(self):
+        return self.notifications - self.messages
+
+    def _run(self):
+        while not self._stopped.wait(self.window):
+            self.flush()
+        self.flush()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        # sends what is still pending
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        else:
+            self.flush()
+
+
+class RunfolderMonitor:
+    """
+    Watches a root folder for new runfolders and the ready flag files within them.
+
+    The inotify reader only updates the watches and queues tasks (Slack notifications, pipeline starts). Those are
+    drained by worker threads with retries, so slow AWS calls don't hold up reading the inotify events.
+
+    Seen runfolders, detected flag files and started executions are recorded in a journal. On startup the monitor
+    reconciles the root folder against it: runfolders with a started execution are neither watched nor checked
+    again, flag files without a started execution (e.g. written while the monitor was down) start the pipeline.
+
+    Runfolders are only watched until their flag file is processed, or they are deleted, so the number of watches is
+    bounded by the runs in progress. Runfolders older than max_age_days are ignored on startup.
+
+    With the samplesheet rule enabled, SampleSheets written to the top level of a watched runfolder are reported as
+    well, and runfolders are watched until their pipeline is started (a SampleSheet may still be rewritten after the
+    flag file). Only the root folder and the runfolders are watched, the runfolder contents are not watched
+    recursively.
+    """
+
+    def __init__(self, monitored_path, slack_lambda_name, state_machine_arn, inotify_service, lambda_client,
+                 pipeline_client, journal, workers=AWS_WORKERS, max_age_days=DEFAULT_MAX_AGE_DAYS,
+                 samplesheet_rule=False, notify_window=DEFAULT_NOTIFY_WINDOW):
+        self.monitored_path = monitored_path
+        self.slack_lambda_name = slack_lambda_name
+        self.state_machine_arn = state_machine_arn
+        self.inotify_service = inotify_service
+        self.lambda_client = lambda_client
+        self.pipeline_client = pipeline_client
+        self.journal = journal
+        self.max_age_days = max_age_days
+        self.samplesheet_rule = samplesheet_rule
+        self.task_queue = queue.Queue()
+        self.workers = [threading.Thread(target=self._work, name=f"aws-worker-{i}", daemon=True)
+                        for i in range(workers)]
+        self.notifier = CoalescingNotifier(send=self._queue_slack_message, window=notify_window)
+        self.root_wd = None
+        self.wd_dir_map = {}
+        self.flagged_runfolders = set()  # runfolders with a pipeline start queued by this process
+        self.started_runfolders = queue.Queue()  # runfolders with a started pipeline, their watches are retired
+        self.max_user_watches = max_user_watches()
+        self.event_lags = []  # seconds between file creation and handling of the event, since the last report
+        self.events_handled = 0
+        self.metrics_reported = time.time()
+
+    ############################################################################
+    # AWS tasks, executed by the worker threads
+
+    def submit(self, task_name, function, **kwargs):
+        logger.debug(f"Queueing task: {task_name}")
+        self.task_queue.put((task_name, function, kwargs))
+
+    def _work(self):
+        while True:
+            task = self.task_queue.get()
+            if task is None:
+                self.task_queue.task_done()
+                break
+            task_name, function, kwargs = task
+            for attempt in range(AWS_MAX_RETRIES + 1):
+                try:
+                    function(**kwargs)
+                    break
+                except Exception as error:
+                    if attempt == AWS_MAX_RETRIES:
+                        logger.error(f"Task {task_name} failed after {attempt + 1} attempts: {error}")
+                    else:
+                        backoff = 2 ** attempt
+                        logger.warning(f"Task {task_name} failed: {error}. Retrying in {backoff}s.")
+                        time.sleep(backoff)
+            self.task_queue.task_done()
+
+    def _invoke_slack_lambda(self, payload):
+        # asynchronous invocation, we don't need to wait for Slack
+        return self.lambda_client.invoke(
+            FunctionName=self.slack_lambda_name,
+            InvocationType='Event',
+            Payload=json.dumps(payload)
+        )
+
+    def _start_execution(self, runfolder, execution_name):
+        # retried with the same name and input: Step Functions returns the execution started by an earlier attempt
+        # (e.g. one that timed out after the execution was started) instead of starting a second one
+        payload = {
+            "runfolder": runfolder
+        }
+
+        try:
+            response = self.pipeline_client.start_execution(
+                stateMachineArn=self.state_machine_arn,
+                name=execution_name,
+                input=json.dumps(payload)
+            )
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ExecutionAlreadyExists':
+                raise
+            # the execution of an earlier attempt has already finished
+            execution_arn = self.state_machine_arn.replace(':stateMachine:', ':execution:') + ':' + execution_name
+            logger.warning(f"Execution {execution_arn} for {runfolder} already exists")
+            self.journal.record_execution(runfolder, execution_arn)
+            self.started_runfolders.put(runfolder)
+            return None
+        logger.info(f"Started execution {response['executionArn']} for {runfolder}")
+        self.journal.record_execution(runfolder, response['executionArn'])
+        self.started_runfolders.put(runfolder)
+        return response
+
+    def _queue_slack_message(self, payload):
+        self.submit(f"Slack notification '{payload['message']}' for {payload['title']}", self._invoke_slack_lambda,
+                    payload=payload)
+
+    def notify_slack(self, title, message, topic=SLACK_TOPIC):
+        # sent with the next batch of the notifier
+        logger.debug(f"Queueing slack message: {message} with title: {title}")
+        self.notifier.notify(title=title, message=message, topic=topic)
+
+    def start_pipeline(self, runfolder):
+        logger.info(f"Starting pipeline for {runfolder}")
+        self.flagged_runfolders.add(runfolder)
+        self.journal.record_flag(runfolder)
+        # the name has to be unique for at least 90 days, it's set once so retries of the task reuse it
+        execution_name = f"{runfolder}_execution_{round(time.time())}"
+        self.submit(f"Pipeline start for {runfolder}", self._start_execution, runfolder=runfolder,
+                    execution_name=execution_name)
+
+    ############################################################################
+    # inotify handling
+
+    def watch_runfolder(self, runfolder_path):
+        # these watches are automatically removed when the directory is deleted
+        wd = self.inotify_service.add_watch(runfolder_path, WATCH_FLAGS)
+        self.wd_dir_map[wd] = str(runfolder_path)
+        return wd
+
+    def retire_watch(self, wd):
+        # the kernel confirms the removal with an IGNORED event, by then the watch descriptor is already unmapped
+        path = self.wd_dir_map.pop(wd, None)
+        logger.info(f"Removing watch for {path}")
+        try:
+            self.inotify_service.rm_watch(wd)
+        except OSError as err:
+            logger.warning(f"Could not remove watch for {path}: {err}")
+
+    def retire_started_runfolders(self):
+        # the watches are only touched by the inotify reader, the workers just report the started pipelines
+        watched = {path: wd for wd, path in self.wd_dir_map.items()}
+        while True:
+            try:
+                runfolder = self.started_runfolders.get_nowait()
+            except queue.Empty:
+                break
+            wd = watched.get(os.path.join(self.monitored_path, runfolder))
+            if wd is not None and wd != self.root_wd:
+                self.retire_watch(wd)
+
+    def scan(self):
+        """
+        Reconcile the root folder with the journal: watch the root folder and all runfolders without a started
+        execution (the watches of already watched folders are kept), and report the runfolders (and their SampleSheets)
+        and start the pipeline for flag files that appeared while unobserved, e.g. while inotify events were dropped.
+        If the journal is empty (first start), the existing runfolders are only recorded, flag files found are
+        considered processed and no pipelines are started.
+        """
+        bootstrap = self.root_wd is None and self.journal.is_empty()
+        if bootstrap:
+            logger.warning(f"Empty journal {self.journal.db_file}, " +
+                           "recording existing runfolders without starting their pipelines.")
+
+        if self.root_wd is None:
+            self.root_wd = self.inotify_service.add_watch(self.monitored_path, WATCH_FLAGS)
+            self.wd_dir_map[self.root_wd] = self.monitored_path
+        journaled = self.journal.runfolders()
+        watched = {path: wd for wd, path in self.wd_dir_map.items()}
+        root_path = Path(self.monitored_path)
+        new_runfolders = 0
+        too_old = 0
+        for child_path in root_path.iterdir():
+            state = journaled.get(child_path.name)
+            if (state and state.execution_started) or child_path.name in self.flagged_runfolders:
+                continue  # completed or queued, no need to look at it again
+            if not child_path.is_dir():
+                continue
+            if self.max_age_days and runfolder_age_days(child_path) > self.max_age_days:
+                logger.debug(f"Ignoring path older than {self.max_age_days} days: {child_path}")
+                too_old += 1
+                continue
+            if state is None:
+                new_runfolders += 1
+                self.journal.record_seen(child_path.name)
+                if not bootstrap:
+                    logger.warning(f"Missed new runfolder detected: {child_path}")
+                    self.notify_slack(title=child_path.name, message="New runfolder detected (rescan).")
+                    if self.samplesheet_rule and (child_path / SAMPLESHEET_FILE_NAME).is_file():
+                        self.handle_samplesheet(str(child_path))
+            flagged = (child_path / FLAG_FILE_NAME).exists()
+            if flagged:
+                if bootstrap:
+                    self.journal.record_execution(child_path.name, PRE_JOURNAL_EXECUTION)
+                else:
+                    logger.warning(f"Missed flag file detected: {child_path / FLAG_FILE_NAME}")
+                    self.notify_slack(title=child_path.name, message="Runfolder ready flag detected (rescan).")
+                    self.start_pipeline(runfolder=child_path.name)
+            if flagged and (bootstrap or not self.samplesheet_rule):
+                if str(child_path) in watched:
+                    self.retire_watch(watched[str(child_path)])
+            elif str(child_path) not in watched:
                 logger.info(f"Adding path to monitor: {child_path}")
-                ch_wd = inotify_service.add_watch(child_path, WATCH_FLAGS)
-                wd_dir_map[ch_wd] = child_path
-
-    while 1:
-        # TODO: monitor for folder deletion events, to remove watches for removed runfolder?
-        for event in inotify_service.read(read_delay=500):
-            reported_flags = flags.from_mask(event.mask)
-
-            # we're only interested in creation events
-            if flags.CREATE in reported_flags or flags.MOVED_TO in reported_flags:
-                parent_path = wd_dir_map[event.wd]  # map the current watch descriptor to the watched folder
-                current_path = os.path.join(parent_path, event.name)  # the full path of the event
-                # and only directory creations in the root folder (direct sub-directories)
-                if flags.ISDIR in reported_flags and event.wd is root_wd:
-                    logger.info(f"New runfolder detected: {current_path}")
-                    try:
-                        # try add a watch for the newly created directory (runfolder)
-                        # these watches are automatically removed when the directory is deleted
-                        wd = inotify_service.add_watch(current_path, WATCH_FLAGS)
-                        wd_dir_map[wd] = current_path
-                    except OSError as err:
-                        notify_slack(topic=SLACK_TOPIC,
-                                     title=event.name,
-                                     message="ERROR creating watch for new runfolder!",
-                                     lambda_name=slack_lambda_name)
-                    notify_slack(topic=SLACK_TOPIC,
-                                 title=event.name,
-                                 message="New runfolder detected.",
-                                 lambda_name=slack_lambda_name)
-                # or the creation of the ready flag file
-                elif event.name == FLAG_FILE_NAME:
-                    logger.info(f"New flag file detected: {current_path}")
-                    # found a flag file, so the directory linked to the watch descriptor is the runfolder
-                    runfolder = os.path.basename(parent_path)
-                    notify_slack(topic=SLACK_TOPIC,
-                                 title=runfolder,
-                                 message="Runfolder ready flag detected.",
-                                 lambda_name=slack_lambda_name)
-                    start_pipeline(state_machine_arn=state_machine_arn,
-                                   runfolder=runfolder)
-                    # Could remove watch for this run, instead of watching it until the directory is removed
-                else:  # Ignore other events
-                    logger.debug(f"Ignored CREATE/MOVE_TO event for {event.name}")
-            else:  # Ignore event types we haven't signed up for (e.g. DELETE_SELF)
-                logger.debug(f"Ignored event with flags {reported_flags} for {event.name}")
+                self.watch_runfolder(child_path)
+        logger.info(f"Reconciled {root_path} with journal: {new_runfolders} new runfolders, " +
+                    f"{too_old} runfolders ignored as too old, {len(self.wd_dir_map)} watches.")
+
+    def record_event_lag(self, path):
+        # how long after the creation of the file or directory we got to handle its event
+        try:
+            self.event_lags.append(max(0.0, time.time() - os.stat(path).st_mtime))
+        except OSError:
+            pass  # already gone again
+
+    def handle_event(self, event):
+        reported_flags = flags.from_mask(event.mask)
+        self.events_handled += 1
+
+        # the kernel dropped events, we have to find out what we missed
+        if flags.Q_OVERFLOW in reported_flags:
+            logger.warning("inotify event queue overflow! Rescanning monitored path.")
+            self.scan()
+        # a watched directory was deleted, its watch is removed with the following IGNORED event
+        elif flags.DELETE_SELF in reported_flags:
+            logger.info(f"Watched directory deleted: {self.wd_dir_map.get(event.wd)}")
+        # the watch was removed, because the directory was deleted (or we retired the watch)
+        elif flags.IGNORED in reported_flags:
+            path = self.wd_dir_map.pop(event.wd, None)
+            if path:
+                logger.info(f"Watch for {path} removed by the kernel")
+            if event.wd == self.root_wd:
+                self.notify_slack(title=self.monitored_path, message="ERROR monitored root folder was removed!")
+                raise RuntimeError(f"Monitored path {self.monitored_path} was removed!")
+        # we're only interested in creation events
+        elif flags.CREATE in reported_flags or flags.MOVED_TO in reported_flags:
+            parent_path = self.wd_dir_map.get(event.wd)  # map the current watch descriptor to the watched folder
+            if parent_path is None:
+                logger.debug(f"Ignored event for {event.name} from retired watch {event.wd}")
+                return
+            current_path = os.path.join(parent_path, event.name)  # the full path of the event
+            # and only directory creations in the root folder (direct sub-directories)
+            if flags.ISDIR in reported_flags and event.wd == self.root_wd:
+                logger.info(f"New runfolder detected: {current_path}")
+                try:
+                    RunfolderName.parse(event.name)
+                except ValueError as err:
+                    logger.warning(f"Unexpected runfolder name: {err}")
+                self.record_event_lag(current_path)
+                self.journal.record_seen(event.name)
+                self.notify_slack(title=event.name, message="New runfolder detected.")
+                try:
+                    # try add a watch for the newly created directory (runfolder)
+                    wd = self.watch_runfolder(current_path)
+                except OSError as err:
+                    logger.error(f"Could not create watch for {current_path}: {err}")
+                    self.notify_slack(title=event.name, message="ERROR creating watch for new runfolder!")
+                else:
+                    # files written before the watch was in place don't produce events (the instrument writes the
+                    # SampleSheet right at the start of the run)
+                    if self.samplesheet_rule and os.path.isfile(os.path.join(current_path, SAMPLESHEET_FILE_NAME)):
+                        self.handle_samplesheet(current_path)
+                    if os.path.isfile(os.path.join(current_path, FLAG_FILE_NAME)):
+                        self.handle_flag_file(current_path, wd)
+            # or the creation of the ready flag file
+            elif event.name == FLAG_FILE_NAME:
+                self.record_event_lag(current_path)
+                self.handle_flag_file(parent_path, event.wd)
+            # or a SampleSheet in a runfolder
+            elif event.name == SAMPLESHEET_FILE_NAME and self.samplesheet_rule and event.wd != self.root_wd:
+                self.record_event_lag(current_path)
+                self.handle_samplesheet(parent_path)
+            else:  # Ignore other events
+                logger.debug(f"Ignored CREATE/MOVE_TO event for {event.name}")
+        else:  # Ignore event types we haven't signed up for
+            logger.debug(f"Ignored event with flags {reported_flags} for {event.name}")
+
+    def handle_flag_file(self, runfolder_path, wd):
+        logger.info(f"New flag file detected: {os.path.join(runfolder_path, FLAG_FILE_NAME)}")
+        # found a flag file, so the directory linked to the watch descriptor is the runfolder
+        runfolder = os.path.basename(runfolder_path)
+        state = self.journal.get(runfolder)
+        if runfolder in self.flagged_runfolders or (state and state.execution_started):
+            logger.warning(f"Flag file for {runfolder} was already processed, ignoring it.")
+        else:
+            self.notify_slack(title=runfolder, message="Runfolder ready flag detected.")
+            self.start_pipeline(runfolder=runfolder)
+        # nothing left to wait for in this runfolder, unless its SampleSheet is still rewritten before the pipeline is
+        # started (the watch is then retired by retire_started_runfolders)
+        if not self.samplesheet_rule or (state and state.execution_started):
+            self.retire_watch(wd)
+
+    def handle_samplesheet(self, runfolder_path):
+        logger.info(f"New SampleSheet detected: {os.path.join(runfolder_path, SAMPLESHEET_FILE_NAME)}")
+        self.notify_slack(title=SAMPLESHEET_TITLE, message=runfolder_path, topic=SAMPLESHEET_TOPIC)
+
+    def metrics(self):
+        return {
+            'watches': len(self.wd_dir_map),
+            'max_user_watches': self.max_user_watches,
+            'events_handled': self.events_handled,
+            'max_event_lag': max(self.event_lags) if self.event_lags else None,
+            'mean_event_lag': sum(self.event_lags) / len(self.event_lags) if self.event_lags else None,
+            'queued_tasks': self.task_queue.qsize(),
+            'notifications': self.notifier.notifications,
+            'duplicate_notifications': self.notifier.duplicates,
+            'slack_messages': self.notifier.messages,
+            'avoided_invocations': self.notifier.avoided_invocations
+        }
+
+    def report_metrics(self):
+        metrics = self.metrics()
+        logger.info("Metrics: " + json.dumps(metrics))
+        if self.max_user_watches and metrics['watches'] > WATCH_LIMIT_WARNING * self.max_user_watches:
+            logger.warning(f"{metrics['watches']} of {self.max_user_watches} inotify watches in use!")
+        self.event_lags = []
+        self.metrics_reported = time.time()
+
+    def run(self):
+        for worker in self.workers:
+            worker.start()
+        self.notifier.start()
+
+        # Add all unfinished runfolders to the ones being watched and start the pipelines we missed
+        logger.info("Reconciling child folders of monitored root path with the journal...")
+        self.scan()
+
+        try:
+            while 1:
+                # the timeout makes sure the metrics are reported without events too
+                for event in self.inotify_service.read(timeout=METRICS_INTERVAL * 1000, read_delay=500):
+                    self.handle_event(event)
+                self.retire_started_runfolders()
+                if time.time() - self.metrics_reported >= METRICS_INTERVAL:
+                    self.report_metrics()
+        finally:
+            self.stop()
+
+    def stop(self):
+        # let the notifier and the workers finish the queued tasks
+        self.notifier.stop()
+        logger.warning(f"Stopping workers, {self.task_queue.qsize()} tasks queued.")
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.join()
+        self.inotify_service.close()
+        self.journal.close()
+        logger.warning("Shutdown complete.")
 
 
 if __name__ == "__main__":
     logger = getLogger()
 
-    # TODO: validate input
-    path_to_monitor = sys.argv[1]
-    slack_lambda_name = sys.argv[2]
-    state_machine_arn = sys.argv[3]
-
-    logger.warn(f"Starting runfolder monitor on path: {path_to_monitor}")
-
-    run_monitor(monitored_path=path_to_monitor, 
-                slack_lambda_name=slack_lambda_name, 
-                state_machine_arn=state_machine_arn)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path_to_monitor', help="The root folder the runfolders are written to.")
+    parser.add_argument('slack_lambda_name', help="The Lambda function sending the Slack notifications.")
+    parser.add_argument('state_machine_arn', help="The state machine executing the pipeline.")
+    parser.add_argument('--journal', dest='journal_file',
+                        help="The journal database (default: one per monitored path, next to this script).")
+    parser.add_argument('--max-age-days', type=int, default=DEFAULT_MAX_AGE_DAYS,
+                        help="Ignore runfolders older than this on startup, 0 for no limit " +
+                             f"(default: {DEFAULT_MAX_AGE_DAYS}).")
+    parser.add_argument('--notify-window', type=float, default=DEFAULT_NOTIFY_WINDOW,
+                        help="Seconds Slack notifications are collected and sent as one message " +
+                             f"(default: {DEFAULT_NOTIFY_WINDOW}).")
+    parser.add_argument('--samplesheets', action='store_true',
+                        help=f"Also report {SAMPLESHEET_FILE_NAME} files written to runfolders " +
+                             "(until their pipeline is started).")
+    args = parser.parse_args()
+
+    path_to_monitor = args.path_to_monitor
+    journal_file = args.journal_file if args.journal_file else \
+        os.path.join(SCRIPT_DIR, SCRIPT + "." + Path(path_to_monitor).name + JOURNAL_FILE_SUFFIX)
+
+    logger.warning(f"Starting runfolder monitor on path: {path_to_monitor}")
+
+    monitor = RunfolderMonitor(monitored_path=path_to_monitor,
+                               slack_lambda_name=args.slack_lambda_name,
+                               state_machine_arn=args.state_machine_arn,
+                               inotify_service=INotify(),
+                               lambda_client=boto3.client('lambda'),
+                               pipeline_client=boto3.client('stepfunctions'),
+                               journal=MonitorJournal(journal_file),
+                               max_age_days=args.max_age_days,
+                               samplesheet_rule=args.samplesheets,
+                               notify_window=args.notify_window)
+    monitor.run()
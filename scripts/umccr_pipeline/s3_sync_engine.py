@@ -0,0 +1,235 @@
+import os
+import time
+import fnmatch
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.exceptions import ClientError
+from s3transfer.subscribers import BaseSubscriber
+from checksum_engine import list_files
+
+################################################################################
+# One way sync of a local directory to an S3 prefix (used by sync-to-s3.py)
+#
+# Follows `aws s3 sync --delete` semantics: a file is uploaded if the object is missing, has a different size or is
+# older than the file; objects without local file are deleted; excluded paths are neither uploaded nor deleted.
+# The S3 listing is fetched once, one listing per top level sub-prefix in parallel. If the checksum manifest of the
+# directory has the MD5 of an unchanged file and it matches the object, the file is not uploaded again even if it is
+# newer: the MD5 is compared with the ETag of single part uploads, and with the md5 metadata (stored by this sync)
+# of multipart uploads, which costs a HEAD request per newer file of the same size.
+
+DEFAULT_PART_SIZE = 16 * 1024 * 1024  # bytes
+DEFAULT_MULTIPART_THRESHOLD = 64 * 1024 * 1024  # bytes
+DEFAULT_CONCURRENCY = 10  # concurrent requests (parts and files)
+DEFAULT_LISTING_WORKERS = 8  # concurrent listings
+DELETE_BATCH_SIZE = 1000  # maximum keys per DeleteObjects request
+PROGRESS_INTERVAL = 60  # seconds between progress log entries
+
+SyncPlan = collections.namedtuple('SyncPlan', ['uploads', 'deletes', 'unchanged'])
+
+
+def is_excluded(rel_path, excludes):
+    # aws cli --exclude semantics: patterns are matched against the whole relative path, '*' also matches '/'
+    return any(fnmatch.fnmatchcase(rel_path, pattern) for pattern in excludes)
+
+
+def _list_prefix(client, bucket, prefix, delimiter=None):
+    objects = dict()
+    common_prefixes = []
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    for page in client.get_paginator('list_objects_v2').paginate(**kwargs):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = obj
+        common_prefixes.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', []))
+    return objects, common_prefixes
+
+
+def list_inventory(client, bucket, prefix, max_workers=DEFAULT_LISTING_WORKERS):
+    """
+    List all objects below a prefix, the top level sub-prefixes are listed in parallel.
+    :return: dict of key (relative to the prefix) to the object record of the listing (Size, ETag, LastModified)
+    """
+    prefix = prefix.rstrip('/') + '/' if prefix else ''
+    objects, sub_prefixes = _list_prefix(client, bucket, prefix, delimiter='/')
+    if sub_prefixes:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(sub_prefixes)))) as executor:
+            for sub_objects, _ in executor.map(lambda sub_prefix: _list_prefix(client, bucket, sub_prefix),
+                                               sub_prefixes):
+                objects.update(sub_objects)
+    return {key[len(prefix):]: obj for key, obj in objects.items()}
+
+
+def plan_sync(local_files, inventory, excludes=(), delete=True, manifest=None, object_md5=None,
+              max_workers=DEFAULT_LISTING_WORKERS):
+    """
+    :param local_files: list of (relative path, size, modification time in ns) tuples
+    :param inventory: dict of relative key to object record (see list_inventory)
+    :param excludes: aws cli style exclude patterns
+    :param delete: whether objects without local file are deleted
+    :param manifest: optional ChecksumManifest of the local directory
+    :param object_md5: optional function returning the md5 metadata of an object (by relative key), to compare
+                       multipart uploads with the manifest
+    :param max_workers: the maximum number of concurrent object_md5 calls
+    :return: SyncPlan with the files to upload, the keys to delete and the number of unchanged files
+    """
+    uploads = []
+    unchanged = 0
+    local_paths = set()
+    multipart_candidates = []  # ((relative path, size, mtime), manifest MD5) of newer files of multipart objects
+    for rel_path, size, mtime_ns in local_files:
+        if is_excluded(rel_path, excludes):
+            continue
+        local_paths.add(rel_path)
+        obj = inventory.get(rel_path)
+        if obj is not None and obj['Size'] == size:
+            if mtime_ns / 1e9 <= obj['LastModified'].timestamp():
+                unchanged += 1
+                continue
+            digests = manifest.get(rel_path, size, mtime_ns, ['md5']) if manifest else None
+            if digests is not None:
+                etag = obj['ETag'].strip('"')
+                if '-' not in etag:
+                    if digests['md5'] == etag:
+                        unchanged += 1
+                        continue
+                elif object_md5:
+                    multipart_candidates.append(((rel_path, size, mtime_ns), digests['md5']))
+                    continue
+        uploads.append((rel_path, size, mtime_ns))
+
+    if multipart_candidates:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(multipart_candidates)))) as executor:
+            object_md5s = executor.map(lambda candidate: object_md5(candidate[0][0]), multipart_candidates)
+            for (local_file, md5), stored_md5 in zip(multipart_candidates, object_md5s):
+                if md5 == stored_md5:
+                    unchanged += 1
+                else:
+                    uploads.append(local_file)
+    deletes = sorted(key for key in inventory if key not in local_paths and not is_excluded(key, excludes)) \
+        if delete else []
+    return SyncPlan(uploads=uploads, deletes=deletes, unchanged=unchanged)
+
+
+class _Progress:
+
+    def __init__(self, total_bytes, logger):
+        self.total_bytes = total_bytes
+        self.bytes = 0
+        self.logger = logger
+        self.start = time.perf_counter()
+        self.reported = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self.bytes += bytes_amount
+            if time.monotonic() - self.reported > PROGRESS_INTERVAL:
+                self.reported = time.monotonic()
+                self.logger.info(f"Uploaded {self.bytes / 1e9:.2f} of {self.total_bytes / 1e9:.2f} GB " +
+                                 f"({self.rate() / 1e6:.1f} MB/s)")
+
+    def rate(self):
+        return self.bytes / max(time.perf_counter() - self.start, 1e-9)
+
+
+class _ProgressSubscriber(BaseSubscriber):
+    # forwards the transferred bytes of an upload to the progress counter
+
+    def __init__(self, progress):
+        self.progress = progress
+
+    def on_progress(self, future, bytes_transferred, **kwargs):
+        self.progress(bytes_transferred)
+
+
+def sync_directory(client, source_dir, bucket, dest_prefix, excludes=(), delete=True, dryrun=False,
+                   part_size=DEFAULT_PART_SIZE, multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+                   concurrency=DEFAULT_CONCURRENCY, listing_workers=DEFAULT_LISTING_WORKERS, manifest=None,
+                   transfer_log=None, logger=None):
+    """
+    Sync a local directory to s3://<bucket>/<dest_prefix>.
+    :param client: boto3 S3 client
+    :param source_dir: the local directory
+    :param bucket: the destination bucket
+    :param dest_prefix: the destination prefix (the "directory" in the bucket)
+    :param excludes: aws cli style exclude patterns (relative to source_dir)
+    :param delete: whether to delete objects without local file
+    :param dryrun: only report what would be done
+    :param part_size: the size of the parts of multipart uploads
+    :param multipart_threshold: the file size from which on multipart uploads are used
+    :param concurrency: the maximum number of concurrent upload requests
+    :param listing_workers: the maximum number of concurrent listing requests
+    :param manifest: optional ChecksumManifest of source_dir, to skip files with unchanged content
+    :param transfer_log: optional file object the performed actions are written to (aws cli output format)
+    :return: dict with the numbers of uploaded/deleted/unchanged files, the uploaded bytes and the duration
+    """
+    logger = logger if logger else logging.getLogger(__name__)
+    dest_prefix = dest_prefix.strip('/')
+    dest_url = f"s3://{bucket}/{dest_prefix}".rstrip('/')
+    start = time.perf_counter()
+
+    def object_key(rel_path):
+        return f"{dest_prefix}/{rel_path}" if dest_prefix else rel_path
+
+    def object_md5(rel_path):
+        try:
+            return client.head_object(Bucket=bucket, Key=object_key(rel_path)).get('Metadata', {}).get('md5')
+        except ClientError as error:
+            logger.warning(f"Could not get the metadata of {object_key(rel_path)}: {error}")
+            return None
+
+    files = list_files(source_dir)
+    inventory = list_inventory(client, bucket, dest_prefix, max_workers=listing_workers)
+    plan = plan_sync(files, inventory, excludes=excludes, delete=delete, manifest=manifest, object_md5=object_md5,
+                     max_workers=listing_workers)
+    upload_bytes = sum(size for _, size, _ in plan.uploads)
+    logger.info(f"Sync {source_dir} to {dest_url}: {len(files)} local files, {len(inventory)} objects, " +
+                f"{len(plan.uploads)} to upload ({upload_bytes / 1e9:.2f} GB), {len(plan.deletes)} to delete, " +
+                f"{plan.unchanged} unchanged")
+
+    def log_action(action):
+        if transfer_log:
+            transfer_log.write(f"{'(dryrun) ' if dryrun else ''}{action}\n")
+
+    progress = _Progress(upload_bytes, logger)
+    if plan.uploads and not dryrun:
+        config = TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=part_size,
+                                max_concurrency=concurrency, use_threads=True)
+        with create_transfer_manager(client, config) as transfer_manager:
+            futures = []
+            for rel_path, size, mtime_ns in plan.uploads:
+                digests = manifest.get(rel_path, size, mtime_ns, ['md5']) if manifest else None
+                extra_args = {'Metadata': {'md5': digests['md5']}} if digests else None
+                future = transfer_manager.upload(os.path.join(source_dir, rel_path), bucket, object_key(rel_path),
+                                                 extra_args=extra_args, subscribers=[_ProgressSubscriber(progress)])
+                futures.append((rel_path, future))
+            for rel_path, future in futures:
+                future.result()
+                log_action(f"upload: {os.path.join(source_dir, rel_path)} to {dest_url}/{rel_path}")
+    else:
+        for rel_path, _, _ in plan.uploads:
+            log_action(f"upload: {os.path.join(source_dir, rel_path)} to {dest_url}/{rel_path}")
+
+    for i in range(0, len(plan.deletes), DELETE_BATCH_SIZE):
+        batch = plan.deletes[i:i + DELETE_BATCH_SIZE]
+        if not dryrun:
+            response = client.delete_objects(Bucket=bucket, Delete={
+                'Objects': [{'Key': object_key(key)} for key in batch], 'Quiet': True})
+            if response.get('Errors'):
+                raise RuntimeError(f"Could not delete {len(response['Errors'])} objects: {response['Errors'][:5]}")
+        for key in batch:
+            log_action(f"delete: {dest_url}/{key}")
+
+    duration = time.perf_counter() - start
+    logger.info(f"{'(dryrun) ' if dryrun else ''}Uploaded {len(plan.uploads)} files " +
+                f"({progress.bytes / 1e6:.1f} MB, {progress.rate() / 1e6:.1f} MB/s), " +
+                f"deleted {len(plan.deletes)} objects in {duration:.2f}s")
+    return {'uploaded': len(plan.uploads),
+            'deleted': len(plan.deletes),
+            'unchanged': plan.unchanged,
+            'bytes': progress.bytes,
+            'seconds': duration}
@@ -5,8 +5,10 @@ import argparse
 import logging
 from logging.handlers import RotatingFileHandler
 import collections
+import pandas as pd
 from sample_sheet import SampleSheet  # https://github.com/clintval/sample-sheet
-from gspread_pandas import Spread
+from index_clash import find_index_clashes
+from tracking_sheet import TrackingSheetCache, LibraryIndex, DEFAULT_CACHE_DIR, DEFAULT_CACHE_TTL, DEFAULT_MAX_WORKERS
 
 
 import warnings
@@ -67,6 +69,11 @@ regex_sample_id_ctl = re.compile(sample_control + library_id)
 regex_sample_name = re.compile(library_id)
 regex_topup = re.compile(topup_exp)
 
+# Levels of metadata validation findings
+FINDING_ERROR = 'error'
+FINDING_WARN = 'warning'
+FINDING_INFO = 'info'
+
 
 if DEPLOY_ENV == 'dev':
     print("DEV")
@@ -102,16 +109,6 @@ def getLogger():
     return new_logger
 
 
-# method to count the differences between two strings
-# NOTE: strings have to be of equal length
-def str_compare(a, b):
-    cnt = 0
-    for i, j in zip(a, b):
-        if i != j:
-            cnt += 1
-    return cnt
-
-
 def get_year_from_lib_id(library_id):
     # TODO: check library ID format and make sure we have proper years
     if library_id.startswith('LPRJ'):
@@ -129,8 +126,7 @@ def get_years_from_samplesheet(samplesheet):
 
 def get_library_sheet_from_google(year):
     logger.info(f"Loading tracking data for year {year}")
-    spread = Spread(lab_spreadsheet_id)
-    library_tracking_spreadsheet_df = spread.sheet_to_df(sheet=year, index=0, header_rows=1, start_row=1)
+    library_tracking_spreadsheet_df = tracking_sheet_cache.get_sheet(year, index=0, header_rows=1, start_row=1)
     hit = library_tracking_spreadsheet_df.iloc[0]
     logger.debug(f"First record: {hit}")
     for column_name in metadata_column_names:
@@ -144,8 +140,7 @@ def get_library_sheet_from_google(year):
 
 def import_library_sheet_validation_from_google():
     global validation_df
-    spread = Spread(lab_spreadsheet_id)
-    validation_df = spread.sheet_to_df(sheet='Validation', index=0, header_rows=1, start_row=1)
+    validation_df = tracking_sheet_cache.get_sheet('Validation', index=0, header_rows=1, start_row=1)
     hit = validation_df.iloc[0]
     logger.debug(f"First record of validation data: {hit}")
     for column_name in metadata_validation_column_names:
@@ -153,25 +148,35 @@ def import_library_sheet_validation_from_google():
         if column_name not in hit:
             logger.error(f"Could not find column {column_name}. The file is not structured as expected! Aborting.")
             exit(-1)
+
+    # sets of allowed values, so validation doesn't depend on the size of the Validation tab
+    global allowed_values
+    allowed_values = dict()
+    for column_name in (val_type_column_name, val_phenotype_column_name,
+                        val_quality_column_name, val_source_column_name):
+        allowed_values[column_name] = frozenset(validation_df[column_name])
+    # project owners and names have to be listed exactly once
+    for column_name in (val_project_owner_column_name, val_project_name_column_name):
+        value_counts = validation_df[column_name].value_counts()
+        allowed_values[column_name] = frozenset(value_counts[value_counts == 1].index)
     logger.info(f"Loaded library tracking sheet validation data.")
 
 
 def get_meta_data_by_library_id(library_id):
-    year = get_year_from_lib_id(library_id)
-    library_tracking_spreadsheet_df = library_tracking_spreadsheet.get(year)
-    try:
-        hit = library_tracking_spreadsheet_df[library_tracking_spreadsheet_df[library_id_column_name] == library_id]
-    except (KeyError, NameError, TypeError, Exception) as er:
-        logger.error(f"Error trying to find library ID {library_id}! Error: {er}")
-
-    # We expect exactly one matching record, not more, not less!
-    if len(hit) == 1:
+    # O(1) lookup in the library index, returns None for unknown or duplicated library IDs
+    hit = library_index.get(library_id)
+    if hit is not None:
         logger.debug(f"Unique entry found for sample ID {library_id}")
-    elif len(hit) > 1:
+    return hit
+
+
+def checkLibraryIdUniqueness(samplesheet):
+    # report missing and duplicated library IDs once, before the per sample checks
+    missing, duplicated = library_index.find_problems(sample.Sample_Name for sample in samplesheet)
+    for library_id in duplicated:
         logger.error(f"Multiple entries for library ID {library_id}!")
-    else:
+    for library_id in missing:
         logger.error(f"No entry for library ID {library_id}")
-    return hit
 
 
 def checkSampleSheetMetadata(samplesheet):
@@ -209,149 +214,94 @@ def checkSampleAndLibraryIdFormat(samplesheet):
     return has_error
 
 
+def validateMetadata(samplesheet):
+    """
+    Validate the metadata of all SampleSheet samples in one pass over the samples joined with the tracking sheet.
+    :return: findings table (DataFrame) with one row per finding: Sample_ID, level (error/warning/info), message
+    """
+    samples_df = pd.DataFrame([(position, sample.Sample_ID, sample.Sample_Name)
+                               for position, sample in enumerate(samplesheet)],
+                              columns=['position', 'Sample_ID', 'Sample_Name'])
+    # SampleSheet Sample_Name == LIMS LibraryID, SampleSheet Sample_ID == LIMS SampleID_LibraryID
+    samples_df = library_index.join(samples_df, on='Sample_Name')
+    # samples without (unique) record have been reported already
+    samples_df = samples_df[samples_df[library_id_column_name].notna()]
+    # exclude 10X samples for now, as they usually don't comply
+    vocab_df = samples_df[samples_df[type_column_name] != '10X']
+    p_owner = vocab_df[project_owner_column_name]
+    p_name = vocab_df[project_name_column_name]
+    metadata_sample_id = samples_df[sample_id_column_name] + '_' + samples_df[library_id_column_name]
+
+    # check that the primary library for the topup exists
+    topup_df = samples_df[samples_df['Sample_Name'].str.contains(regex_topup)]
+    orig_library_ids = topup_df['Sample_Name'].str.replace(regex_topup, '', regex=True)
+    topup_df = topup_df.assign(orig_library_id=orig_library_ids)[~orig_library_ids.isin(library_index.records.index)]
+
+    # (level, rows failing the check, message), in the order the checks are reported for each sample
+    checks = (
+        (FINDING_ERROR, samples_df[metadata_sample_id != samples_df['Sample_ID']],
+         lambda row: f"Sample_ID of SampleSheet ({row.Sample_ID}) does not match " +
+                     f"SampleID/LibraryID of metadata ({row[sample_id_column_name]}_{row[library_id_column_name]})"),
+        (FINDING_INFO, samples_df[samples_df[type_column_name] == '10X'],
+         lambda row: f"Skipping controlled vocabulary checks for 10X sample {row.Sample_ID}"),
+        (FINDING_WARN, vocab_df[vocab_df[subject_id_column_name] == ''],
+         lambda row: f"No subject ID for {row.Sample_ID}"),
+        (FINDING_WARN, vocab_df[~vocab_df[type_column_name].isin(allowed_values[val_type_column_name])],
+         lambda row: f"Unsupported Type '{row[type_column_name]}' for {row.Sample_ID}"),
+        (FINDING_WARN, vocab_df[~vocab_df[phenotype_column_name].isin(allowed_values[val_phenotype_column_name])],
+         lambda row: f"Unsupported Phenotype '{row[phenotype_column_name]}' for {row.Sample_ID}"),
+        (FINDING_WARN, vocab_df[~vocab_df[quality_column_name].isin(allowed_values[val_quality_column_name])],
+         lambda row: f"Unsupported Quality '{row[quality_column_name]}' for {row.Sample_ID}"),
+        (FINDING_WARN, vocab_df[~vocab_df[source_column_name].isin(allowed_values[val_source_column_name])],
+         lambda row: f"Unsupported Source '{row[source_column_name]}' for {row.Sample_ID}"),
+        (FINDING_ERROR, vocab_df[p_owner == ''],
+         lambda row: f"No project owner found for sample {row.Sample_ID}"),
+        (FINDING_ERROR, vocab_df[~p_owner.isin(allowed_values[val_project_owner_column_name])],
+         lambda row: f"Project owner {row[project_owner_column_name]} not found in allowed values!"),
+        (FINDING_ERROR, vocab_df[p_name == ''],
+         lambda row: f"No project name found for sample {row.Sample_ID}"),
+        (FINDING_ERROR, vocab_df[~p_name.isin(allowed_values[val_project_name_column_name])],
+         lambda row: f"Project name {row[project_name_column_name]} not found in allowed values!"),
+        (FINDING_ERROR, topup_df,
+         lambda row: f"Couldn't find library {row.orig_library_id} for topup {row.Sample_Name}"),
+    )
+
+    findings = list()
+    for rank, (level, failed_df, message) in enumerate(checks):
+        for _, row in failed_df.iterrows():
+            findings.append((row.position, rank, row.Sample_ID, level, message(row)))
+    findings_df = pd.DataFrame(findings, columns=['position', 'rank', 'Sample_ID', 'level', 'message'])
+    findings_df = findings_df.sort_values(['position', 'rank'])
+    return findings_df[['Sample_ID', 'level', 'message']].reset_index(drop=True)
+
+
 def checkMetadataCorrespondence(samplesheet):
     logger.info("Checking SampleSheet data against metadata")
-    has_error = False
-    global validation_df
 
-    for sample in samplesheet:
-        ss_sample_name = sample.Sample_Name  # SampleSheet Sample_Name == LIMS LibraryID
-        ss_sample_id = sample.Sample_ID  # SampleSheet Sample_ID == LIMS SampleID_LibraryID
-        logger.debug(f"Checking Sammple_ID/Sample_Name: {ss_sample_id}/{ss_sample_name}")
-
-        # Make sure the ID exists and is unique
-        column_values = get_meta_data_by_library_id(ss_sample_name)
-        if len(column_values) != 1:
-            has_error = False
-            continue
-        logger.debug(f"Retrieved values: {column_values} for sample {ss_sample_name}.")
-
-        # check sample ID/Name match
-        ss_sn = column_values[sample_id_column_name].item() + '_' + column_values[library_id_column_name].item()
-        if ss_sn != ss_sample_id:
-            has_error = True
-            logger.error(f"Sample_ID of SampleSheet ({ss_sample_id}) does not match " +
-                         f"SampleID/LibraryID of metadata ({ss_sn})")
-
-        # exclude 10X samples for now, as they usually don't comply
-        if column_values[type_column_name].item() != '10X':
-            # check presence of subject ID
-            if column_values[subject_id_column_name].item() == '':
-                logger.warn(f"No subject ID for {ss_sample_id}")
-
-            # check controlled vocab: phenotype, type, source, quality: WARN if not present
-            if column_values[type_column_name].item() not in validation_df[val_type_column_name].values:
-                logger.warn(f"Unsupported Type '{column_values[type_column_name].item()}' for {ss_sample_id}")
-            if column_values[phenotype_column_name].item() not in validation_df[val_phenotype_column_name].values:
-                logger.warn(f"Unsupproted Phenotype '{column_values[phenotype_column_name].item()}' for {ss_sample_id}")
-            if column_values[quality_column_name].item() not in validation_df[val_quality_column_name].values:
-                logger.warn(f"Unsupproted Quality '{column_values[quality_column_name].item()}' for {ss_sample_id}")
-            if column_values[source_column_name].item() not in validation_df[val_source_column_name].values:
-                logger.warn(f"Unsupproted Source '{column_values[source_column_name].item()}' for {ss_sample_id}")
-
-            # check project name: WARN if not consistent
-            p_name = column_values[project_name_column_name].item()
-            p_owner = column_values[project_owner_column_name].item()
-            if p_owner == '':
-                has_error = True
-                logger.error(f"No project owner found for sample {sample.Sample_ID}")
-            if len(validation_df[validation_df[val_project_owner_column_name] == p_owner]) != 1:
-                has_error = True
-                logger.error(f"Project owner {p_owner} not found in allowed values!")
-            if p_name == '':
-                has_error = True
-                logger.error(f"No project name found for sample {sample.Sample_ID}")
-            if len(validation_df[validation_df[val_project_name_column_name] == p_name]) != 1:
-                has_error = True
-                logger.error(f"Project name {p_name} not found in allowed values!")
-
-        # check that the primary library for the topup exists
-        if regex_topup.search(sample.Sample_Name):
-            orig_library_id = regex_topup.sub('', sample.Sample_Name)
-            if len(get_meta_data_by_library_id(orig_library_id)) != 1:
-                logger.error(f"Couldn't find library {orig_library_id} for topup {sample.Sample_Name}")
-                has_error = True
+    checkLibraryIdUniqueness(samplesheet)
+    findings_df = validateMetadata(samplesheet)
+    for finding in findings_df.itertuples():
+        if finding.level == FINDING_ERROR:
+            logger.error(finding.message)
+        elif finding.level == FINDING_WARN:
+            logger.warning(finding.message)
+        else:
+            logger.info(finding.message)
+    logger.debug(f"Metadata findings:\n{findings_df.to_string()}")
 
-    return has_error
+    return bool((findings_df['level'] == FINDING_ERROR).any())
 
 
 def checkSampleSheetForIndexClashes(samplesheet):
     logger.info("Checking SampleSheet for index clashes")
     has_error = False
 
-    remaining_samples = list()
-    for sample in samplesheet:
-        remaining_samples.append(sample)
-
-    for sample in samplesheet:
-        remaining_samples.remove(sample)
-        logger.info(f"Comparing indexes of sample {sample}")
-        sample_i7 = sample.index.replace('N', '')
-        sample_i5 = sample.index2.replace('N', '')
-        # compare i7 to i5 of sample
-        if len(sample_i5) > 0:
-            if len(sample_i7) == len(sample_i5):
-                if str_compare(sample_i7, sample_i5) <= 1:
-                    logger.error(f"Too similar: i7 and i5 for sample {sample}")
-                    has_error = True
-            else:
-                if sample_i5 in sample_i7:
-                    logger.error(f"Substring: i5 of i7 for sample {sample}")
-                    has_error = True
-        else:
-            logger.debug(f"Skipping i5 index of sample {sample}")
-        for sample_other in remaining_samples:
-            logger.info(f"Checking indexes of sample {sample} against {sample_other}")
-            if sample.Sample_ID != sample_other.Sample_ID and sample.lane == sample_other.lane:
-                sample_other_i7 = sample_other.index.replace('N', '')
-                sample_other_i5 = sample_other.index2.replace('N', '')
-                # compare i7 of sample to i7 of other sample
-                if len(sample_i7) == len(sample_other_i7):
-                    if str_compare(sample_i7, sample_other_i7) <= 1:
-                        logger.error(f"Too similar: i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                else:
-                    if sample_other_i7 in sample_i7 or sample_i7 in sample_other_i7:
-                        logger.error(f"Substring: i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                # compare i7 of sample to i5 of other sample
-                if len(sample_i7) == len(sample_other_i5):
-                    if str_compare(sample_i7, sample_other_i5) <= 1:
-                        logger.error(f"Too similar: i7/i5 for samples {sample} and {sample_other}")
-                        has_error = True
-                elif len(sample_other_i5) > 0:
-                    if sample_other_i5 in sample_i7 or sample_i7 in sample_other_i5:
-                        logger.error(f"Substring: i5/i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                else:
-                    logger.info(f"Skipping i5 index of sample {sample_other}")
-                # compare i5 of sample to i7 of other sample
-                if len(sample_i5) == len(sample_other_i7):
-                    if str_compare(sample_i5, sample_other_i7) <= 1:
-                        logger.error(f"Too similar: i5/i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                elif len(sample_i5) > 0:
-                    if sample_i5 in sample_other_i7 or sample_other_i7 in sample_i5:
-                        logger.error(f"Substring: i5/i7 for samples {sample} and {sample_other}")
-                        has_error = True
-                else:
-                    logger.info(f"Skipping i5 index of sample {sample}")
-                # compare i5 of sample to i5 of other sample
-                if len(sample_i5) > 0:
-                    if len(sample_i5) == len(sample_other_i5):
-                        if str_compare(sample_i5, sample_other_i5) <= 1:
-                            logger.error(f"Too similar: i5/i5 for samples {sample} and {sample_other}")
-                            has_error = True
-                    elif len(sample_other_i5) > 0:
-                        if sample_i5 in sample_other_i5 or sample_other_i5 in sample_i5:
-                            logger.error(f"Substring: i5/i5 for samples {sample} and {sample_other}")
-                            has_error = True
-                    else:
-                        logger.info(f"Skipping i5 index of sample {sample_other}")
-                else:
-                    logger.info(f"Skipping i5 index of sample {sample}")
-            else:
-                logger.info(f"Sample sample or different lane")
+    # compare indexes within lanes (see index_clash.py), instead of all samples against each other
+    clashes = find_index_clashes(samplesheet)
+    for clash in clashes:
+        logger.error(clash.message)
+        has_error = True
+    logger.info(f"Found {len(clashes)} index clashes.")
 
     return has_error
 
@@ -412,15 +362,22 @@ def writeSammpleSheets(sample_list, sheet_path, template_sheet):
     return exit_status
 
 
-def main(samplesheet_file_path, check_only):
+def main(samplesheet_file_path, check_only, offline=False, refresh_cache=False):
+    global library_index
     logger.info(f"Checking SampleSheet {samplesheet_file_path}")
+    tracking_sheet_cache.offline = offline
+    if refresh_cache:
+        tracking_sheet_cache.invalidate()
     original_sample_sheet = SampleSheet(samplesheet_file_path)
 
     # Run some consistency checks
     years = get_years_from_samplesheet(original_sample_sheet)
     logger.info(f"Samplesheet contains IDs from {len(years)} years: {years}")
+    # fetch all required tabs concurrently, the loaders below then use the loaded tabs
+    tracking_sheet_cache.get_sheets(sorted(years) + ['Validation'], index=0, header_rows=1, start_row=1)
     for year in years:
         library_tracking_spreadsheet[year] = get_library_sheet_from_google(year)
+    library_index = LibraryIndex(library_tracking_spreadsheet.values(), library_id_column_name)
     import_library_sheet_validation_from_google()
     # TODO: replace has_error return with enum and expand to error, warning, info?
     has_header_error = checkSampleSheetMetadata(original_sample_sheet)
@@ -452,7 +409,9 @@ def main(samplesheet_file_path, check_only):
 # global variables
 # TODO: should be refactored in proper class variables
 library_tracking_spreadsheet = dict()  # dict of sheets as dataframes
+library_index = None  # LibraryID index over all loaded sheets
 logger = getLogger()
+tracking_sheet_cache = TrackingSheetCache(lab_spreadsheet_id, logger=logger)
 
 if __name__ == "__main__":
     logger.info(f"Invocation with parameters: {sys.argv[1:]}")
@@ -474,10 +433,24 @@ if __name__ == "__main__":
                         help="The samplesheet to process.")
     parser.add_argument('--check-only', action='store_true',
                         help="Only run the checks, do not split the samplesheet.")
+    parser.add_argument('--offline', action='store_true',
+                        help="Only use the local snapshot of the library tracking sheet, do not contact Google.")
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help="Discard the local snapshot of the library tracking sheet before loading it.")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help="Where to keep the local snapshot of the library tracking sheet.")
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL,
+                        help="Maximum age (in seconds) of the local snapshot of the library tracking sheet.")
+    parser.add_argument('--max-fetch-workers', type=int, default=DEFAULT_MAX_WORKERS,
+                        help="Maximum number of library tracking sheet tabs to fetch concurrently.")
 
     logger.debug("Parsing arguments.")
     args = parser.parse_args()
     samplesheet_file_path = args.samplesheet
     check_only = True if args.check_only else False
+    tracking_sheet_cache.cache_dir = args.cache_dir
+    tracking_sheet_cache.ttl = args.cache_ttl
+    tracking_sheet_cache.max_workers = args.max_fetch_workers
 
-    main(samplesheet_file_path=samplesheet_file_path, check_only=check_only)
+    main(samplesheet_file_path=samplesheet_file_path, check_only=check_only,
+         offline=args.offline, refresh_cache=args.refresh_cache)
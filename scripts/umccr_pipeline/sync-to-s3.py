@@ -0,0 +1,133 @@
+import os
+import sys
+import time
+import argparse
+import logging
+from logging.handlers import RotatingFileHandler
+import boto3
+from botocore.exceptions import ClientError
+from checksum_engine import ChecksumManifest, manifest_file_name
+from s3_sync_engine import sync_directory, DEFAULT_PART_SIZE, DEFAULT_MULTIPART_THRESHOLD, DEFAULT_CONCURRENCY, \
+    DEFAULT_LISTING_WORKERS
+
+################################################################################
+# CONSTANTS
+
+DEPLOY_ENV = os.getenv('DEPLOY_ENV')
+if not DEPLOY_ENV:
+    raise ValueError("DEPLOY_ENV is not set! Set it to either 'dev' or 'prod'.")
+SCRIPT = os.path.basename(__file__)
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+TRANSFER_LOG_DIR = os.path.join(SCRIPT_DIR, 's3sync-logs')
+MB = 1024 * 1024
+
+if DEPLOY_ENV == 'prod':
+    LOG_FILE_NAME = os.path.join(SCRIPT_DIR, SCRIPT + ".log")
+    MANIFEST_DIR = os.path.join(SCRIPT_DIR, 'checksum_manifests')
+else:
+    LOG_FILE_NAME = os.path.join(SCRIPT_DIR, SCRIPT + ".dev.log")
+    MANIFEST_DIR = os.path.join(SCRIPT_DIR, 'checksum_manifests.dev')
+
+
+def getLogger():
+    new_logger = logging.getLogger(__name__)
+    new_logger.setLevel(logging.DEBUG)
+
+    # create a logging format
+    formatter = logging.Formatter('%(asctime)s - %(module)s - %(name)s - %(levelname)s : %(lineno)d - %(message)s')
+
+    # create a file handler
+    file_handler = RotatingFileHandler(filename=LOG_FILE_NAME, maxBytes=10000000, backupCount=5)
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(formatter)
+
+    # add the handlers to the logger
+    new_logger.addHandler(file_handler)
+
+    if DEPLOY_ENV != 'prod':
+        # create a console handler
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(logging.DEBUG)
+        console_handler.setFormatter(formatter)
+        new_logger.addHandler(console_handler)
+
+    return new_logger
+
+
+if __name__ == "__main__":
+    logger = getLogger()
+    logger.info(f"Invocation with parameters: {sys.argv[1:]}")
+
+    parser = argparse.ArgumentParser(description="Sync a runfolder or bcl2fastq output directory to S3.")
+    parser.add_argument('-b', '--bucket', required=True,
+                        help="The destination bucket.")
+    parser.add_argument('-d', '--dest_path', '--dest-dir', dest='dest_path', required=True,
+                        help="The destination path (prefix) in the bucket.")
+    parser.add_argument('-s', '--source_path', '--source-dir', dest='source_path', required=True,
+                        help="The source directory.")
+    parser.add_argument('-n', '--runfolder-name', required=True,
+                        help="The runfolder name.")
+    parser.add_argument('-x', '--excludes', action='append', default=[],
+                        help="Sync exclusion in aws syntax (e.g. 'Thumbnail_Images/*'), can be repeated.")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="Force write to output directory, even if it does not match the input name.")
+    parser.add_argument('--checksums', choices=['runfolder', 'bcl2fastq'],
+                        help="Reuse the checksum manifest of create-checksums.py for this use case to skip files " +
+                             "with unchanged content.")
+    parser.add_argument('--part-size', type=int, default=DEFAULT_PART_SIZE // MB,
+                        help=f"Multipart upload part size in MB (default: {DEFAULT_PART_SIZE // MB}).")
+    parser.add_argument('--multipart-threshold', type=int, default=DEFAULT_MULTIPART_THRESHOLD // MB,
+                        help=f"File size in MB from which on multipart uploads are used " +
+                             f"(default: {DEFAULT_MULTIPART_THRESHOLD // MB}).")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"Maximum number of concurrent upload requests (default: {DEFAULT_CONCURRENCY}).")
+    parser.add_argument('--listing-workers', type=int, default=DEFAULT_LISTING_WORKERS,
+                        help=f"Maximum number of concurrent listing requests (default: {DEFAULT_LISTING_WORKERS}).")
+    args = parser.parse_args()
+
+    if DEPLOY_ENV == 'dev':
+        # Wait a bit to simulate work (and avoid tasks running too close to each other)
+        time.sleep(5)
+
+    if args.dest_path not in args.source_path:
+        logger.warning(f"Destination {args.dest_path} and source {args.source_path} do not match!")
+        if not args.force:
+            logger.error("Aborting!")
+            sys.exit(1)
+
+    s3_client = boto3.client('s3')
+    try:
+        s3_client.head_bucket(Bucket=args.bucket)
+    except ClientError as error:
+        logger.error(f"Could not access bucket {args.bucket}: {error}")
+        sys.exit(1)
+
+    manifest = None
+    if args.checksums:
+        manifest_file = manifest_file_name(MANIFEST_DIR, args.runfolder_name, args.checksums)
+        if os.path.exists(manifest_file):
+            logger.info(f"Using checksum manifest {manifest_file}")
+            manifest = ChecksumManifest(manifest_file)
+        else:
+            logger.warning(f"No checksum manifest {manifest_file}, comparing by size and modification time only.")
+
+    # TODO: perhaps add a timestamp to the log file name
+    transfer_log_name = args.dest_path.replace('/', '_') + ('' if DEPLOY_ENV == 'prod' else '.dev')
+    os.makedirs(TRANSFER_LOG_DIR, exist_ok=True)
+    with open(os.path.join(TRANSFER_LOG_DIR, transfer_log_name + '.log'), 'a') as transfer_log:
+        try:
+            sync_directory(s3_client, args.source_path, args.bucket, args.dest_path,
+                           excludes=args.excludes,
+                           dryrun=DEPLOY_ENV != 'prod',
+                           part_size=args.part_size * MB,
+                           multipart_threshold=args.multipart_threshold * MB,
+                           concurrency=args.concurrency,
+                           listing_workers=args.listing_workers,
+                           manifest=manifest,
+                           transfer_log=transfer_log,
+                           logger=logger)
+        except Exception as error:
+            logger.error(f"S3 sync failed: {error}")
+            raise
+
+    logger.info("All done.")
@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+################################################################################
+# Local snapshot cache for the lab's library tracking spreadsheet
+#
+# Tabs of the spreadsheet (year tabs, Validation) are stored as Parquet snapshots, keyed by spreadsheet ID and tab.
+# A snapshot is reused as long as it is younger than the TTL and the spreadsheet has not been modified since it was
+# taken (a single revision check per spreadsheet and run). In offline mode snapshots are used without contacting
+# Google at all.
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_CACHE_DIR = os.path.join(SCRIPT_DIR, 'tracking_sheet_cache')
+DEFAULT_CACHE_TTL = 24 * 60 * 60  # seconds
+DEFAULT_MAX_WORKERS = 4  # concurrent tab fetches
+RETRY_STATUS_CODES = (429, 500, 503)  # quota exceeded / transient backend errors
+MAX_RETRIES = 5
+
+
+def _default_spread_factory(spreadsheet_id):
+    from gspread_pandas import Spread
+    return Spread(spreadsheet_id)
+
+
+class TrackingSheetCache:
+
+    def __init__(self, spreadsheet_id, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_CACHE_TTL, offline=False,
+                 max_workers=DEFAULT_MAX_WORKERS, spread_factory=_default_spread_factory, logger=None):
+        self.spreadsheet_id = spreadsheet_id
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.offline = offline
+        self.max_workers = max_workers
+        self.spread_factory = spread_factory
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self._spread = None
+        self._revision = None
+        self._revision_checked = False
+        self._sheets = dict()  # tabs loaded in this run
+        self._local = threading.local()  # per thread Spread, as Spread keeps the currently open tab
+        self.timings = dict()  # seconds per fetched tab
+
+    @property
+    def spread(self):
+        if self.offline:
+            raise ValueError(f"Spreadsheet {self.spreadsheet_id} can't be accessed in offline mode!")
+        if self._spread is None:
+            self._spread = self.spread_factory(self.spreadsheet_id)
+        return self._spread
+
+    @property
+    def revision(self):
+        if not self._revision_checked:
+            # the Drive modifiedTime of the spreadsheet (gspread >= 5), None if it can't be determined
+            try:
+                self._revision = self.spread.spread.lastUpdateTime
+            except AttributeError as error:
+                self.logger.warning(f"Could not retrieve spreadsheet revision: {error}")
+            self._revision_checked = True
+            self.logger.debug(f"Spreadsheet {self.spreadsheet_id} revision: {self._revision}")
+        return self._revision
+
+    def _snapshot_paths(self, sheet):
+        base = os.path.join(self.cache_dir, self.spreadsheet_id, str(sheet))
+        return base + '.parquet', base + '.json'
+
+    def _read_snapshot_info(self, sheet):
+        snapshot_file, info_file = self._snapshot_paths(sheet)
+        if not (os.path.exists(snapshot_file) and os.path.exists(info_file)):
+            return None
+        with open(info_file) as fp:
+            return json.load(fp)
+
+    def _is_current(self, info):
+        if time.time() - info['created'] > self.ttl:
+            self.logger.debug(f"Snapshot of sheet {info['sheet']} expired.")
+            return False
+        revision = self.revision
+        if revision is None or revision != info['revision']:
+            self.logger.debug(f"Snapshot of sheet {info['sheet']} is outdated (revision {info['revision']}).")
+            return False
+        return True
+
+    def _write_snapshot(self, sheet, df):
+        snapshot_file, info_file = self._snapshot_paths(sheet)
+        os.makedirs(os.path.dirname(snapshot_file), exist_ok=True)
+        try:
+            df.to_parquet(snapshot_file + '.tmp')
+        except ImportError as error:
+            self.logger.warning(f"Not caching sheet {sheet}, Parquet support is not available: {error}")
+            return
+        except Exception as error:
+            # e.g. duplicate or blank column names, the snapshot is only an optimisation
+            self.logger.warning(f"Not caching sheet {sheet}, could not write the snapshot: {error}")
+            if os.path.exists(snapshot_file + '.tmp'):
+                os.remove(snapshot_file + '.tmp')
+            return
+        os.replace(snapshot_file + '.tmp', snapshot_file)
+        with open(info_file, 'w') as fp:
+            json.dump({'spreadsheet_id': self.spreadsheet_id,
+                       'sheet': str(sheet),
+                       'revision': self.revision,
+                       'created': time.time()}, fp)
+
+    def _load_snapshot(self, sheet):
+        # the snapshot of the tab if it is (still) usable, None otherwise
+        info = self._read_snapshot_info(sheet)
+        if info and (self.offline or self._is_current(info)):
+            self.logger.info(f"Using snapshot of sheet {sheet} from {time.ctime(info['created'])}")
+            return pd.read_parquet(self._snapshot_paths(sheet)[0])
+        if self.offline:
+            raise ValueError(f"No snapshot of sheet {sheet} available for offline use!")
+        return None
+
+    def _thread_spread(self):
+        if threading.current_thread() is threading.main_thread():
+            return self.spread
+        if getattr(self._local, 'spread', None) is None:
+            self._local.spread = self.spread_factory(self.spreadsheet_id)
+        return self._local.spread
+
+    def _fetch_sheet(self, sheet, sheet_to_df_args):
+        self.logger.info(f"Fetching sheet {sheet} from spreadsheet {self.spreadsheet_id}")
+        start = time.perf_counter()
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                df = self._thread_spread().sheet_to_df(sheet=sheet, **sheet_to_df_args)
+                break
+            except Exception as error:
+                status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+                if status_code not in RETRY_STATUS_CODES or attempt == MAX_RETRIES:
+                    raise
+                backoff = 2 ** attempt + random.random()
+                self.logger.warning(f"Fetching sheet {sheet} failed with status {status_code}, " +
+                                    f"retrying in {backoff:.1f}s")
+                time.sleep(backoff)
+        self.timings[sheet] = time.perf_counter() - start
+        self.logger.info(f"Fetched {len(df.index)} records of sheet {sheet} in {self.timings[sheet]:.2f}s")
+        self._write_snapshot(sheet, df)
+        return df
+
+    def get_sheet(self, sheet, **sheet_to_df_args):
+        """
+        Get a tab of the spreadsheet as DataFrame, from the local snapshot if it is still current.
+        :param sheet: the name of the tab
+        :param sheet_to_df_args: arguments passed on to Spread.sheet_to_df
+        :return: the tab as pandas DataFrame
+        """
+        if sheet not in self._sheets:
+            df = self._load_snapshot(sheet)
+            self._sheets[sheet] = df if df is not None else self._fetch_sheet(sheet, sheet_to_df_args)
+        return self._sheets[sheet]
+
+    def get_sheets(self, sheets, max_workers=None, **sheet_to_df_args):
+        """
+        Get several tabs of the spreadsheet, fetching the ones without current snapshot concurrently.
+        :param sheets: the names of the tabs
+        :param max_workers: the maximum number of concurrent fetches (default: the cache's max_workers)
+        :param sheet_to_df_args: arguments passed on to Spread.sheet_to_df
+        :return: dict of tab name to pandas DataFrame
+        """
+        missing = list()
+        for sheet in sheets:
+            if sheet not in self._sheets:
+                df = self._load_snapshot(sheet)
+                if df is None:
+                    missing.append(sheet)
+                else:
+                    self._sheets[sheet] = df
+
+        if missing:
+            # resolve the revision before the worker threads write their snapshots
+            self.logger.debug(f"Fetching {missing} at revision {self.revision}")
+            start = time.perf_counter()
+            max_workers = max_workers if max_workers else self.max_workers
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing)))) as executor:
+                fetched = executor.map(lambda sheet: self._fetch_sheet(sheet, sheet_to_df_args), missing)
+                self._sheets.update(zip(missing, fetched))
+            self.logger.info(f"Fetched {len(missing)} sheets in {time.perf_counter() - start:.2f}s " +
+                             f"(slowest: {max(self.timings[sheet] for sheet in missing):.2f}s)")
+
+        return {sheet: self._sheets[sheet] for sheet in sheets}
+
+    def invalidate(self, sheet=None):
+        """
+        Remove the snapshot of a tab, or all snapshots of the spreadsheet if no tab is given.
+        """
+        if sheet is None:
+            spreadsheet_dir = os.path.join(self.cache_dir, self.spreadsheet_id)
+            sheets = [os.path.splitext(f)[0] for f in os.listdir(spreadsheet_dir) if f.endswith('.json')] \
+                if os.path.isdir(spreadsheet_dir) else []
+        else:
+            sheets = [sheet]
+        for name in sheets:
+            self.logger.info(f"Invalidating snapshot of sheet {name}")
+            self._sheets.pop(name, None)
+            for path in self._snapshot_paths(name):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+class LibraryIndex:
+    """
+    LibraryID -> record index over the loaded tabs of the library tracking sheet.
+
+    Library IDs with more than one record are excluded from the index and kept in `duplicates`, so they can be
+    reported once instead of on every lookup.
+    """
+
+    def __init__(self, sheets, library_id_column_name='LibraryID'):
+        tracking_df = pd.concat(list(sheets), ignore_index=True).fillna('')
+        tracking_df = tracking_df[tracking_df[library_id_column_name] != '']
+        duplicated = tracking_df[library_id_column_name].duplicated(keep=False)
+        self.library_id_column_name = library_id_column_name
+        self.duplicates = frozenset(tracking_df.loc[duplicated, library_id_column_name])
+        self.records = tracking_df[~duplicated].set_index(library_id_column_name, drop=False).rename_axis(None)
+
+    def __contains__(self, library_id):
+        return library_id in self.records.index
+
+    def __len__(self):
+        return len(self.records.index)
+
+    def get(self, library_id):
+        # the record (as Series) of a unique library ID, None for unknown or duplicated IDs
+        if library_id in self.records.index:
+            return self.records.loc[library_id]
+        return None
+
+    def find_problems(self, library_ids):
+        """
+        :param library_ids: the library IDs to check
+        :return: tuple of (missing, duplicated) library IDs, each sorted
+        """
+        library_ids = set(library_ids)
+        duplicated = library_ids & self.duplicates
+        missing = {library_id for library_id in library_ids - duplicated if library_id not in self}
+        return sorted(missing), sorted(duplicated)
+
+    def join(self, df, on):
+        # left join the tracking records onto df, matching df[on] against the library IDs
+        return df.merge(self.records, how='left', left_on=on, right_index=True, suffixes=('', '_tracking'))
@@ -1,15 +1,17 @@
 import os
 import sys
 import argparse
-import re
 import csv
+import collections
+import time
 from glob import glob
-from datetime import datetime
+import pandas as pd
 from sample_sheet import SampleSheet
 import logging
 from logging.handlers import RotatingFileHandler
 import gspread  # maybe move to https://github.com/aiguofer/gspread-pandas
-from gspread_pandas import Spread
+from runfolder_name import RunfolderName
+from tracking_sheet import TrackingSheetCache, LibraryIndex, DEFAULT_CACHE_DIR, DEFAULT_CACHE_TTL, DEFAULT_MAX_WORKERS
 from oauth2client.service_account import ServiceAccountCredentials
 
 import warnings
@@ -20,6 +22,7 @@ warnings.simplefilter("ignore")
 
 SHEET_NAME_RUNS = 'Sheet1'
 SHEET_NAME_FAILED = 'Failed Runs'
+LIMS_APPEND_CHUNK_SIZE = 1000  # rows per append request
 DEPLOY_ENV = os.getenv('DEPLOY_ENV')
 if not DEPLOY_ENV:
     raise ValueError("DEPLOY_ENV needs to be set!")
@@ -75,11 +78,6 @@ metadata_column_names = (
     override_cycles_column_name,
     workflow_column_name
 )
-# Instrument ID mapping
-instrument_name = {
-    "A01052": "Po",
-    "A00130": "Baymax"
-}
 
 # column headers of the LIMS spreadsheet (in order!)
 sheet_column_headers = (
@@ -135,9 +133,10 @@ write_csv = False
 creds_file = "/home/limsadmin/.google/google-lims-updater-b50921f70155.json"
 skip_lims_update = False
 failed_run = False
-
-# pre-compile regex patterns
-runfolder_pattern = re.compile('([12][0-9][01][0-9][0123][0-9])_(A01052|A00130)_([0-9]{4})_[A-Z0-9]{10}')
+offline = False
+cache_dir = DEFAULT_CACHE_DIR
+cache_ttl = DEFAULT_CACHE_TTL
+max_fetch_workers = DEFAULT_MAX_WORKERS
 
 
 ################################################################################
@@ -167,18 +166,9 @@ def getLogger():
     return new_logger
 
 
-def get_year_from_lib_id(library_id):
-    # TODO: check library ID format and make sure we have proper years
-    if library_id.startswith('LPRJ'):
-        return '20' + library_id[4:6]
-    else:
-        return '20' + library_id[1:3]
-
-
 def get_library_sheet_from_google(year):
     logger.info(f"Loading tracking data for year {year}")
-    spread = Spread(lab_spreadsheet_id)
-    library_tracking_spreadsheet_df = spread.sheet_to_df(sheet=year, index=0, header_rows=1, start_row=1)
+    library_tracking_spreadsheet_df = tracking_sheet_cache.get_sheet(year, index=0, header_rows=1, start_row=1)
     hit = library_tracking_spreadsheet_df.iloc[0]
     logger.debug(f"First record: {hit}")
     for column_name in metadata_column_names:
@@ -190,24 +180,38 @@ def get_library_sheet_from_google(year):
     return library_tracking_spreadsheet_df
 
 
-def get_meta_data_by_library_id(library_id):
-    year = get_year_from_lib_id(library_id)
-    library_tracking_spreadsheet_df = library_tracking_spreadsheet.get(year)
-    try:
-        hit = library_tracking_spreadsheet_df[library_tracking_spreadsheet_df[library_id_column_name] == library_id]
-    except (KeyError, NameError, TypeError, Exception) as er:
-        logger.error(f"Error trying to find library ID {library_id}! Error: {er}")
-
-    # We expect exactly one matching record, not more, not less!
-    if len(hit) == 1:
-        logger.debug(f"Unique entry found for sample ID {library_id}")
-    elif len(hit) > 1:
+def build_lims_data_rows(samples_df, runfolder, run_number, run_timestamp):
+    # join all samples against the library index at once, instead of looking up one sample at a time
+    missing, duplicated = library_index.find_problems(samples_df['Sample_Name'])
+    for library_id in duplicated:
         logger.error(f"Multiple entries for library ID {library_id}!")
-        raise ValueError(f"Multiple entries for library ID {library_id}!")
-    else:
+    for library_id in missing:
         logger.error(f"No entry for library ID {library_id}")
-        raise ValueError(f"No entry for library ID {library_id}")
-    return hit
+    if missing or duplicated:
+        raise ValueError(f"Library IDs without unique tracking sheet entry: {missing + duplicated}")
+
+    lims_df = library_index.join(samples_df, on='Sample_Name')
+    lims_columns = {
+        illumina_id_column_name: runfolder,
+        run_column_name: run_number,
+        timestamp_column_name: run_timestamp,
+        library_ext_id_column_name: '-',
+        project_custodian_column_name: '-',
+        topup_column_name: '-',
+        secondary_analysis_column_name: '-',
+        tags_column_name: '-',
+        fastq_column_name: lims_df['FastqPattern'],
+        number_fastqs_column_name: lims_df['FastqCount'],
+        results_column_name: '-',
+        trello_column_name: '-',
+        notes_column_name: '-',
+        todo_column_name: '-'
+    }
+    for column_name in sheet_column_headers:
+        if column_name not in lims_columns:
+            lims_columns[column_name] = lims_df[column_name]
+    lims_df = pd.DataFrame(lims_columns, index=lims_df.index, columns=sheet_column_headers)
+    return set(tuple(row) for row in lims_df.astype(object).values.tolist())
 
 
 def write_csv_file(output_file, column_headers, data_rows):
@@ -218,9 +222,23 @@ def write_csv_file(output_file, column_headers, data_rows):
             sheetwriter.writerow(row)
 
 
-def next_available_row(worksheet):
-    str_list = list(filter(None, worksheet.col_values(1)))  # fastest
-    return len(str_list)+1
+def column_letter(column_name):
+    # the A1 notation letters of a LIMS column (A..Z, AA, AB, ...)
+    number = sheet_column_headers.index(column_name) + 1
+    letters = ''
+    while number > 0:
+        number, remainder = divmod(number - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def get_lims_keys(spreadsheet, sheet_name):
+    # (IlluminaID, LibraryID) keys of the rows already in the LIMS, read with a single batch request
+    ranges = [f"'{sheet_name}'!{column_letter(illumina_id_column_name)}:{column_letter(illumina_id_column_name)}",
+              f"'{sheet_name}'!{column_letter(library_id_column_name)}:{column_letter(library_id_column_name)}"]
+    value_ranges = spreadsheet.values_batch_get(ranges, params={'majorDimension': 'COLUMNS'})['valueRanges']
+    columns = [value_range.get('values', [[]])[0] for value_range in value_ranges]
+    return set(zip(*columns))
 
 
 def write_to_google_lims(keyfile, lims_spreadsheet_id, data_rows, failed_run):
@@ -229,21 +247,68 @@ def write_to_google_lims(keyfile, lims_spreadsheet_id, data_rows, failed_run):
     scope = ['https://www.googleapis.com/auth/drive']
     creds = ServiceAccountCredentials.from_json_keyfile_name(keyfile, scope)
     client = gspread.authorize(creds)
-
+    spreadsheet = client.open_by_key(lims_spreadsheet_id)
+    sheet_name = SHEET_NAME_FAILED if failed_run else SHEET_NAME_RUNS
+
+    # skip rows that are already in the LIMS (e.g. from a previous attempt for the same runfolder)
+    lims_keys = get_lims_keys(spreadsheet, sheet_name)
+    illumina_id_idx = sheet_column_headers.index(illumina_id_column_name)
+    library_id_idx = sheet_column_headers.index(library_id_column_name)
+    new_rows = [row for row in sorted(data_rows) if (row[illumina_id_idx], row[library_id_idx]) not in lims_keys]
+    if len(new_rows) < len(data_rows):
+        logger.warning(f"Skipping {len(data_rows) - len(new_rows)} records already present in the LIMS.")
+    if not new_rows:
+        return 0
+
+    # append the rows as a whole (in chunks for very large runs), the API determines the next free row
     params = {
         'valueInputOption': 'USER_ENTERED',
         'insertDataOption': 'INSERT_ROWS'
     }
-    body = {
-        'majorDimension': 'ROWS',
-        'values': list(data_rows)
-    }
-
-    spreadsheet = client.open_by_key(lims_spreadsheet_id)
-    if failed_run:
-        spreadsheet.values_append(SHEET_NAME_FAILED, params, body)
-    else:
-        spreadsheet.values_append(SHEET_NAME_RUNS, params, body)
+    start = time.perf_counter()
+    for chunk_start in range(0, len(new_rows), LIMS_APPEND_CHUNK_SIZE):
+        body = {
+            'majorDimension': 'ROWS',
+            'values': new_rows[chunk_start:chunk_start + LIMS_APPEND_CHUNK_SIZE]
+        }
+        spreadsheet.values_append(sheet_name, params, body)
+    duration = time.perf_counter() - start
+    logger.info(f"Appended {len(new_rows)} records to sheet {sheet_name} in {duration:.2f}s " +
+                f"({len(new_rows) / max(duration, 1e-6):.1f} rows/s)")
+    return len(new_rows)
+
+
+def index_fastqs(runfolder_dir):
+    """
+    Index the FASTQ files of a bcl2fastq output folder in a single walk (<project>/<Sample_ID>/*.fastq.gz).
+    :param runfolder_dir: the bcl2fastq output folder of the run
+    :return: dict of (project, Sample_ID) to a list of (file name, path, size) tuples
+    """
+    fastq_index = collections.defaultdict(list)
+    if not os.path.isdir(runfolder_dir):
+        logger.warning(f"bcl2fastq output folder {runfolder_dir} does not exist!")
+        return fastq_index
+    with os.scandir(runfolder_dir) as project_entries:
+        for project_entry in project_entries:
+            if not project_entry.is_dir():
+                continue
+            with os.scandir(project_entry.path) as sample_entries:
+                for sample_entry in sample_entries:
+                    if not sample_entry.is_dir():
+                        continue
+                    with os.scandir(sample_entry.path) as file_entries:
+                        for file_entry in file_entries:
+                            if file_entry.name.endswith('.fastq.gz') and file_entry.is_file():
+                                fastq_index[(project_entry.name, sample_entry.name)].append(
+                                    (file_entry.name, file_entry.path, file_entry.stat().st_size))
+    logger.info(f"Indexed {sum(len(fastqs) for fastqs in fastq_index.values())} FASTQ files " +
+                f"of {len(fastq_index)} samples in {runfolder_dir}")
+    return fastq_index
+
+
+def get_fastqs(fastq_index, project, sample_id, sample_name):
+    # equivalent of glob(<project>/<sample_id>/<sample_name>*.fastq.gz) against the FASTQ index
+    return [fastq for fastq in fastq_index.get((project, sample_id), ()) if fastq[0].startswith(sample_name)]
 
 
 def split_at(s, c, n):
@@ -286,6 +351,19 @@ if __name__ == "__main__":
                         help="Use this flag to skip the update of the Google LIMS.")
     parser.add_argument('--failed-run', action='store_true',
                         help="Use this flag to indicate a failed run (updates the Failed Runs sheet).")
+    parser.add_argument('--offline', action='store_true',
+                        help="Only use the local snapshot of the library tracking sheet and skip the LIMS update.")
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help="Discard the local snapshot of the library tracking sheet before loading it.")
+    parser.add_argument('--cache-dir',
+                        help="Where to keep the local snapshot of the library tracking sheet.",
+                        default=cache_dir)
+    parser.add_argument('--cache-ttl', type=int,
+                        help="Maximum age (in seconds) of the local snapshot of the library tracking sheet.",
+                        default=cache_ttl)
+    parser.add_argument('--max-fetch-workers', type=int,
+                        help="Maximum number of library tracking sheet tabs to fetch concurrently.",
+                        default=max_fetch_workers)
 
     logger.debug("Parsing arguments.")
     args = parser.parse_args()
@@ -307,6 +385,15 @@ if __name__ == "__main__":
         skip_lims_update = True
     if args.failed_run:
         failed_run = True
+    if args.offline:
+        offline = True
+        skip_lims_update = True
+    if args.cache_dir:
+        cache_dir = args.cache_dir
+    if args.cache_ttl is not None:
+        cache_ttl = args.cache_ttl
+    if args.max_fetch_workers:
+        max_fetch_workers = args.max_fetch_workers
     runfolder = args.runfolder
 
     # extract date and run number from runfolder name
@@ -314,34 +401,36 @@ if __name__ == "__main__":
     if len(runfolder) != runfolder_name_expected_length:
         raise ValueError(f"Runfolder name {runfolder} did not match the expected \
                           length of {runfolder_name_expected_length} characters!")
-    try:
-        run_date = re.search(runfolder_pattern, runfolder).group(1)
-        run_inst_id = re.search(runfolder_pattern, runfolder).group(2)
-        run_no = re.search(runfolder_pattern, runfolder).group(3)
-    except AttributeError:
-        raise ValueError(f"Runfolder name {runfolder} did not match expected format: {runfolder_pattern}")
-
-    run_timestamp = datetime.strptime(run_date, '%y%m%d').strftime('%Y-%m-%d')
-    run_year = datetime.strptime(run_date, '%y%m%d').strftime('%Y')
-    run_number = int(run_no)
+    runfolder_name = RunfolderName.parse(runfolder)
+
+    run_timestamp = runfolder_name.timestamp
+    run_year = runfolder_name.year
+    run_number = runfolder_name.run_number
     logger.info(f"Extracted run number/year/timestamp: {run_number}/{run_year}/{run_timestamp}")
-    logger.info(f"Extracted instrument ID: {run_inst_id} ({instrument_name[run_inst_id]})")
+    logger.info(f"Extracted instrument ID: {runfolder_name.instrument_id} ({runfolder_name.instrument_name})")
 
     # set raw data base path according to instrument
-    runfolder_base_dir = os.path.join(raw_data_base_dir, instrument_name[run_inst_id])
+    runfolder_base_dir = os.path.join(raw_data_base_dir, runfolder_name.instrument_name)
 
     # load the library tracking sheet for the run year
     logger.debug("Loading library tracking data.")
+    tracking_sheet_cache = TrackingSheetCache(lab_spreadsheet_id, cache_dir=cache_dir, ttl=cache_ttl,
+                                              offline=offline, max_workers=max_fetch_workers, logger=logger)
+    if args.refresh_cache:
+        tracking_sheet_cache.invalidate()
     # global variables
     # TODO: should be refactored in proper class variables
     library_tracking_spreadsheet = dict()  # dict of sheets as dataframes
-    for year in ('2019', '2020', '2021'):  # TODO: this could be determined scanning though all SampleSheets
+    years = ('2019', '2020', '2021')  # TODO: this could be determined scanning though all SampleSheets
+    tracking_sheet_cache.get_sheets(years, index=0, header_rows=1, start_row=1)  # concurrent fetch
+    for year in years:
         library_tracking_spreadsheet[year] = get_library_sheet_from_google(year)
+    library_index = LibraryIndex(library_tracking_spreadsheet.values(), library_id_column_name)
 
     ################################################################################
     # Generate LIMS records from SampleSheet
 
-    lims_data_rows = set()
+    sample_records = list()
 
     if failed_run:
         logger.info("Processing failed run. Using original sample sheet.")
@@ -355,25 +444,23 @@ if __name__ == "__main__":
         raise ValueError("No sample sheets found!")
     logger.info(f"Using {len(samplesheet_paths)} sample sheet(s).")
 
+    # list the bcl2fastq output once, instead of a directory listing per sample
+    fastq_index = index_fastqs(os.path.join(bcl2fastq_base_dir, runfolder))
+
     for samplesheet in samplesheet_paths:
         logger.info(f"Processing samplesheet {samplesheet}")
         name, extension = os.path.splitext(samplesheet)
         samples = SampleSheet(samplesheet).samples
         logger.info(f"Found {len(samples)} samples.")
         for sample in samples:
-            logger.debug(f"Looking up metadata with {sample.Sample_Name} for samplesheet.Sample_ID (UMCCR SampleID); " +
-                         f"{sample.Sample_ID} and samplesheet.sample_Name (UMCCR LibraryID): {sample.Sample_Name}")
-            column_values = get_meta_data_by_library_id(sample.Sample_Name)
-
-            fastq_pattern = os.path.join(bcl2fastq_base_dir, runfolder, sample.Sample_Project,
-                                         sample.Sample_ID, sample.Sample_Name + "*.fastq.gz")
             s3_fastq_pattern = os.path.join(fastq_hpc_base_dir, runfolder, sample.Sample_Project,
                                             sample.Sample_ID, sample.Sample_Name + "*.fastq.gz")
 
-            logger.debug('Looking for FASTQs: ' + fastq_pattern)
-            fastq_file_paths = glob(fastq_pattern)
-            if len(fastq_file_paths) < 1:
+            fastqs = get_fastqs(fastq_index, sample.Sample_Project, sample.Sample_ID, sample.Sample_Name)
+            if len(fastqs) < 1:
                 logger.warn(f"Found no FASTQ files for sample {sample.Sample_ID}!")
+            fastq_bytes = sum(fastq[2] for fastq in fastqs)
+            logger.debug(f"Found {len(fastqs)} FASTQ files ({fastq_bytes} bytes) for sample {sample.Sample_ID}")
 
             # splitting the combined sample name
             if sample.Sample_ID.startswith('NTC') or sample.Sample_ID.startswith('PTC'):
@@ -381,41 +468,15 @@ if __name__ == "__main__":
             else:
                 s_id, es_id = split_at(sample.Sample_ID, '_', 1)
             print(f"Split SampleID {sample.Sample_ID} into intID {s_id} and extID {es_id}")
-            print(f"Inserting values {column_values}")
-            # double check LibraryID
-            if not sample.Sample_Name == column_values[library_id_column_name].item():
-                raise ValueError(f"Library IDs did not match. Samplesheet: {sample.Sample_Name} " +
-                                 f"Tracking sheet: {column_values[library_id_column_name].item()}")
-            lims_data_rows.add((runfolder,
-                                run_number,
-                                run_timestamp,
-                                column_values[subject_id_column_name].item(),
-                                column_values[sample_id_column_name].item(),
-                                column_values[library_id_column_name].item(),
-                                column_values[subject_ext_id_column_name].item(),
-                                column_values[sample_ext_id_column_name].item(),
-                                '-',  # ExternalLibraryID
-                                column_values[sample_name_column_name].item(),
-                                column_values[project_owner_column_name].item(),
-                                column_values[project_name_column_name].item(),
-                                '-',  # ProjectCustodian
-                                column_values[type_column_name].item(),
-                                column_values[assay_column_name].item(),
-                                column_values[override_cycles_column_name].item(),
-                                column_values[phenotype_column_name].item(),
-                                column_values[source_column_name].item(),
-                                column_values[quality_column_name].item(),
-                                '-',  # Topup
-                                '-',  # SecondaryAnalysis
-                                column_values[workflow_column_name].item(),
-                                '-',  # Tags
-                                s3_fastq_pattern,
-                                len(fastq_file_paths),
-                                '-',  # Results
-                                '-',  # Trello
-                                '-',  # Notes
-                                '-'  # ToDo
-                                ))
+            # samplesheet.Sample_Name == UMCCR LibraryID
+            sample_records.append((sample.Sample_Name, s3_fastq_pattern, len(fastqs), fastq_bytes))
+
+    logger.info(f"Looking up metadata for {len(sample_records)} samples.")
+    samples_df = pd.DataFrame(sample_records, columns=['Sample_Name', 'FastqPattern', 'FastqCount', 'FastqBytes'])
+    logger.info(f"Found {samples_df['FastqCount'].sum()} FASTQ files with a total of " +
+                f"{samples_df['FastqBytes'].sum()} bytes for the samples.")
+    lims_data_rows = build_lims_data_rows(samples_df=samples_df, runfolder=runfolder,
+                                          run_number=run_number, run_timestamp=run_timestamp)
 
     ################################################################################
     # write the data into a CSV file
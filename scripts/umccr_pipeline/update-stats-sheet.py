@@ -1,9 +1,12 @@
 import os
 import sys
 import json
+import argparse
 from collections import OrderedDict, Counter
 from openpyxl import load_workbook
 from glob import glob
+from bcl2fastq_stats import merge_stats, GENOME_SIZE
+from runfolder_name import RunfolderName
 import logging
 from logging.handlers import RotatingFileHandler
 
@@ -13,15 +16,23 @@ if not DEPLOY_ENV:
 SCRIPT = os.path.basename(__file__)
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# The run stats are recorded in a Parquet store (one file per run), so an update doesn't depend on the size of the
+# recorded history. The stats workbook is exported from the store on demand (--export-xlsx).
 if DEPLOY_ENV == 'prod':
     LOG_FILE_NAME = os.path.join(SCRIPT_DIR, SCRIPT + ".log")
     stats_workbook_name = '/storage/shared/dev/AH-supplied-Baymax-Run-Stats-automated.xlsx'
+    stats_store_dir = '/storage/shared/dev/AH-supplied-Baymax-Run-Stats-automated.store'
 else:
     LOG_FILE_NAME = os.path.join(SCRIPT_DIR, SCRIPT + ".dev.log")
     stats_workbook_name = '/storage/shared/dev/AH-supplied-Baymax-Run-Stats-automated.dev.xlsx'
+    stats_store_dir = '/storage/shared/dev/AH-supplied-Baymax-Run-Stats-automated.dev.store'
 
-GENOME_SIZE = 3200000000
-LANES = [1, 2, 3, 4]
+# Columns of the run stats sheet (see Bcl2fastqStats.prepare_rows)
+STATS_COLUMNS = ['RunID', 'SampleID', 'SampleName',
+                 'Lane1Reads', 'Lane1Fraction', 'Lane2Reads', 'Lane2Fraction',
+                 'Lane3Reads', 'Lane3Fraction', 'Lane4Reads', 'Lane4Fraction',
+                 'TotalReads', 'TotalFraction', 'GenomeEquivalents']
+PERCENTAGE_COLUMNS = ('E', 'G', 'I', 'K', 'M')
 
 
 def getLogger():
@@ -42,277 +53,6 @@ def getLogger():
     return new_logger
 
 
-class Bcl2fastqStats:
-
-    separator = "\t"
-
-    def __init__(self, stats_file):
-        self.stats_file_name = stats_file
-        with open(stats_json) as fp:
-            data = json.load(fp)
-
-            self.flowcell = data[u'Flowcell']  # str
-            self.run_number = data[u'RunNumber']  # int
-            self.run_id = data[u'RunId']
-            self.samples_in_lanes = {}
-
-            # conversion results
-            self.total_reads_PF = 0
-            self.total_bases_PF = 0
-            conversion_stats = data[u'ConversionResults']
-            self.lane_stats = {}
-            for lane_number in LANES:
-                self.lane_stats[lane_number] = {'reads_raw': 0, 'reads_PF': 0, 'bases_PF': 0, 'reads_undetermined': 0,
-                                                'bases_undetermined': 0, 'reads_demuxed': 0, 'bases_demuxed': 0,
-                                                'samples': {}}
-
-            for lane_stat in conversion_stats:
-                lane_number = lane_stat[u'LaneNumber']
-                self.lane_stats[lane_number]['reads_raw'] = lane_stat[u'TotalClustersRaw']
-                self.lane_stats[lane_number]['reads_PF'] = lane_stat[u'TotalClustersPF']
-                self.lane_stats[lane_number]['bases_PF'] = lane_stat[u'Yield']
-                self.lane_stats[lane_number]['reads_undetermined'] = lane_stat[u'Undetermined'][u'NumberReads']
-                self.lane_stats[lane_number]['bases_undetermined'] = lane_stat[u'Undetermined'][u'Yield']
-
-                self.total_reads_PF += self.lane_stats[lane_number]['reads_PF']
-                self.total_bases_PF += self.lane_stats[lane_number]['bases_PF']
-
-                demux_results = lane_stat[u'DemuxResults']
-                for sample_stat in demux_results:
-                    sample_id = sample_stat[u'SampleId']
-                    sample_name = sample_stat[u'SampleName']
-                    sample_reads = sample_stat[u'NumberReads']
-                    sample_bases = sample_stat[u'Yield']
-
-                    self.lane_stats[lane_number]['samples'][(sample_id, sample_name)] = {'reads': sample_reads,
-                                                                                         'bases': sample_bases}
-                    self.lane_stats[lane_number]['reads_demuxed'] += sample_reads
-                    self.lane_stats[lane_number]['bases_demuxed'] += sample_bases
-
-                    if self.samples_in_lanes.get((sample_id, sample_name)) is None:
-                        self.samples_in_lanes[(sample_id, sample_name)] = [
-                            0] * len(LANES)
-                    self.samples_in_lanes[(
-                        sample_id, sample_name)][lane_number-1] = 1
-
-    def get_total_bases_undetermined(self):
-        return sum([self.lane_stats[lane_number]['bases_undetermined'] for lane_number in LANES])
-
-    def merge(self, other):
-        if self.run_id != other.run_id:
-            return False
-
-        # check other metrics
-        for lane_number, lane_stat in other.lane_stats.items():
-            # other.lane_stats[lane_number] == lane_stat ??
-            
-            s_lane_stat = self.lane_stats[lane_number]
-            if lane_stat['reads_PF'] == 0:
-                continue
-
-            if lane_stat['reads_PF'] != s_lane_stat['reads_PF']:
-                raise Exception(f"Read PF are not the same - Lane {lane_number}. \
-                                  Reads 'self' = {s_lane_stat['reads_PF']}, \
-                                  'other' = {lane_stat['reads_PF']}")
-            # if s_lane_stat['reads_PF'] == lane_stat['reads_PF']:
-            else:
-                # assert s_lane_stat['reads_PF'] == lane_stat['reads_PF']
-                if s_lane_stat['bases_PF'] != lane_stat['bases_PF']:
-                    raise Exception(f"[{self.run_id}] Base accounting failed - \
-                                        {s_lane_stat['bases_PF']} vs \
-                                        {lane_stat['bases_PF']}")
-
-                undetermined_self = s_lane_stat['reads_undetermined'] - \
-                    lane_stat['reads_demuxed']
-                undetermined_other = lane_stat['reads_undetermined'] - \
-                    s_lane_stat['reads_demuxed']
-
-                if undetermined_self != undetermined_other:
-                    raise Exception(f"Mismatch of undetermined reads after matching up demultiplexed reads - \
-                                     Lane {lane_number}")
-
-                # update the undetermined reads
-                s_lane_stat['reads_undetermined'] = undetermined_self
-                s_lane_stat['bases_undetermined'] = s_lane_stat['bases_undetermined'] - \
-                    lane_stat['bases_demuxed']
-
-                # update the demultiplexed reads
-                s_lane_stat['reads_demuxed'] += lane_stat['reads_demuxed']
-                s_lane_stat['bases_demuxed'] += lane_stat['bases_demuxed']
-
-                # add samples in 'other' into 'self'
-                for sample, sample_info in lane_stat['samples'].items():
-                    # print(sample, sample_info)
-                    if s_lane_stat['samples'].get(sample) is None:
-                        s_lane_stat['samples'][sample] = {
-                            'reads': 0, 'bases': 0}
-                    s_lane_stat['samples'][sample]['reads'] += sample_info['reads']
-                    s_lane_stat['samples'][sample]['bases'] += sample_info['bases']
-                    # print(sample, sample_info)
-
-        for sample, membership in other.samples_in_lanes.items():
-            self.samples_in_lanes[sample] = membership
-
-        return True
-
-    def __hash__(self):
-        return hash(self.run_id)
-
-    def __cmp__(self, other):
-        return cmp(self.run_id, other.run_id)
-
-    def prepare_output(self):
-        all_sample_names = sorted(
-            self.samples_in_lanes.items(), key=lambda kv: kv[1], reverse=True)
-        all_lanes = set([])
-        for lane_number, lane_data in self.lane_stats.items():
-            all_lanes.add(lane_number)
-        all_lanes = sorted(list(all_lanes))
-
-        total_genome_equivalent = 0
-        output = []
-        for sample_id_value, sample_lane_membership in all_sample_names:
-            sample_id, sample_name = sample_id_value
-            row = [self.run_id, sample_id, sample_name]
-            total_sample_reads = 0
-            total_sample_bases = 0
-            for lane_number in all_lanes:
-                lane_data = self.lane_stats.get(lane_number)
-
-                sample_reads = lane_data['samples'].get(
-                    (sample_id, sample_name))
-                if sample_reads is not None:
-                    row += ['{:,}'.format(sample_reads['reads']), '{:.2%}'.format(
-                        sample_reads['reads']/float(lane_data['reads_PF']))]
-                    total_sample_reads += sample_reads['reads']
-                    total_sample_bases += sample_reads['bases']
-                else:
-                    # row += ['{:,}'.format(0), '{:.2%}'.format(0.0)]
-                    row += ['.', '.']
-
-            genome_equivalent = total_sample_bases/float(GENOME_SIZE)
-            total_genome_equivalent += genome_equivalent
-            row += ['{:,}'.format(total_sample_reads), '{:.2%}'.format(
-                total_sample_reads/float(self.total_reads_PF))]
-            row += ['{:.2f}'.format(genome_equivalent)]
-            row_str = self.separator.join([str(v) for v in row])
-            output.append(row_str)
-
-        total_undetermined = 0
-        total_PF = 0
-        row = [self.run_id, 'Undetermined', 'Undetermined']
-        total = [self.run_id, '.', 'TOTAL']
-        for lane_number in all_lanes:
-            lane_data = self.lane_stats.get(lane_number)
-            if lane_data['reads_PF'] == 0:
-                row += ['.', '.']
-            else:
-                row += ['{:,}'.format(lane_data['reads_undetermined']), '{:.2%}'.format(
-                    lane_data['reads_undetermined']/float(lane_data['reads_PF']))]
-
-            if lane_data['reads_PF'] == 0:
-                total += ['.', '.']
-            else:
-                total_undetermined += lane_data['reads_undetermined']
-                total_PF += lane_data['reads_PF']
-                total += ['{:,}'.format(lane_data['reads_PF']), '{:.2%}'.format(
-                    lane_data['reads_PF']/float(self.total_reads_PF))]
-
-        genome_equivalent = self.get_total_bases_undetermined()/float(GENOME_SIZE)
-        total_genome_equivalent += genome_equivalent
-        row += ['{:,}'.format(total_undetermined),
-                '{:.2%}'.format(total_undetermined/float(total_PF))]
-        row += ['{:.2f}'.format(genome_equivalent)]
-        row_str = self.separator.join([str(v) for v in row])
-        total += ['{:,}'.format(total_PF),
-                  '{:.2%}'.format(total_PF/float(self.total_reads_PF))]
-        total += ['{:.2f}'.format(total_genome_equivalent)]
-        total_str = self.separator.join([str(v) for v in total])
-
-        output.append(row_str)
-        output.append(total_str)
-
-        return output
-
-    def __str__(self):
-        output = self.prepare_output()
-        return '\n'.join(output)
-
-    def prepare_rows(self):
-        all_sample_names = sorted(
-            self.samples_in_lanes.items(), key=lambda kv: kv[1], reverse=True)
-        all_lanes = set([])
-        for lane_number, lane_data in self.lane_stats.items():
-            all_lanes.add(lane_number)
-        all_lanes = sorted(list(all_lanes))
-
-        total_genome_equivalent = 0
-        output = []
-        for sample_id_value, sample_lane_membership in all_sample_names:
-            sample_id, sample_name = sample_id_value
-            row = [self.run_id, sample_id, sample_name]
-            total_sample_reads = 0
-            total_sample_bases = 0
-            for lane_number in all_lanes:
-                lane_data = self.lane_stats.get(lane_number)
-
-                sample_reads = lane_data['samples'].get(
-                    (sample_id, sample_name))
-                if sample_reads is not None:
-                    row.append(sample_reads['reads'])
-                    row.append(sample_reads['reads']/float(lane_data['reads_PF']))
-                    total_sample_reads += sample_reads['reads']
-                    total_sample_bases += sample_reads['bases']
-                else:
-                    # row += ['{:,}'.format(0), '{:.2%}'.format(0.0)]
-                    row.append(0)
-                    row.append(0)
-
-            genome_equivalent = total_sample_bases/float(GENOME_SIZE)
-            total_genome_equivalent += genome_equivalent
-            row.append(total_sample_reads)
-            row.append(total_sample_reads/float(self.total_reads_PF))
-            row.append(genome_equivalent)
-            output.append(row)
-
-        total_undetermined = 0
-        total_PF = 0
-        undet_row = [self.run_id, 'Undetermined', 'Undetermined']
-        total_row = [self.run_id, '.', 'TOTAL']
-        for lane_number in all_lanes:
-            lane_data = self.lane_stats.get(lane_number)
-            if lane_data['reads_PF'] == 0:
-                undet_row.append(0)
-                undet_row.append(0)
-            else:
-                undet = lane_data['reads_undetermined']
-                undet_row.append(undet)
-                undet_row.append(undet/float(lane_data['reads_PF']))
-
-            if lane_data['reads_PF'] == 0:
-                total_row.append(0)
-                total_row.append(0)
-            else:
-                total_undetermined += lane_data['reads_undetermined']
-                total_PF += lane_data['reads_PF']
-                total_row.append(lane_data['reads_PF'])
-                total_row.append(lane_data['reads_PF']/float(self.total_reads_PF))
-
-        genome_equivalent = self.get_total_bases_undetermined()/float(GENOME_SIZE)
-        total_genome_equivalent += genome_equivalent
-        undet_row.append(total_undetermined)
-        undet_row.append(total_undetermined/float(total_PF))
-        undet_row.append(genome_equivalent)
-        output.append(undet_row)
-
-        total_row.append(total_PF)
-        total_row.append(total_PF/float(self.total_reads_PF))
-        total_row.append(total_genome_equivalent)
-        output.append(total_row)
-
-        return output
-
-
 def sample_name_cmp(item1, item2):
     return cmp(item1[0], item2[0])
 
@@ -361,75 +101,182 @@ def get_stats(stats_json):
         print()
 
 
+def get_run_year(run_id):
+    try:
+        return RunfolderName.parse(run_id).year
+    except ValueError:
+        # unknown instrument, but runfolder names still start with the run date (YYMMDD)
+        return '20' + run_id[:2]
+
+
+def total_per_lane_row(block_start, block_end):
+    return ['', '', '',
+            'total per lane', f"=SUM(E{block_start}:E{block_end})",
+            '', f"=SUM(G{block_start}:G{block_end})",
+            '', f"=SUM(I{block_start}:I{block_end})",
+            '', f"=SUM(K{block_start}:K{block_end})",
+            '', '', '']
+
+
+def append_to_workbook(workbook_name, all_stats):
+    # append the rows of each run to the sheet of the run year, only touching the appended rows
+    # NOTE: openpyxl has to load (and save) the whole workbook, so this gets slower with every recorded run
+    workbook = load_workbook(workbook_name)
+    stats_by_year = OrderedDict()
+    for stats in all_stats:
+        stats_by_year.setdefault(get_run_year(stats.run_id), []).append(stats)
+
+    for year, year_stats in stats_by_year.items():
+        if year in workbook.sheetnames:
+            worksheet = workbook[year]
+        else:
+            logger.info(f"Creating sheet {year}")
+            worksheet = workbook.create_sheet(year)
+            worksheet.append(STATS_COLUMNS)
+
+        current_rows = worksheet.max_row  # record the number of existing rows
+        logger.debug(f"Appending data to sheet {year} after row {current_rows}")
+        new_rows = 0
+        for stats in year_stats:
+            rows = stats.prepare_rows()
+            new_rows += len(rows)
+            for row in rows:
+                worksheet.append(row)
+
+        block_start = current_rows + 1
+        block_end = current_rows + new_rows - 1  # step one row back to exclude total
+        logger.debug("Adding per lane totals")
+        worksheet.append(total_per_lane_row(block_start, block_end))
+
+        # Format the appended cells as Percentage
+        logger.debug(f"Updating cell format (set percentage) of rows {block_start}-{worksheet.max_row}")
+        for row in range(block_start, worksheet.max_row + 1):
+            for column in PERCENTAGE_COLUMNS:
+                worksheet[f"{column}{row}"].number_format = "0.00%"
+
+    logger.info("Saving workbook")
+    workbook.save(workbook_name)
+
+
+def write_run_to_store(store_dir, run_id, rows):
+    import pandas as pd
+    year_dir = os.path.join(store_dir, get_run_year(run_id))
+    os.makedirs(year_dir, exist_ok=True)
+    run_file = os.path.join(year_dir, run_id + '.parquet')
+    logger.info(f"Writing stats of run {run_id} to {run_file}")
+    pd.DataFrame(rows, columns=STATS_COLUMNS).to_parquet(run_file, index=False)
+
+
+def write_to_store(store_dir, all_stats):
+    # one Parquet file per run and year, so the cost of an update doesn't grow with the recorded history
+    for stats in all_stats:
+        write_run_to_store(store_dir, stats.run_id, stats.prepare_rows())
+
+
+def import_workbook(workbook_name, store_dir):
+    # seed the store with the runs recorded in an existing stats workbook (the per lane totals are not imported,
+    # the export adds them again); runs already in the store are kept
+    workbook = load_workbook(workbook_name, read_only=True)
+    runs = OrderedDict()
+    for worksheet in workbook.worksheets:
+        for row in worksheet.iter_rows(min_row=2, max_col=len(STATS_COLUMNS), values_only=True):
+            if not row or not row[0]:
+                continue  # per lane totals and empty rows
+            values = list(row) + [None] * (len(STATS_COLUMNS) - len(row))
+            runs.setdefault(str(values[0]), []).append(
+                [str(value) if value is not None else '' for value in values[:3]] +
+                [value if isinstance(value, (int, float)) else None for value in values[3:]])
+    workbook.close()
+
+    imported = 0
+    for run_id, rows in runs.items():
+        if glob(os.path.join(store_dir, '*', run_id + '.parquet')):
+            logger.info(f"Run {run_id} is already in the store, not importing it")
+            continue
+        write_run_to_store(store_dir, run_id, rows)
+        imported += 1
+    logger.info(f"Imported {imported} of {len(runs)} runs from {workbook_name}")
+
+
+def formatted_cells(worksheet, row):
+    # write-only rows, with the same percentage format append_to_workbook applies
+    from openpyxl.cell import WriteOnlyCell
+    cells = [WriteOnlyCell(worksheet, value=value) for value in row]
+    for column in PERCENTAGE_COLUMNS:
+        cells[ord(column) - ord('A')].number_format = "0.00%"
+    return cells
+
+
+def export_store(store_dir, workbook_name):
+    # (re)create the stats workbook from the Parquet store, one sheet per year
+    import pandas as pd
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    for year in sorted(os.listdir(store_dir)):
+        worksheet = workbook.create_sheet(year)
+        worksheet.append(STATS_COLUMNS)
+        current_rows = 1
+        for run_file in sorted(glob(os.path.join(store_dir, year, '*.parquet'))):
+            rows = pd.read_parquet(run_file).values.tolist()
+            for row in rows:
+                worksheet.append(formatted_cells(worksheet, row))
+            worksheet.append(formatted_cells(worksheet, total_per_lane_row(current_rows + 1,
+                                                                           current_rows + len(rows) - 1)))
+            current_rows += len(rows) + 1
+        logger.info(f"Exported {current_rows - 1} rows to sheet {year}")
+    logger.info(f"Saving workbook {workbook_name}")
+    workbook.save(workbook_name)
+
+
 if __name__ == '__main__':
     logger = getLogger()
     logger.info(f"Invocation with parameters: {sys.argv[1:]}")
 
-    if len(sys.argv) > 1:
+    parser = argparse.ArgumentParser(description='Add bcl2fastq stats to the run stats store.')
+    parser.add_argument('stats_jsons', nargs='*',
+                        help="Stats.json files (or glob patterns). Read from stdin if none are given.")
+    parser.add_argument('--store-dir', default=stats_store_dir,
+                        help=f"The Parquet store the stats are written to (default: {stats_store_dir}).")
+    parser.add_argument('--export-xlsx', nargs='?', const=stats_workbook_name,
+                        help=f"Export the store to this workbook (default: {stats_workbook_name}) and exit.")
+    parser.add_argument('--import-xlsx',
+                        help="Add the runs of this (previously updated) stats workbook to the store and exit.")
+    parser.add_argument('--append-xlsx', action='store_true',
+                        help=f"Append the stats to {stats_workbook_name} directly instead of writing them to the " +
+                             "store (loads the whole workbook).")
+    args = parser.parse_args()
+
+    if args.import_xlsx:
+        import_workbook(args.import_xlsx, args.store_dir)
+        logger.info("All done.")
+        sys.exit(0)
+
+    if args.export_xlsx:
+        export_store(args.store_dir, args.export_xlsx)
+        logger.info("All done.")
+        sys.exit(0)
+
+    if args.stats_jsons:
         stats_jsons = set()
-        for pattern in sys.argv[1:]:
+        for pattern in args.stats_jsons:
             stats_jsons.update(glob(pattern))
     else:
         stats_jsons = []
         for stats_json in sys.stdin:
             stats_jsons.append(stats_json.strip())
 
-    all_stats = []
-    for stats_json in stats_jsons:
-        logger.info(f"Processing {stats_json}")
-        # get_stats(stats_json)
-        stats = Bcl2fastqStats(stats_json)
-        stats.separator = ';'
-
-        merged = False
-        for stat in all_stats:
-            if stat.merge(stats):
-                merged = True
-
-        if not merged:
-            all_stats.append(stats)
+    # stats of split runs are merged per run ID
+    logger.info(f"Processing {len(stats_jsons)} Stats.json files: {stats_jsons}")
+    all_stats = merge_stats(stats_jsons)
 
     for stats in all_stats:
+        stats.separator = ';'
         print(stats)
         print()
 
-    logger.info(f"Updating stats sheet {stats_workbook_name}")
-    workbook = load_workbook(stats_workbook_name)
-    # TODO: extract sheet name from workbook name/path (contains run name, which contains the run year)
-    worksheet = workbook.get_sheet_by_name('2019')
-
-    current_rows = worksheet.max_row  # record the number of existing rows
-    logger.debug(f"Appending data after row {current_rows}")
-    new_rows = 0
-    for stats in all_stats:
-        rows = stats.prepare_rows()
-        new_rows += len(rows)
-        for row in rows:
-            worksheet.append(row)
-
-    block_start = current_rows + 1
-    block_end = current_rows + new_rows - 1  # step one row back to exclude total
-    logger.debug("Adding per lane totals")
-    worksheet.append(['', '', '',
-                      'total per lane', f"=SUM(E{block_start}:E{block_end})",
-                      '', f"=SUM(G{block_start}:G{block_end})",
-                      '', f"=SUM(I{block_start}:I{block_end})",
-                      '', f"=SUM(K{block_start}:K{block_end})",
-                      '', '', ''])
-
-    # Format cells as Percentage
-    logger.debug("Updating cell format (set percentage)")
-    for cell in worksheet['E']:
-        cell.number_format = "0.00%"
-    for cell in worksheet['G']:
-        cell.number_format = "0.00%"
-    for cell in worksheet['I']:
-        cell.number_format = "0.00%"
-    for cell in worksheet['K']:
-        cell.number_format = "0.00%"
-    for cell in worksheet['M']:
-        cell.number_format = "0.00%"
-
-    logger.info("Saving workbook")
-    workbook.save(stats_workbook_name)
+    if args.append_xlsx:
+        logger.info(f"Updating stats sheet {stats_workbook_name}")
+        append_to_workbook(stats_workbook_name, all_stats)
+    else:
+        write_to_store(args.store_dir, all_stats)
     logger.info("All done.")
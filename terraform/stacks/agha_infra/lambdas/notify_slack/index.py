@@ -1,6 +1,6 @@
 import os
 import json
-import http.client
+from slack_client import SlackClient
 import boto3
 
 iam_client = boto3.client('iam')
@@ -8,14 +8,11 @@ iam_client = boto3.client('iam')
 slack_host = os.environ.get("SLACK_HOST")
 slack_webhook_endpoint = os.environ.get("SLACK_WEBHOOK_ENDPOINT")
 slack_channel = os.environ.get("SLACK_CHANNEL")
-headers = {
-    'Content-Type': 'application/json',
-}
 
+slack_client = SlackClient(slack_host, webhook_endpoint=slack_webhook_endpoint)
 
-def call_slack_webhook(topic, title, message):
-    connection = http.client.HTTPSConnection(slack_host)
 
+def call_slack_webhook(topic, title, message):
     # TODO: make more generic/customisable
     post_data = {
         "channel": slack_channel,
@@ -28,11 +25,7 @@ def call_slack_webhook(topic, title, message):
         }]
     }
 
-    connection.request("POST", slack_webhook_endpoint, json.dumps(post_data), headers)
-    response = connection.getresponse()
-    connection.close()
-
-    return response.status
+    return slack_client.post(post_data)
 
 
 def get_username_from_userid(user_id):
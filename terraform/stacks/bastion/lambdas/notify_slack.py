@@ -1,18 +1,15 @@
 import os
 import json
-import http.client
+from slack_client import SlackClient
 
 slack_host = os.environ.get("SLACK_HOST")
 slack_webhook_endpoint = os.environ.get("SLACK_WEBHOOK_ENDPOINT")
 slack_channel = os.environ.get("SLACK_CHANNEL")
-headers = {
-    'Content-Type': 'application/json',
-}
 
+slack_client = SlackClient(slack_host, webhook_endpoint=slack_webhook_endpoint)
 
-def call_slack_webhook(topic, title, message):
-    connection = http.client.HTTPSConnection(slack_host)
 
+def call_slack_webhook(topic, title, message):
     # TODO: make more generic/customisable
     post_data = {
         "channel": slack_channel,
@@ -25,11 +22,7 @@ def call_slack_webhook(topic, title, message):
         }]
     }
 
-    connection.request("POST", slack_webhook_endpoint, json.dumps(post_data), headers)
-    response = connection.getresponse()
-    connection.close()
-
-    return response.status
+    return slack_client.post(post_data)
 
 
 def lambda_handler(event, context):
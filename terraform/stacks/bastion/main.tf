@@ -217,7 +217,7 @@ module "notify_slack_lambda" {
   runtime       = "python3.6"
   timeout       = 3
 
-  source_path = "${path.module}/lambdas/notify_slack.py"
+  source_path = "${path.module}/lambdas"
 
   environment {
     variables {
@@ -436,7 +436,7 @@ module "notify_slack_lambda" {
   runtime       = "python3.6"
   timeout       = 10
 
-  source_path = "${path.module}/lambdas/notify_slack.py"
+  source_path = "${path.module}/lambdas"
 
   environment {
     variables {
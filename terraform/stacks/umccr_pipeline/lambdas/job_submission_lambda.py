@@ -1,7 +1,8 @@
 import boto3
 import os
 import json
-import re
+import time
+from runfolder_name import RunfolderName
 
 SSM_DOC_NAME = os.environ.get("SSM_DOC_NAME")
 DEPLOY_ENV = os.environ.get("DEPLOY_ENV")
@@ -12,24 +13,41 @@ BASTION_SSM_ROLE_ARN = os.environ.get("BASTION_SSM_ROLE_ARN")
 ssm_client = boto3.client('ssm')
 states_client = boto3.client('stepfunctions')
 
-# pre-compile regex patterns
-runfolder_pattern = re.compile('([12][0-9][01][0-9][0123][0-9])_(A01052|A00130)_([0-9]{4})_[A-Z0-9]{10}')
 
-# Instrument ID mapping
-instrument_name = {
-    "A01052": "Po",
-    "A00130": "Baymax"
-}
+CONFIG_TTL = int(os.environ.get("CONFIG_TTL", "300"))  # seconds the SSM parameters are cached in warm containers
 
 
-def getSSMParam(name):
+class SSMConfig:
     """
-    Fetch the parameter with the given name from SSM Parameter Store.
+    The parameters below a path prefix of SSM Parameter Store.
+
+    All parameters are fetched with (paginated) GetParametersByPath calls on first access and kept for TTL seconds,
+    so warm invocations don't go back to SSM and a cold start doesn't have to wait for one request per parameter.
     """
-    return ssm_client.get_parameter(
-                Name=name,
-                WithDecryption=True
-           )['Parameter']['Value']
+
+    def __init__(self, prefix, ttl=CONFIG_TTL):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.parameters = None
+        self.loaded = 0
+
+    def load(self):
+        start = time.perf_counter()
+        parameters = dict()
+        paginator = ssm_client.get_paginator('get_parameters_by_path')
+        for page in paginator.paginate(Path=self.prefix, Recursive=True, WithDecryption=True):
+            for parameter in page['Parameters']:
+                parameters[parameter['Name'][len(self.prefix):]] = parameter['Value']
+        self.parameters = parameters
+        self.loaded = time.time()
+        print(f"Loaded {len(parameters)} SSM parameters from {self.prefix} in {time.perf_counter() - start:.3f}s")
+
+    def __getitem__(self, name):
+        if self.parameters is None or time.time() - self.loaded > self.ttl:
+            self.load()
+        if name not in self.parameters:
+            raise ValueError(f"SSM parameter {self.prefix}{name} not found!")
+        return self.parameters[name]
 
 
 # We could use the in-command notation for Parameter Store parameters as explained here:
@@ -38,25 +56,7 @@ def getSSMParam(name):
 #   command += f" python {{{{ssm:{SSM_PARAM_PREFIX}samplesheet_check_script_plain}}}} {samplesheet_path} ..."
 # However, that does not suppport encrypted parameters!
 # Therefore we have to fetch the parameters ourselves
-ssm_instance_id = getSSMParam(SSM_PARAM_PREFIX + "ssm_instance_id")
-runfolder_base_path = getSSMParam(SSM_PARAM_PREFIX + "runfolder_base_path")
-bcl2fastq_base_path = getSSMParam(SSM_PARAM_PREFIX + "bcl2fastq_base_path")
-hpc_dest_base_path = getSSMParam(SSM_PARAM_PREFIX + "hpc_dest_base_path")
-runfolder_check_script = getSSMParam(SSM_PARAM_PREFIX + "runfolder_check_script")
-samplesheet_check_script = getSSMParam(SSM_PARAM_PREFIX + "samplesheet_check_script")
-bcl2fastq_script = getSSMParam(SSM_PARAM_PREFIX + "bcl2fastq_script")
-checksum_script = getSSMParam(SSM_PARAM_PREFIX + "checksum_script")
-hpc_sync_script = getSSMParam(SSM_PARAM_PREFIX + "hpc_sync_script")
-s3_sync_script = getSSMParam(SSM_PARAM_PREFIX + "s3_sync_script")
-lims_update_script = getSSMParam(SSM_PARAM_PREFIX + "lims_update_script")
-multiqc_script = getSSMParam(SSM_PARAM_PREFIX + "multiqc_script")
-stats_update_script = getSSMParam(SSM_PARAM_PREFIX + "stats_update_script")
-hpc_sync_dest_host = getSSMParam(SSM_PARAM_PREFIX + "hpc_sync_dest_host")
-HPC_SSH_USER = getSSMParam(SSM_PARAM_PREFIX + "hpc_sync_ssh_user")
-aws_profile = getSSMParam(SSM_PARAM_PREFIX + "aws_profile")
-aws_profile_spartan = getSSMParam(SSM_PARAM_PREFIX + "aws_profile_spartan")
-s3_sync_dest_bucket = getSSMParam(SSM_PARAM_PREFIX + "s3_sync_dest_bucket")
-s3_raw_data_bucket = getSSMParam(SSM_PARAM_PREFIX + "s3_raw_data_bucket")
+config = SSMConfig(SSM_PARAM_PREFIX)
 
 
 def build_command(script_case, input_data):
@@ -71,18 +71,13 @@ def build_command(script_case, input_data):
     else:
         raise ValueError('A runfolder parameter is mandatory!')
 
-    # TODO: PO: extract instrument ID from runfolder and deduct runfolder base path
-    try:
-        run_date = re.search(runfolder_pattern, runfolder).group(1)
-        run_inst_id = re.search(runfolder_pattern, runfolder).group(2)
-        run_no = re.search(runfolder_pattern, runfolder).group(3)
-    except AttributeError:
-        raise ValueError(f"Runfolder name {runfolder} did not match expected format: {runfolder_pattern}")
-    print(f"Extracted date/instr_id/run_no from runfolder: {run_date}/{run_inst_id}/{run_no}")
+    runfolder_name = RunfolderName.parse(runfolder)
+    print(f"Extracted date/instr_id/run_no from runfolder: " +
+          f"{runfolder_name.run_date}/{runfolder_name.instrument_id}/{runfolder_name.run_no}")
 
-    runfolder_path = os.path.join(runfolder_base_path, instrument_name[run_inst_id], runfolder)
+    runfolder_path = os.path.join(config['runfolder_base_path'], runfolder_name.instrument_name, runfolder)
     print(f"Using runfolder path: {runfolder_path}")
-    bcl2fastq_out_path = os.path.join(bcl2fastq_base_path, runfolder)
+    bcl2fastq_out_path = os.path.join(config['bcl2fastq_base_path'], runfolder)
     print(f"Using fastq path: {bcl2fastq_out_path}")
 
     execution_timneout = '600'  # the (default) time (in sec) before the command is timed out
@@ -91,51 +86,56 @@ def build_command(script_case, input_data):
     if script_case == "runfolder_check":
         execution_timneout = '60'
         command += f" DEPLOY_ENV={DEPLOY_ENV}"
-        command += f" {runfolder_check_script} {runfolder_path}"
+        command += f" {config['runfolder_check_script']} {runfolder_path}"
     elif script_case == "samplesheet_check":
         samplesheet_path = os.path.join(runfolder_path, "SampleSheet.csv")
         command += f" conda activate pipeline &&"
-        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={aws_profile}"
-        command += f" python {samplesheet_check_script} {samplesheet_path}"
+        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={config['aws_profile']}"
+        command += f" python {config['samplesheet_check_script']} {samplesheet_path}"
     elif script_case == "bcl2fastq":
         execution_timneout = '72000'
-        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={aws_profile}"
-        command += f" {bcl2fastq_script} -R {runfolder_path} -n {runfolder} -o {bcl2fastq_out_path}"
+        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={config['aws_profile']}"
+        command += f" {config['bcl2fastq_script']} -R {runfolder_path} -n {runfolder} -o {bcl2fastq_out_path}"
     elif script_case == "create_runfolder_checksums":
         execution_timneout = '36000'
-        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={aws_profile}"
-        command += f" {checksum_script} runfolder {runfolder_path} {runfolder}"
+        command += f" conda activate pipeline &&"
+        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={config['aws_profile']}"
+        command += f" python {config['checksum_script']} runfolder {runfolder_path} {runfolder}"
     elif script_case == "create_fastq_checksums":
         execution_timneout = '36000'
-        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={aws_profile}"
-        command += f" {checksum_script} bcl2fastq {bcl2fastq_out_path} {runfolder}"
+        command += f" conda activate pipeline &&"
+        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={config['aws_profile']}"
+        command += f" python {config['checksum_script']} bcl2fastq {bcl2fastq_out_path} {runfolder}"
     elif script_case == "sync_fastqs_to_s3_spartan":
         execution_timneout = '36000'
-        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={aws_profile_spartan}"
-        command += f" {s3_sync_script} -b {s3_sync_dest_bucket} -n {runfolder}"
-        command += f" -d {runfolder} -s {bcl2fastq_out_path} -f"
+        command += f" conda activate pipeline &&"
+        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={config['aws_profile_spartan']}"
+        command += f" python {config['s3_sync_script']} -b {config['s3_sync_dest_bucket']} -n {runfolder}"
+        command += f" -d {runfolder} -s {bcl2fastq_out_path} -f --checksums bcl2fastq"
     elif script_case == "sync_runfolder_to_s3":
         execution_timneout = '10800'
-        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={aws_profile}"
-        command += f" {s3_sync_script} -b {s3_raw_data_bucket} -n {runfolder}"
-        command += f" -d {runfolder} -s {runfolder_path} -x Thumbnail_Images/*"
+        command += f" conda activate pipeline &&"
+        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={config['aws_profile']}"
+        command += f" python {config['s3_sync_script']} -b {config['s3_raw_data_bucket']} -n {runfolder}"
+        command += f" -d {runfolder} -s {runfolder_path} -x Thumbnail_Images/* --checksums runfolder"
     elif script_case == "sync_fastqs_to_s3":
         execution_timneout = '36000'
-        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={aws_profile}"
-        command += f" {s3_sync_script} -b {s3_sync_dest_bucket} -n {runfolder}"
-        command += f" -d {runfolder} -s {bcl2fastq_out_path} -f"
+        command += f" conda activate pipeline &&"
+        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={config['aws_profile']}"
+        command += f" python {config['s3_sync_script']} -b {config['s3_sync_dest_bucket']} -n {runfolder}"
+        command += f" -d {runfolder} -s {bcl2fastq_out_path} -f --checksums bcl2fastq"
     elif script_case == "google_lims_update":
         command += f" conda activate pipeline &&"
         command += f" DEPLOY_ENV={DEPLOY_ENV}"
-        command += f" python {lims_update_script} {runfolder}"
+        command += f" python {config['lims_update_script']} {runfolder}"
     elif script_case == "create_multiqc_reports":
         command += f" conda activate pipeline &&"
-        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={aws_profile}"
-        command += f" {multiqc_script} {runfolder}"
+        command += f" DEPLOY_ENV={DEPLOY_ENV} AWS_PROFILE={config['aws_profile']}"
+        command += f" {config['multiqc_script']} {runfolder}"
     elif script_case == "stats_sheet_update":
         command += f" conda activate pipeline &&"
         command += f" DEPLOY_ENV={DEPLOY_ENV}"
-        command += f" python {stats_update_script} {bcl2fastq_out_path}/Stats_custom.*.truseq/Stats.json"
+        command += f" python {config['stats_update_script']} {bcl2fastq_out_path}/Stats_custom.*.truseq/Stats.json"
     else:
         print("Unsupported script_case! Should do something sensible here....")
         raise ValueError("No valid execution script!")
@@ -198,7 +198,7 @@ def lambda_handler(event, context):
 
     session_assumed = aws_session(role_arn=BASTION_SSM_ROLE_ARN, session_name='bastion_session')
     response = session_assumed.client('ssm').send_command(
-        InstanceIds=[ssm_instance_id],
+        InstanceIds=[config['ssm_instance_id']],
         DocumentName=SSM_DOC_NAME,
         Parameters={"commands": [script_command], "executionTimeout": [script_timeout],
                     "taskToken": [task_token], "deployEnv": [DEPLOY_ENV]},
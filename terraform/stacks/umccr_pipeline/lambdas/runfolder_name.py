@@ -0,0 +1,76 @@
+import re
+import functools
+from datetime import datetime
+
+################################################################################
+# Runfolder name parsing
+#
+# Runfolder names follow the Illumina convention <YYMMDD>_<instrument ID>_<run number>_<flowcell position><flowcell ID>
+# e.g. 200401_A00130_0135_AH2JJCDSXY. A name is parsed (and validated) once, the parsed names are cached.
+# NOTE: copy of scripts/umccr_pipeline/runfolder_name.py (deployed with the pipeline scripts), keep them in sync.
+
+RUNFOLDER_PATTERN = re.compile('([12][0-9][01][0-9][0123][0-9])_(A01052|A00130)_([0-9]{4})_([A-Z0-9])([A-Z0-9]{9})')
+
+# Instrument ID mapping
+INSTRUMENT_NAMES = {
+    "A01052": "Po",
+    "A00130": "Baymax"
+}
+
+
+class RunfolderName:
+
+    __slots__ = ('name', 'run_date', 'instrument_id', 'run_no', 'flowcell_position', 'flowcell')
+
+    def __init__(self, name, run_date, instrument_id, run_no, flowcell_position, flowcell):
+        self.name = name
+        self.run_date = run_date  # YYMMDD
+        self.instrument_id = instrument_id
+        self.run_no = run_no  # zero padded, as in the name
+        self.flowcell_position = flowcell_position  # A or B on NovaSeqs
+        self.flowcell = flowcell
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def parse(runfolder):
+        """
+        :param runfolder: the runfolder name
+        :return: the RunfolderName
+        :raises ValueError: if the name does not follow the expected format
+        """
+        match = RUNFOLDER_PATTERN.fullmatch(runfolder)
+        if not match:
+            raise ValueError(f"Runfolder name {runfolder} did not match expected format: {RUNFOLDER_PATTERN.pattern}")
+        return RunfolderName(runfolder, *match.groups())
+
+    @property
+    def date(self):
+        return datetime.strptime(self.run_date, '%y%m%d')
+
+    @property
+    def year(self):
+        return self.date.strftime('%Y')
+
+    @property
+    def timestamp(self):
+        return self.date.strftime('%Y-%m-%d')
+
+    @property
+    def run_number(self):
+        return int(self.run_no)
+
+    @property
+    def instrument_name(self):
+        return INSTRUMENT_NAMES[self.instrument_id]
+
+    def __eq__(self, other):
+        return isinstance(other, RunfolderName) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return f"RunfolderName({self.name!r})"
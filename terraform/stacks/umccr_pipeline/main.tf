@@ -69,7 +69,7 @@ module "job_submission_lambda" {
   memory_size   = 128
 
   handler     = "job_submission_lambda.lambda_handler"
-  source_path = "${path.module}/lambdas/job_submission_lambda.py"
+  source_path = "${path.module}/lambdas"
 
   attach_policy = true
   policy        = "${aws_iam_policy.job_submission_lambda.arn}"
@@ -1,6 +1,8 @@
 import boto3
 import os
 import json
+from botocore.credentials import CredentialProvider, DeferredRefreshableCredentials
+from botocore.session import get_session
 
 EVENT_SOURCE = "aws.ssm"
 STATUS_SUCCESS = "Success"
@@ -10,23 +12,68 @@ DEV_SFN_ROLE_ARN = os.environ.get("DEV_SFN_ROLE_ARN")
 PROD_SFN_ROLE_ARN = os.environ.get("PROD_SFN_ROLE_ARN")
 
 
+sts_client = boto3.client('sts')
+# sessions and clients are kept across warm invocations, the credentials of assumed roles are refreshed before they
+# expire, so a burst of events only costs one AssumeRole call
+assumed_sessions = dict()  # role ARN -> boto3 Session
+clients = dict()  # (role ARN, service name) -> client
+
+
+def assume_role_refresher(role_arn, session_name):
+    def refresh():
+        response = sts_client.assume_role(RoleArn=role_arn, RoleSessionName=session_name)
+        credentials = response['Credentials']
+        print(f"Assumed role {role_arn}, credentials expire at {credentials['Expiration']}")
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat()
+        }
+    return refresh
+
+
+class AssumeRoleProvider(CredentialProvider):
+    """
+    Credentials of an assumed role, the role is only assumed when the credentials are first used (i.e. within the
+    handler) and again before they expire
+    """
+    METHOD = 'sts-assume-role'
+
+    def __init__(self, role_arn, session_name):
+        super().__init__()
+        self.refresh = assume_role_refresher(role_arn, session_name)
+
+    def load(self):
+        return DeferredRefreshableCredentials(refresh_using=self.refresh, method=self.METHOD)
+
+
 def aws_session(role_arn=None, session_name='my_session'):
     """
-    If role_arn is given assumes a role and returns boto3 session
-    otherwise return a regular session with the current IAM user/role
+    If role_arn is given returns a (cached) boto3 session for the assumed role, which refreshes its credentials
+    before they expire, otherwise return a regular session with the current IAM user/role
     """
     if role_arn:
-        client = boto3.client('sts')
-        response = client.assume_role(RoleArn=role_arn, RoleSessionName=session_name)
-        session = boto3.Session(
-            aws_access_key_id=response['Credentials']['AccessKeyId'],
-            aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-            aws_session_token=response['Credentials']['SessionToken'])
-        return session
+        if role_arn not in assumed_sessions:
+            botocore_session = get_session()
+            botocore_session.get_component('credential_provider').insert_before(
+                'env', AssumeRoleProvider(role_arn, session_name))
+            assumed_sessions[role_arn] = boto3.Session(botocore_session=botocore_session)
+        return assumed_sessions[role_arn]
     else:
         return boto3.Session()
 
 
+def aws_client(service_name, role_arn=None, session_name='my_session'):
+    """
+    Returns a (cached) client for the service, using the assumed role if role_arn is given
+    """
+    key = (role_arn, service_name)
+    if key not in clients:
+        clients[key] = aws_session(role_arn=role_arn, session_name=session_name).client(service_name)
+    return clients[key]
+
+
 def lambda_handler(event, context):
 
     print("Received event: " + json.dumps(event, indent=2))
@@ -55,12 +102,11 @@ def lambda_handler(event, context):
     print("Command status: " + command_status)
 
     if deploy_env == 'prod':
-        session_assumed = aws_session(role_arn=PROD_SFN_ROLE_ARN, session_name='bastion_session')
-        print("Assumed prod session")
+        tmp_client = aws_client('stepfunctions', role_arn=PROD_SFN_ROLE_ARN, session_name='bastion_session')
+        print("Using prod session")
     else:
-        session_assumed = aws_session(role_arn=DEV_SFN_ROLE_ARN, session_name='bastion_session')
-        print("Assumed dev session")
-    tmp_client = session_assumed.client('stepfunctions')
+        tmp_client = aws_client('stepfunctions', role_arn=DEV_SFN_ROLE_ARN, session_name='bastion_session')
+        print("Using dev session")
 
     if command_status == STATUS_SUCCESS:
         print("Successful completed pipeline step.")